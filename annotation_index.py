@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+视频标注统计索引（GET /api/annotations/stats）
+
+读取 annotation_store.py 写入的分段文件，按视频建立列式索引，回答
+"视频X每5秒内 快点/慢点 各被标注了多少次" 这类查询：
+
+    GET /api/annotations/stats?video=sample.mp4&bucket=5&labels=快点,慢点
+
+索引结构:
+    - 标注内容和会话ID映射为整数编号
+    - 每个视频三列等长数组：时间戳（升序）、标注编号、会话编号
+    - 查询时用二分查找截取时间范围，再按 (标注, 时间桶) 一次 bincount 得到全部计数
+
+增量更新：记录每个分段文件已读取的字节数，查询时（最多每 REFRESH_INTERVAL 秒一次）
+只读取新追加的完整行，合并到已排序的数组中。安装了 numpy 时使用向量化计算，
+否则使用纯 Python（结果相同，数据量大时较慢）。
+"""
+
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    import numpy as np  # 可选依赖，未安装时使用纯Python统计
+except ImportError:
+    np = None
+
+from annotation_store import iter_segments
+
+# 索引配置
+REFRESH_INTERVAL = 1.0          # 查询时检查分段文件是否有新数据的最小间隔（秒）
+DEFAULT_BUCKET_SECONDS = 5.0    # 默认时间桶宽度（秒）
+MIN_BUCKET_SECONDS = 0.01       # 时间桶宽度下限（秒）
+MAX_BUCKETS = 10000             # 单次查询最多返回的时间桶数
+
+
+class QueryError(ValueError):
+    """查询参数不合法（返回400）"""
+
+
+class VideoColumns:
+    """一个视频的全部标注：按时间戳排序的三列数组"""
+
+    def __init__(self):
+        if np is not None:
+            self.timestamps = np.empty(0, dtype=np.float64)
+            self.labels = np.empty(0, dtype=np.int32)
+            self.sessions = np.empty(0, dtype=np.int32)
+        else:
+            self.timestamps, self.labels, self.sessions = [], [], []
+        self.pending = []   # 新读入、尚未合并的 (时间戳, 标注编号, 会话编号)
+
+    def __len__(self):
+        return len(self.timestamps) + len(self.pending)
+
+    def compact(self):
+        """把新读入的数据合并到已排序的数组中"""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        if np is not None:
+            new = np.array(pending, dtype=np.float64).reshape(-1, 3)
+            timestamps = np.concatenate([self.timestamps, new[:, 0]])
+            labels = np.concatenate([self.labels, new[:, 1].astype(np.int32)])
+            sessions = np.concatenate([self.sessions, new[:, 2].astype(np.int32)])
+            # 已有部分有序，stable 排序（timsort）接近线性
+            order = np.argsort(timestamps, kind='stable')
+            self.timestamps = timestamps[order]
+            self.labels = labels[order]
+            self.sessions = sessions[order]
+        else:
+            rows = sorted(list(zip(self.timestamps, self.labels, self.sessions)) + pending,
+                          key=lambda row: row[0])
+            self.timestamps = [row[0] for row in rows]
+            self.labels = [row[1] for row in rows]
+            self.sessions = [row[2] for row in rows]
+
+
+class AnnotationIndex:
+    """标注存储目录的内存索引，多个请求线程共用"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.offsets = {}       # 分段文件路径 -> 已读取的字节数
+        self.labels = []        # 标注编号 -> 标注内容
+        self.label_ids = {}
+        self.session_ids = {}   # 会话ID（字符串）-> 会话编号
+        self.videos = {}        # 视频名（未指定时为空字符串）-> VideoColumns
+        self.records = 0
+        self.checked_at = None
+
+    def warm(self):
+        """在后台线程中读取已有的分段文件，第一次查询不必等待建立索引"""
+        def run():
+            with self._lock:
+                self.refresh()
+        threading.Thread(target=run, name='annotation-index', daemon=True).start()
+
+    def refresh(self):
+        """读取分段文件中新追加的标注（调用方持有锁）"""
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < REFRESH_INTERVAL:
+            return
+        self.checked_at = now
+        changed = False
+        for path in iter_segments(self.directory):
+            offset = self.offsets.get(path, 0)
+            try:
+                size = os.path.getsize(path)
+                if size <= offset:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(size - offset)
+            except OSError:
+                continue
+            # 只处理完整的行，正在写入的行留到下次
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                    self.add(record['video'] if record.get('video') is not None else '',
+                             float(record['timestamp']), record['label'],
+                             record.get('session_id'))
+                except (ValueError, KeyError, TypeError):
+                    continue
+            self.offsets[path] = offset + end
+            changed = True
+        if changed:
+            for columns in self.videos.values():
+                columns.compact()
+
+    def add(self, video, timestamp, label, session):
+        label_id = self.label_ids.get(label)
+        if label_id is None:
+            label_id = self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        session_key = '' if session is None else str(session)
+        session_id = self.session_ids.setdefault(session_key, len(self.session_ids))
+        columns = self.videos.get(str(video))
+        if columns is None:
+            columns = self.videos[str(video)] = VideoColumns()
+        columns.pending.append((timestamp, label_id, session_id))
+        self.records += 1
+
+    # ---- 查询 ----
+
+    def summary(self):
+        """所有视频的标注数、会话数和各标注的总数"""
+        started = time.perf_counter()
+        with self._lock:
+            self.refresh()
+            videos = []
+            totals = [0] * len(self.labels)
+            for name, columns in sorted(self.videos.items()):
+                counts = count_labels(columns.labels, len(self.labels))
+                totals = [a + b for a, b in zip(totals, counts)]
+                videos.append({
+                    'video': name,
+                    'annotations': len(columns),
+                    'sessions': count_distinct(columns.sessions),
+                    'duration': float(columns.timestamps[-1]) if len(columns.timestamps) else 0.0,
+                })
+            labels = {self.labels[i]: count
+                      for i, count in sorted(enumerate(totals), key=lambda item: -item[1])}
+        return {'annotations': self.records, 'videos': videos, 'labels': labels,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 3)}
+
+    def histogram(self, video, bucket=DEFAULT_BUCKET_SECONDS, start=0.0, end=None,
+                  labels=None, session=None):
+        """按时间桶统计一个视频的各标注数量
+
+        返回每个标注一行计数（按总数从多到少），labels 指定时只统计这些标注
+        （按给定顺序，没有出现过的标注计数为0）。
+        """
+        started = time.perf_counter()
+        if not (bucket >= MIN_BUCKET_SECONDS):
+            raise QueryError(f'bucket 不能小于 {MIN_BUCKET_SECONDS}')
+        if not (0 <= start < math.inf) or (end is not None and not (start < end < math.inf)):
+            raise QueryError('时间范围不合法')
+
+        with self._lock:
+            self.refresh()
+            columns = self.videos.get(video)
+            if columns is None:
+                raise KeyError(video)
+            if labels is None:
+                selected = list(range(len(self.labels)))
+            else:
+                selected = [self.label_ids.get(label, -1) for label in labels]
+            session_id = None
+            if session is not None:
+                session_id = self.session_ids.get(session, -1)
+
+            timestamps = columns.timestamps
+            if end is None:
+                end = (float(timestamps[-1]) if len(timestamps) else start) + 1e-9
+            buckets = max(1, math.ceil((end - start) / bucket))
+            if buckets > MAX_BUCKETS:
+                raise QueryError(f'时间桶数 {buckets} 超过上限 {MAX_BUCKETS}，请增大 bucket 或缩小时间范围')
+
+            counts, sessions = bucket_counts(columns, len(self.labels), selected,
+                                             start, end, bucket, buckets, session_id)
+
+        names = labels if labels is not None else [self.labels[i] for i in selected]
+        rows = list(zip(names, counts))
+        if labels is None:
+            # 只保留在这个视频（和时间范围）中出现过的标注
+            rows = sorted((row for row in rows if any(row[1])), key=lambda row: -sum(row[1]))
+        return {
+            'video': video,
+            'bucket': bucket,
+            'start': start,
+            'end': end,
+            'buckets': buckets,
+            'sessions': sessions,
+            'total': sum(sum(row) for _, row in rows),
+            'labels': dict(rows),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 3),
+        }
+
+
+def count_labels(labels, label_count):
+    if np is not None:
+        return np.bincount(labels, minlength=label_count).tolist()
+    counts = [0] * label_count
+    for label in labels:
+        counts[label] += 1
+    return counts
+
+
+def count_distinct(values):
+    """不同编号的个数（编号是从0开始的小整数，bincount 比排序去重快）"""
+    if np is not None:
+        return int(np.count_nonzero(np.bincount(values))) if len(values) else 0
+    return len(set(values))
+
+
+def bucket_counts(columns, label_count, selected, start, end, bucket, buckets, session_id):
+    """返回 ([每个所选标注的各桶计数], 涉及的会话数)"""
+    timestamps = columns.timestamps
+    if np is not None:
+        # 时间戳已排序：二分查找截取时间范围
+        lo, hi = np.searchsorted(timestamps, [start, end], side='left')
+        labels = columns.labels[lo:hi]
+        sessions = columns.sessions[lo:hi]
+        # 时间戳非负，乘以倒数后截断即为桶号；浮点误差可能让紧挨 end 的时间戳落到最后一个桶之外
+        slots = ((timestamps[lo:hi] - start) * (1.0 / bucket)).astype(np.int64)
+        np.minimum(slots, buckets - 1, out=slots)
+        if session_id is not None:
+            mask = sessions == session_id
+            labels, sessions, slots = labels[mask], sessions[mask], slots[mask]
+        # 只为所选且在范围内出现过的标注分配计数：标注编号先映射为行号（其他为 -1），
+        # 计数数组的大小与索引中的标注总数无关
+        present = np.bincount(labels, minlength=label_count) > 0
+        rows_of = np.full(label_count, -1, dtype=np.int64)
+        ids = sorted({label_id for label_id in selected if label_id >= 0 and present[label_id]})
+        rows_of[ids] = np.arange(len(ids))
+        rows = rows_of[labels]
+        mask = rows >= 0
+        rows, slots, sessions = rows[mask], slots[mask], sessions[mask]
+        # 一次 bincount 得到 (行, 时间桶) 的全部计数
+        grid = np.bincount(rows * buckets + slots,
+                           minlength=len(ids) * buckets).reshape(len(ids), buckets)
+        counts = [grid[rows_of[label_id]].tolist() if label_id >= 0 and rows_of[label_id] >= 0
+                  else [0] * buckets
+                  for label_id in selected]
+        return counts, count_distinct(sessions)
+
+    lo = bisect.bisect_left(timestamps, start)
+    hi = bisect.bisect_left(timestamps, end)
+    row_of = {label_id: row for row, label_id in enumerate(selected) if label_id >= 0}
+    counts = [[0] * buckets for _ in selected]
+    seen = set()
+    for i in range(lo, hi):
+        row = row_of.get(columns.labels[i])
+        if row is None or (session_id is not None and columns.sessions[i] != session_id):
+            continue
+        counts[row][min(int((timestamps[i] - start) * (1.0 / bucket)), buckets - 1)] += 1
+        seen.add(columns.sessions[i])
+    return counts, len(seen)
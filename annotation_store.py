@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+视频标注存储（POST /api/annotations）
+
+datacollection/video-annotation-tool.html 录制时把每条标注（快点/慢点/舒适…）
+实时发送到 server.py，服务器追加写入 JSON Lines 分段文件：
+
+    python3 server.py start --annotations data/annotations
+
+存储方式:
+    - 每行一条标注，字段见 normalize_record()，另加 id（"分段名:行号"）和 received_at
+    - 每个进程写自己的分段文件 annotations-<时间>-<PID>-<序号>.jsonl，
+      超过 SEGMENT_MAX_BYTES 时换新分段；多进程模式和平滑重启时不会有两个进程
+      写同一个文件，也不需要文件锁
+    - 一个写线程负责所有写入：取出队列中已到达的全部请求，一次写入、一次 fsync
+      （group commit），然后通知各请求线程返回确认；负载越高每次 fsync 覆盖的
+      请求越多
+    - 进程崩溃时分段末尾可能留下不完整的一行，读取时跳过无法解析的行
+"""
+
+import datetime
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+# 存储配置
+SEGMENT_PREFIX = 'annotations-'
+SEGMENT_SUFFIX = '.jsonl'
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024    # 分段文件超过此大小时换新分段
+QUEUE_SIZE = 1024                       # 等待写入的请求数上限，满时返回503
+COMMIT_TIMEOUT = 10.0                   # 请求线程等待写入确认的最长秒数
+
+# 请求限制
+MAX_BODY_BYTES = 1024 * 1024            # 请求体最大字节数
+MAX_BATCH_RECORDS = 5000                # 一次请求最多包含的标注数
+MAX_LABEL_LENGTH = 100                  # 标注内容最大长度（字符）
+MAX_FIELD_LENGTH = 200                  # session_id / video / client_id 的最大长度
+ANNOTATION_TYPES = ('preset', 'custom')
+
+# 可以在批量请求外层统一指定、由每条标注继承的字段
+SHARED_FIELDS = ('session_id', 'video')
+
+
+class AnnotationError(ValueError):
+    """请求中的标注不合法（返回400）"""
+
+
+def normalize_record(record, shared):
+    """校验一条标注并转换为存储格式
+
+    接受视频标注工具导出格式中的单条标注：
+    {"timestamp": 12.345, "label": "快点", "type": "preset", ...}
+    timestamp 为录制开始后的秒数；session_id、video 可以在批量请求外层指定。
+    """
+    if not isinstance(record, dict):
+        raise AnnotationError('标注必须是JSON对象')
+
+    label = record.get('label')
+    if not isinstance(label, str) or not label.strip():
+        raise AnnotationError('label 不能为空')
+    label = label.strip()
+    if len(label) > MAX_LABEL_LENGTH:
+        raise AnnotationError(f'label 超过 {MAX_LABEL_LENGTH} 个字符')
+
+    timestamp = record.get('timestamp')
+    if (isinstance(timestamp, bool) or not isinstance(timestamp, (int, float))
+            or not math.isfinite(timestamp) or timestamp < 0):
+        raise AnnotationError('timestamp 必须是非负数（秒）')
+
+    kind = record.get('type', 'custom')
+    if kind not in ANNOTATION_TYPES:
+        raise AnnotationError(f"type 必须是 {' / '.join(ANNOTATION_TYPES)}")
+
+    stored = {'timestamp': timestamp, 'label': label, 'type': kind}
+    for field in SHARED_FIELDS:
+        value = record.get(field, shared.get(field))
+        if value is not None:
+            stored[field] = check_field(field, value)
+    # 客户端生成的标注ID，重试上传时可据此去重
+    if record.get('id') is not None:
+        stored['client_id'] = check_field('id', record['id'])
+    return stored
+
+
+def check_field(name, value):
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise AnnotationError(f'{name} 必须是字符串或数字')
+    if isinstance(value, str) and len(value) > MAX_FIELD_LENGTH:
+        raise AnnotationError(f'{name} 超过 {MAX_FIELD_LENGTH} 个字符')
+    return value
+
+
+def parse_batch(data):
+    """把请求体解析为 (标注列表, 外层共享字段)
+
+    支持三种形式：单条标注对象、标注数组、或视频标注工具的导出格式
+    {"session_id": ..., "annotations": [...]}。
+    """
+    if isinstance(data, list):
+        return data, {}
+    if isinstance(data, dict) and 'annotations' in data:
+        records = data['annotations']
+        if not isinstance(records, list):
+            raise AnnotationError('annotations 必须是数组')
+        return records, {field: data[field] for field in SHARED_FIELDS if field in data}
+    if isinstance(data, dict):
+        return [data], {}
+    raise AnnotationError('请求体必须是标注对象或数组')
+
+
+def iter_segments(directory):
+    """按文件名顺序（即创建时间顺序）返回目录中的分段文件路径"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+
+
+def read_segment(path):
+    """逐条读取分段中的标注，跳过崩溃时留下的不完整行"""
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class _PendingWrite:
+    """一次请求等待写入的标注，写线程完成后设置 ids 或 error"""
+
+    __slots__ = ('records', 'done', 'ids', 'error')
+
+    def __init__(self, records):
+        self.records = records
+        self.done = threading.Event()
+        self.ids = None
+        self.error = None
+
+
+class AnnotationStore:
+    """追加写入的标注存储，所有写入由一个后台线程批量完成"""
+
+    def __init__(self, directory, segment_max_bytes=SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.segment_index = 0
+        self.file = None
+        self.segment_name = None
+        self.segment_lines = 0
+        # 统计（rejected 由请求线程修改，其余只由写线程修改）
+        self._lock = threading.Lock()
+        self.records_written = 0
+        self.commits = 0
+        self.fsync_seconds = 0.0
+        self.errors = 0
+        self.rejected = 0
+        self.thread = threading.Thread(target=self._run, name='annotation-writer', daemon=True)
+        self.thread.start()
+
+    # ---- 请求线程接口 ----
+
+    def append(self, records):
+        """提交一批已校验的标注，写入并 fsync 后返回它们的ID
+
+        队列已满时抛出 queue.Full，等待超时抛出 TimeoutError，写入失败抛出 OSError。
+        """
+        pending = _PendingWrite(records)
+        self.queue.put_nowait(pending)
+        if not pending.done.wait(COMMIT_TIMEOUT):
+            raise TimeoutError('标注写入超时')
+        if pending.error is not None:
+            raise pending.error
+        return pending.ids
+
+    def count_rejected(self, count):
+        with self._lock:
+            self.rejected += count
+
+    def close(self):
+        """写完队列中剩余的标注后停止写线程"""
+        self.queue.put(None)
+        self.thread.join(timeout=COMMIT_TIMEOUT)
+
+    # ---- 写线程 ----
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # group commit：上一次 fsync 期间到达的请求一起写入
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [pending for pending in batch if pending is not None]
+            if batch:
+                self._commit(batch)
+            if stop:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def _commit(self, batch):
+        try:
+            if self.file is None or self.file.tell() >= self.segment_max_bytes:
+                self._open_segment()
+            received_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')
+            chunks = []
+            line_no = self.segment_lines
+            for pending in batch:
+                pending.ids = []
+                for record in pending.records:
+                    line_no += 1
+                    record_id = f'{self.segment_name}:{line_no}'
+                    pending.ids.append(record_id)
+                    chunks.append(json.dumps(dict(record, id=record_id, received_at=received_at),
+                                             ensure_ascii=False, separators=(',', ':')))
+            data = ('\n'.join(chunks) + '\n').encode('utf-8')
+            self.file.write(data)
+            self.file.flush()
+            started = time.perf_counter()
+            os.fsync(self.file.fileno())
+            self.fsync_seconds += time.perf_counter() - started
+        except OSError as e:
+            # 写入失败后换新分段，已写出的部分可能留下不完整的行（读取时跳过）
+            self.errors += 1
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                self.file = None
+            for pending in batch:
+                pending.ids = None
+                pending.error = e
+                pending.done.set()
+            return
+        self.segment_lines = line_no
+        self.records_written += len(chunks)
+        self.commits += 1
+        for pending in batch:
+            pending.done.set()
+
+    def _open_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.segment_index += 1
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self.segment_name = f'{SEGMENT_PREFIX}{stamp}-{os.getpid()}-{self.segment_index:04d}'
+        path = os.path.join(self.directory, self.segment_name + SEGMENT_SUFFIX)
+        self.file = open(path, 'ab')
+        self.segment_lines = 0
+
+    # ---- 运行指标 ----
+
+    def render_metrics(self):
+        return [
+            '# HELP annotations_written_total Annotations appended to the store.',
+            '# TYPE annotations_written_total counter',
+            f'annotations_written_total {self.records_written}',
+            '# HELP annotations_rejected_total Annotations rejected as invalid.',
+            '# TYPE annotations_rejected_total counter',
+            f'annotations_rejected_total {self.rejected}',
+            '# HELP annotation_commits_total Group commits (one write and fsync each).',
+            '# TYPE annotation_commits_total counter',
+            f'annotation_commits_total {self.commits}',
+            '# HELP annotation_fsync_seconds_total Time spent in fsync.',
+            '# TYPE annotation_fsync_seconds_total counter',
+            f'annotation_fsync_seconds_total {self.fsync_seconds:.6f}',
+            '# HELP annotation_write_errors_total Failed segment writes.',
+            '# TYPE annotation_write_errors_total counter',
+            f'annotation_write_errors_total {self.errors}',
+        ]
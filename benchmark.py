@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+开发服务器压测脚本
+
+在单独的端口上启动 server.py（服务 web-prototype 目录），模拟真实的页面加载：
+index.html + 页面引用的 JS/CSS + 偶像/角色图片，同时有客户端并发地完整下载
+或分段（Range）读取视频。结束后输出吞吐量、p50/p95/p99 延迟以及服务器进程的
+CPU 和内存占用，并把结果保存为 JSON，便于比较不同版本。
+
+用法:
+    # 默认：压测30秒，16个页面客户端 + 4个视频客户端
+    python3 benchmark.py
+
+    # 传给 server.py start 的参数放在 -- 之后
+    python3 benchmark.py --label single -- --mode single
+    python3 benchmark.py --label prefork -- --workers 4
+
+    # 与之前保存的结果比较
+    python3 benchmark.py --compare benchmark-results/20250101-120000-baseline.json
+
+结果默认保存在 benchmark-results/ 目录。
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import psutil   # 可选依赖，未安装时从 /proc 读取（仅Linux）
+except ImportError:
+    psutil = None
+
+# 配置
+SCRIPT_DIR = Path(__file__).parent
+WEB_ROOT = SCRIPT_DIR / 'web-prototype'
+RESULTS_DIR = SCRIPT_DIR / 'benchmark-results'
+BENCH_PORT = 18080              # 与开发服务器（8080）错开，可以同时运行
+DURATION = 30                   # 压测时长（秒）
+WARMUP = 3                      # 预热时长（秒），期间的请求不计入结果
+PAGE_CLIENTS = 16               # 模拟页面加载的客户端数
+VIDEO_CLIENTS = 4               # 读取视频的客户端数
+FULL_VIDEO_RATIO = 0.2          # 视频请求中完整下载的比例，其余为分段读取
+VIDEO_RANGE_SIZE = 1024 * 1024  # 分段读取每次请求的字节数（浏览器播放/拖动时的典型大小）
+IMAGES_PER_PAGE = 6             # 每次页面加载请求的图片数
+STARTUP_TIMEOUT = 15            # 等待服务器启动的秒数
+SAMPLE_INTERVAL = 0.5           # 采样服务器内存的间隔（秒）
+PERCENTILES = (50, 95, 99)
+BROWSER_HEADERS = {
+    'Accept-Encoding': 'br, gzip',
+    'User-Agent': 'benchmark.py',
+}
+
+
+def discover_assets(root):
+    """扫描服务目录，得到页面、脚本/样式、图片和视频的URL列表"""
+    index = (root / 'index.html').read_text(encoding='utf-8')
+    scripts = []
+    for ref in re.findall(r'(?:src|href)="([^"]+)"', index):
+        if ref.startswith(('http:', 'https:', '//', '#', 'data:')) or not ref:
+            continue
+        if ref.endswith(('.js', '.css')) and (root / ref).is_file():
+            scripts.append('/' + ref)
+    images = sorted('/' + p.relative_to(root).as_posix()
+                    for p in (root / 'resource').rglob('*.png'))
+    videos = sorted('/' + p.relative_to(root).as_posix()
+                    for ext in ('*.mp4', '*.mov') for p in (root / 'resource').rglob(ext))
+    return {
+        'pages': ['/index.html'],
+        'scripts': sorted(set(scripts)),
+        'images': images,
+        'videos': [(url, (root / url.lstrip('/')).stat().st_size) for url in videos],
+    }
+
+
+class LoadClient:
+    """一个持久连接的HTTP客户端，记录每个请求的 (类别, 延迟, 字节数, 状态码)"""
+
+    def __init__(self, port, samples, measure_from):
+        self.port = port
+        self.samples = samples
+        self.measure_from = measure_from
+        self.conn = None
+
+    def request(self, kind, url, headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        started = time.perf_counter()
+        try:
+            self.conn.request('GET', url, headers={**BROWSER_HEADERS, **(headers or {})})
+            response = self.conn.getresponse()
+            nbytes = 0
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+            status = response.status
+            if response.will_close:
+                self.close()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            nbytes, status = 0, 0
+        finished = time.perf_counter()
+        if started >= self.measure_from:
+            self.samples.append((kind, finished - started, nbytes, status))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def page_client(port, assets, samples, measure_from, deadline, seed):
+    """反复加载页面：HTML，然后脚本/样式，然后若干图片"""
+    rng = random.Random(seed)
+    client = LoadClient(port, samples, measure_from)
+    while time.perf_counter() < deadline:
+        client.request('html', rng.choice(assets['pages']))
+        for url in assets['scripts']:
+            client.request('script', url)
+        for url in rng.sample(assets['images'], min(IMAGES_PER_PAGE, len(assets['images']))):
+            client.request('image', url)
+    client.close()
+
+
+def video_client(port, assets, samples, measure_from, deadline, seed):
+    """反复读取视频：部分完整下载，其余从随机位置分段读取"""
+    rng = random.Random(seed)
+    client = LoadClient(port, samples, measure_from)
+    while time.perf_counter() < deadline:
+        url, size = rng.choice(assets['videos'])
+        if rng.random() < FULL_VIDEO_RATIO or size <= VIDEO_RANGE_SIZE:
+            client.request('video_full', url)
+        else:
+            start = rng.randrange(0, size - VIDEO_RANGE_SIZE)
+            client.request('video_range', url,
+                           {'Range': f'bytes={start}-{start + VIDEO_RANGE_SIZE - 1}'})
+    client.close()
+
+
+def run_load_process(port, assets, page_clients, video_clients, start_at, duration, seed):
+    """在一个压测进程中运行若干客户端线程（多个进程避免客户端自身受GIL限制）
+
+    客户端立即开始发送请求（预热），start_at（墙上时间）之后开始的请求才计入结果。
+    """
+    samples = []
+    # 各进程的 perf_counter 起点不同，用墙上时间对齐开始时刻
+    measure_from = time.perf_counter() + max(0.0, start_at - time.time())
+    deadline = measure_from + duration
+    threads = []
+    for i in range(page_clients):
+        threads.append(threading.Thread(target=page_client, args=(
+            port, assets, samples, measure_from, deadline, seed * 1000 + i)))
+    for i in range(video_clients):
+        threads.append(threading.Thread(target=video_client, args=(
+            port, assets, samples, measure_from, deadline, seed * 1000 + 500 + i)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def split_clients(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def process_tree(pid):
+    """服务器进程及其子进程（多进程模式下的工作进程）"""
+    if psutil is not None:
+        try:
+            parent = psutil.Process(pid)
+            return [parent.pid] + [child.pid for child in parent.children(recursive=True)]
+        except psutil.Error:
+            return []
+    pids = [pid]
+    for entry in Path('/proc').iterdir() if Path('/proc').is_dir() else []:
+        if not entry.name.isdigit():
+            continue
+        try:
+            fields = (entry / 'stat').read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) in pids:
+            pids.append(int(entry.name))
+    return pids
+
+
+def read_process_usage(pid):
+    """返回 (CPU秒数, 常驻内存字节数)，无法读取时返回 None"""
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            times = proc.cpu_times()
+            return times.user + times.system, proc.memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        fields = Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        # utime/stime 为第14/15个字段，rss 为第24个字段（去掉 pid 和 comm 后下标减2）
+        return (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * page_size
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ResourceSampler:
+    """后台采样服务器进程树的CPU时间和内存"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu = {}           # pid -> 最近一次的CPU秒数
+        self.cpu_start = None
+        self.peak_rss = 0
+        self.rss_samples = []
+        self.running = False
+        self.thread = None
+
+    def total(self):
+        rss = 0
+        for pid in process_tree(self.pid):
+            usage = read_process_usage(pid)
+            if usage is None:
+                continue
+            self.cpu[pid] = usage[0]
+            rss += usage[1]
+        # 已退出的进程保留最后一次读到的CPU时间
+        cpu = sum(self.cpu.values())
+        return cpu, rss
+
+    def start(self):
+        self.cpu_start = self.total()[0]
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            rss = self.total()[1]
+            self.rss_samples.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.total()[0] - self.cpu_start
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, duration):
+    """按请求类别统计数量、字节数和延迟分位数（毫秒）"""
+    def stats(items):
+        latencies = sorted(latency for _, latency, _, _ in items)
+        nbytes = sum(size for _, _, size, _ in items)
+        result = {
+            'requests': len(items),
+            'errors': sum(1 for _, _, _, status in items if status == 0 or status >= 500),
+            'bytes': nbytes,
+            'requests_per_sec': round(len(items) / duration, 2),
+            'mb_per_sec': round(nbytes / duration / (1024 * 1024), 2),
+        }
+        for pct in PERCENTILES:
+            value = percentile(latencies, pct)
+            result[f'p{pct}_ms'] = None if value is None else round(value * 1000, 3)
+        result['max_ms'] = round(latencies[-1] * 1000, 3) if latencies else None
+        return result
+
+    by_kind = {}
+    for sample in samples:
+        by_kind.setdefault(sample[0], []).append(sample)
+    statuses = {}
+    for _, _, _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'total': stats(samples),
+        'by_kind': {kind: stats(items) for kind, items in sorted(by_kind.items())},
+        'status_counts': dict(sorted(statuses.items())),
+    }
+
+
+def wait_for_server(port, proc):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/index.html')
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(options):
+    assets = discover_assets(WEB_ROOT)
+    if not assets['videos'] or not assets['images']:
+        print(f"❌ 在 {WEB_ROOT} 中找不到图片或视频")
+        sys.exit(1)
+
+    server_cmd = [sys.executable, str(SCRIPT_DIR / 'server.py'), 'start',
+                  '--port', str(options.port), '--no-browser', *options.server_args]
+    print(f"🚀 启动服务器: {' '.join(server_cmd[1:])}（输出见 {RESULTS_DIR / 'server.log'}）")
+    log_file = open(RESULTS_DIR / 'server.log', 'w')
+    proc = subprocess.Popen(server_cmd, stdout=log_file, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_server(options.port, proc):
+            print(f"❌ 服务器没有在 {STARTUP_TIMEOUT} 秒内启动（端口 {options.port} 可能被占用）")
+            sys.exit(1)
+        # 多进程模式下等待所有工作进程启动
+        time.sleep(0.5)
+
+        print(f"📊 {options.page_clients} 个页面客户端 + {options.video_clients} 个视频客户端，"
+              f"{options.processes} 个压测进程，预热 {WARMUP}s，压测 {options.duration}s")
+        print(f"   {len(assets['scripts'])} 个脚本/样式, {len(assets['images'])} 张图片, "
+              f"{len(assets['videos'])} 个视频")
+        sampler = ResourceSampler(proc.pid)
+        start_at = time.time() + WARMUP
+        page_split = split_clients(options.page_clients, options.processes)
+        video_split = split_clients(options.video_clients, options.processes)
+        with multiprocessing.Pool(options.processes) as pool:
+            pending = [pool.apply_async(run_load_process, (
+                options.port, assets, page_split[i], video_split[i],
+                start_at, options.duration, options.seed + i))
+                for i in range(options.processes)]
+            time.sleep(max(0.0, start_at - time.time()))
+            sampler.start()
+            results = [item.get() for item in pending]
+        cpu_seconds = sampler.stop()
+    finally:
+        subprocess.run([sys.executable, str(SCRIPT_DIR / 'server.py'), 'stop',
+                        '--port', str(options.port)], stdout=subprocess.DEVNULL)
+        proc.wait(timeout=10)
+        log_file.close()
+
+    samples = [sample for process_samples in results for sample in process_samples]
+    summary = summarize(samples, options.duration)
+    summary['server'] = {
+        'cpu_seconds': round(cpu_seconds, 3),
+        'cpu_percent': round(cpu_seconds / options.duration * 100, 1),
+        'peak_rss_mb': round(sampler.peak_rss / (1024 * 1024), 1),
+        'avg_rss_mb': round(sum(sampler.rss_samples) / len(sampler.rss_samples) / (1024 * 1024), 1)
+        if sampler.rss_samples else None,
+    }
+    return {
+        'label': options.label,
+        'timestamp': datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'config': {
+            'server_args': options.server_args,
+            'duration': options.duration,
+            'warmup': WARMUP,
+            'page_clients': options.page_clients,
+            'video_clients': options.video_clients,
+            'processes': options.processes,
+            'full_video_ratio': FULL_VIDEO_RATIO,
+            'video_range_size': VIDEO_RANGE_SIZE,
+            'images_per_page': IMAGES_PER_PAGE,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': summary,
+    }
+
+
+def print_summary(report):
+    results = report['results']
+    print()
+    print(f"{'类别':<12}{'请求数':>9}{'req/s':>10}{'MB/s':>9}"
+          + ''.join(f"{f'p{pct}(ms)':>11}" for pct in PERCENTILES) + f"{'错误':>7}")
+    rows = list(results['by_kind'].items()) + [('total', results['total'])]
+    for kind, stats in rows:
+        latencies = ''.join(f"{'-' if stats[f'p{pct}_ms'] is None else stats[f'p{pct}_ms']:>11}"
+                            for pct in PERCENTILES)
+        print(f"{kind:<12}{stats['requests']:>9}{stats['requests_per_sec']:>10}"
+              f"{stats['mb_per_sec']:>9}{latencies}{stats['errors']:>7}")
+    server = results['server']
+    print(f"\n🖥️  服务器: CPU {server['cpu_seconds']}s ({server['cpu_percent']}% 单核), "
+          f"内存峰值 {server['peak_rss_mb']} MB")
+    print(f"   状态码: {results['status_counts']}")
+
+
+def print_comparison(report, baseline_path):
+    """与之前保存的结果逐项比较"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n📈 与 {baseline_path} 比较 ({baseline.get('label')}, {baseline.get('git_revision')}):")
+    old_kinds = dict(baseline['results']['by_kind'], total=baseline['results']['total'])
+    new_kinds = dict(report['results']['by_kind'], total=report['results']['total'])
+    for kind in sorted(set(old_kinds) & set(new_kinds)):
+        old, new = old_kinds[kind], new_kinds[kind]
+        parts = []
+        for key in ('requests_per_sec', 'p50_ms', 'p99_ms'):
+            if old.get(key) and new.get(key) is not None:
+                change = (new[key] - old[key]) / old[key] * 100
+                parts.append(f"{key} {old[key]} → {new[key]} ({change:+.1f}%)")
+        print(f"   {kind:<12} " + ", ".join(parts))
+    old_server, new_server = baseline['results']['server'], report['results']['server']
+    print(f"   {'server':<12} CPU {old_server['cpu_seconds']}s → {new_server['cpu_seconds']}s, "
+          f"内存峰值 {old_server['peak_rss_mb']} → {new_server['peak_rss_mb']} MB")
+
+
+def parse_options(args):
+    # -- 之后的参数原样传给 server.py start
+    server_args = []
+    if '--' in args:
+        index = args.index('--')
+        args, server_args = args[:index], args[index + 1:]
+    parser = argparse.ArgumentParser(prog='python3 benchmark.py',
+                                     usage='%(prog)s [选项] [-- server.py start 的参数]')
+    parser.add_argument('--port', type=int, default=BENCH_PORT,
+                        help=f'压测时服务器使用的端口 (默认: {BENCH_PORT})')
+    parser.add_argument('--duration', type=float, default=DURATION,
+                        help=f'压测时长，秒 (默认: {DURATION})')
+    parser.add_argument('--page-clients', type=int, default=PAGE_CLIENTS,
+                        help=f'页面加载客户端数 (默认: {PAGE_CLIENTS})')
+    parser.add_argument('--video-clients', type=int, default=VIDEO_CLIENTS,
+                        help=f'视频客户端数 (默认: {VIDEO_CLIENTS})')
+    parser.add_argument('--processes', type=int, default=min(4, os.cpu_count() or 1),
+                        help='运行客户端的进程数 (默认: CPU核数，最多4)')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子 (默认: 1)')
+    parser.add_argument('--label', default='run', help='结果标签，用于文件名')
+    parser.add_argument('--output', default=None,
+                        help='结果JSON文件路径 (默认: benchmark-results/<时间>-<标签>.json)')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='与之前保存的结果比较')
+    options = parser.parse_args(args)
+    options.server_args = server_args
+    options.processes = max(1, min(options.processes,
+                                   options.page_clients + options.video_clients))
+    return options
+
+
+def main():
+    options = parse_options(sys.argv[1:])
+    RESULTS_DIR.mkdir(exist_ok=True)
+    report = run_benchmark(options)
+    print_summary(report)
+
+    output = Path(options.output) if options.output else RESULTS_DIR / (
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + f"-{options.label}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 结果已保存: {output}")
+
+    if options.compare:
+        print_comparison(report, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,41 @@
 """
 发布脚本 - 构建项目发布包
 将web-prototype目录下的必要文件打包，生成发布版本
+
+默认增量构建：构建清单（BUILD_MANIFEST）记录每个源文件和输出文件的大小、
+修改时间和内容哈希，只复制/生成内容变化的文件，删除不再需要的文件，
+ZIP包中未变化的成员直接从上一个ZIP包复制压缩数据。什么都没改时不写任何文件。
+
+ZIP包中 mp4/mov/png 等已压缩的媒体文件直接存储，文本文件在多个线程中并行压缩，
+按路径顺序写入，同一构建目录生成的ZIP包逐字节相同。
+
+用法:
+    python3 build_release.py            # 增量构建
+    python3 build_release.py --clean    # 清空构建目录后完整构建
+    python3 build_release.py --jobs 4   # ZIP包压缩线程数（默认CPU核数）
 """
 
 import os
+import re
+import gzip
+import json
+import struct
+import hashlib
+import argparse
 import shutil
+import zlib
 import zipfile
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import pattern_compiler
+
+try:
+    import brotli  # 可选依赖，未安装时只生成 .gz
+except ImportError:
+    brotli = None
+
 # 配置
 PROJECT_NAME = "smart-control-prototype"
 VERSION = "1.0.0"
@@ -25,8 +52,12 @@ INCLUDE_FILES = [
     "styles.css",
     "app.js",
     "characters.js",
+    "idols.js",
+    "chat-demo.js",
     "voice.js",
     "waveform.js",
+    "control-curve.js",
+    "pattern-library.js",
     "mqtt.js",
     "manifest.json",
     "sw.js",
@@ -43,6 +74,13 @@ ROOT_INCLUDE_FILES = [
     "AI_PROTOTYPE_SUMMARY.md",
     "README_SERVER.md",
     "server.py",
+    "mqtt_broker.py",
+    "annotation_store.py",
+    "annotation_index.py",
+    "curve_compiler.py",
+    "pattern_compiler.py",
+    "command_journal.py",
+    "presence.py",
 ]
 
 ROOT_INCLUDE_DIRS = [
@@ -58,6 +96,88 @@ EXCLUDE_PATTERNS = [
     "node_modules",
 ]
 
+# 需要生成预压缩文件（.gz/.br）的文本类文件扩展名
+# mp4/mov/png 等媒体文件本身已压缩，不在此列
+PRECOMPRESS_EXTENSIONS = [
+    ".html",
+    ".css",
+    ".js",
+    ".json",
+    ".md",
+    ".svg",
+    ".txt",
+    ".curve",       # curve_compiler.py 生成的控制曲线，平滑曲线的字节重复度高
+]
+
+# 小于此大小的文件不生成预压缩文件
+PRECOMPRESS_MIN_SIZE = 256
+
+# 重命名为 name.<内容哈希>.ext 的文件扩展名（server.py 对这些文件发送 immutable 缓存头）
+FINGERPRINT_EXTENSIONS = [
+    ".js",
+    ".css",
+]
+
+# 地址必须固定的文件：Service Worker 的脚本地址变化会被当作另一个 Service Worker
+FINGERPRINT_EXCLUDE = [
+    "sw.js",
+]
+
+# 需要改写资源引用的文件
+FINGERPRINT_REFERENCES = [
+    "index.html",
+    "demo.html",
+    "sw.js",
+]
+
+FINGERPRINT_LENGTH = 10                 # 文件名中内容哈希的长度（十六进制字符）
+ASSET_MANIFEST = "asset-manifest.json"  # 资源清单：原文件名 -> 带哈希的文件名
+RELEASE_NOTES = "RELEASE_NOTES.md"
+
+# 增量构建
+ZIP_FILE = f"{RELEASE_DIR}/{PROJECT_NAME}-v{VERSION}.zip"
+BUILD_MANIFEST = f"{RELEASE_DIR}/.{PROJECT_NAME}-v{VERSION}.build.json"    # 构建清单（不在构建目录中，不打包）
+BUILD_MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024           # 计算文件哈希时每次读取的字节数
+
+# ZIP包：已压缩的格式直接存储（ZIP_STORED），再压缩只消耗CPU，几乎不减小体积
+ZIP_STORED_EXTENSIONS = [
+    ".mp4",
+    ".mov",
+    ".webm",
+    ".mp3",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".woff2",
+    ".zip",
+    ".gz",          # 预压缩文件
+    ".br",
+]
+ZIP_COMPRESS_LEVEL = 9          # 其他文件的 DEFLATE 压缩级别
+ZIP_MIN_SAVING = 0.05           # 压缩后节省不到5%时改为直接存储
+ZIP_SAMPLE_SIZE = 256 * 1024    # 更大的其他文件先试压缩开头这么多字节，不值得压缩时不压缩全文
+ZIP_FORMAT = 2                  # 打包方式变化时加1，旧ZIP包中的成员不再复用
+
+# ZIP 容器格式（APPNOTE.TXT），由 ZipWriter 写入
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+ZIP_LOCAL_SIGNATURE = 0x04034B50
+ZIP_CENTRAL_SIGNATURE = 0x02014B50
+ZIP_END_SIGNATURE = 0x06054B50
+ZIP64_END_SIGNATURE = 0x06064B50
+ZIP64_LOCATOR_SIGNATURE = 0x07064B50
+ZIP64_EXTRA_ID = 0x0001
+ZIP_FLAG_UTF8 = 0x800           # 文件名为 UTF-8
+ZIP_VERSION = 20                # 解压所需版本：DEFLATE
+ZIP64_VERSION = 45              # 解压所需版本：ZIP64
+ZIP64_LIMIT = (1 << 31) - 1     # 与 zipfile 相同：大小或偏移超过时使用 ZIP64
+
 def clean_dir(directory):
     """清理目录"""
     if os.path.exists(directory):
@@ -71,23 +191,247 @@ def should_exclude(path):
             return True
     return False
 
-def copy_file(src, dst):
-    """复制文件，保持目录结构"""
-    dst_dir = os.path.dirname(dst)
-    os.makedirs(dst_dir, exist_ok=True)
-    shutil.copy2(src, dst)
-    print(f"  ✓ {src} -> {dst}")
+def file_stat(path):
+    """用于判断文件是否变化的 (大小, 纳秒修改时间)"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
 
-def copy_directory(src, dst):
-    """复制整个目录"""
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(path):
+    """读取构建清单，不存在或格式不符时返回空清单（完整构建）"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != BUILD_MANIFEST_VERSION:
+        return {}
+    return manifest
+
+def save_manifest(path, manifest):
+    manifest["version"] = BUILD_MANIFEST_VERSION
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+class Build:
+    """构建目录的增量写入
+
+    所有输出都经过 copy()/write()：内容哈希与上次构建相同且文件未被改动
+    （大小和修改时间与清单一致）时跳过，否则写入。源文件的哈希按
+    (大小, 修改时间) 缓存，未修改的源文件不重新读取。
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.source_cache = manifest.get("sources", {})     # 源文件 -> {size, mtime_ns, sha256}
+        self.previous = manifest.get("outputs", {})         # 上次构建的输出（相对构建目录）
+        self.sources = {}
+        self.outputs = {}
+        self.written = 0
+        self.removed = 0
+
+    @property
+    def changed(self):
+        return self.written > 0 or self.removed > 0
+
+    def source_hash(self, path):
+        size, mtime_ns = file_stat(path)
+        cached = self.source_cache.get(path)
+        if cached and cached["size"] == size and cached["mtime_ns"] == mtime_ns:
+            digest = cached["sha256"]
+        else:
+            digest = hash_file(path)
+        self.sources[path] = {"size": size, "mtime_ns": mtime_ns, "sha256": digest}
+        return digest
+
+    def path(self, rel):
+        return os.path.join(self.directory, rel)
+
+    def unchanged(self, rel, digest):
+        """输出文件与上次构建相同：记录下来并返回 True"""
+        entry = self.previous.get(rel)
+        if entry is None or entry["sha256"] != digest:
+            return False
+        try:
+            if file_stat(self.path(rel)) != (entry["size"], entry["mtime_ns"]):
+                return False
+        except OSError:
+            return False
+        self.outputs[rel] = entry
+        return True
+
+    def record(self, rel, digest, **extra):
+        size, mtime_ns = file_stat(self.path(rel))
+        self.outputs[rel] = {"size": size, "mtime_ns": mtime_ns, "sha256": digest, **extra}
+        self.written += 1
+
+    def copy(self, src, rel, digest=None):
+        """复制源文件到构建目录中的 rel，返回是否写入"""
+        digest = digest or self.source_hash(src)
+        if self.unchanged(rel, digest):
+            return False
+        dst = self.path(rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(src, dst)
+        self.record(rel, digest)
+        print(f"  ✓ {src} -> {dst}")
+        return True
+
+    def write(self, rel, data, **extra):
+        """把生成的内容写入构建目录中的 rel，返回是否写入"""
+        digest = hashlib.sha256(data).hexdigest()
+        if self.unchanged(rel, digest):
+            return False
+        dst = self.path(rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with open(dst, "wb") as f:
+            f.write(data)
+        self.record(rel, digest, **extra)
+        return True
+
+    def prune(self):
+        """删除构建目录中本次没有输出的文件（源文件已删除或改名）"""
+        for root, dirs, files in os.walk(self.directory, topdown=False):
+            for file in files:
+                file_path = os.path.join(root, file)
+                rel = os.path.relpath(file_path, self.directory).replace(os.sep, "/")
+                if rel not in self.outputs:
+                    os.remove(file_path)
+                    self.removed += 1
+                    print(f"  ✗ 删除: {rel}")
+            if root != self.directory and not os.listdir(root):
+                os.rmdir(root)
+
+def walk_files(directory):
+    """目录中未排除的文件，按路径排序"""
+    result = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not should_exclude(d)]
+        result.extend(os.path.join(root, file) for file in files if not should_exclude(file))
+    return sorted(result)
+
+def copy_directory(build, src, dst):
+    """复制整个目录（只复制变化的文件）"""
     if not os.path.exists(src):
         print(f"  ⚠ 目录不存在: {src}")
         return
-    
-    shutil.copytree(src, dst, dirs_exist_ok=True)
-    print(f"  ✓ 复制目录: {src} -> {dst}")
+    for file_path in walk_files(src):
+        rel = os.path.relpath(file_path, src).replace(os.sep, "/")
+        build.copy(file_path, f"{dst}/{rel}")
+
+def rewrite_references(text, assets):
+    """把文本中引用的资源文件名替换为带哈希的文件名，返回 (新文本, 替换次数)
+
+    只替换引号内的完整文件名（可带 / 或 ./ 前缀和 ?/# 后缀），
+    不会误改 CDN 地址中的同名文件（如 mqtt.min.js）。
+    """
+    names = sorted(assets, key=len, reverse=True)
+    pattern = re.compile(r"""(["'](?:\./|/)?)(%s)(?=[?#"'])""" % "|".join(map(re.escape, names)))
+    return pattern.subn(lambda m: m.group(1) + assets[m.group(2)], text)
+
+def fingerprint_assets(build):
+    """把JS/CSS发布为 name.<内容哈希>.ext，并改写页面和 sw.js 中的引用
 
-def create_release():
+    文件名随内容变化，浏览器可以长期缓存而无需重新验证；sw.js 的 CACHE_NAME
+    由页面内容（其中包含所有带哈希的文件名）计算，资源变化时自动更新，
+    不再需要手动修改。资源清单写入 ASSET_MANIFEST，供 server.py 使用。
+    """
+    assets = {}
+    for filename in INCLUDE_FILES:
+        stem, ext = os.path.splitext(filename)
+        src = os.path.join(SOURCE_DIR, filename)
+        if ext not in FINGERPRINT_EXTENSIONS or filename in FINGERPRINT_EXCLUDE:
+            continue
+        if not os.path.exists(src):
+            continue
+        digest = build.source_hash(src)
+        hashed = f"{stem}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+        build.copy(src, hashed, digest)
+        assets[filename] = hashed
+
+    pages = {}
+    build_hash = hashlib.sha256(json.dumps(assets, sort_keys=True).encode("utf-8"))
+    for filename in FINGERPRINT_REFERENCES:
+        src = os.path.join(SOURCE_DIR, filename)
+        if not os.path.exists(src):
+            print(f"  ⚠ 文件不存在: {filename}")
+            continue
+        if not assets:
+            build.copy(src, filename)
+            continue
+        with open(src, encoding="utf-8") as f:
+            pages[filename] = rewrite_references(f.read(), assets)
+        if filename not in FINGERPRINT_EXCLUDE:
+            build_hash.update(pages[filename][0].encode("utf-8"))
+    if not assets:
+        return assets
+
+    cache_name = f"{PROJECT_NAME}-v{VERSION}-{build_hash.hexdigest()[:FINGERPRINT_LENGTH]}"
+    if "sw.js" in pages:
+        text, count = pages["sw.js"]
+        text = re.sub(r"const CACHE_NAME = '[^']*';", f"const CACHE_NAME = '{cache_name}';", text)
+        pages["sw.js"] = text, count
+    for filename, (text, count) in pages.items():
+        if build.write(filename, text.encode("utf-8")):
+            print(f"  ✓ 改写引用: {filename} ({count} 处)")
+
+    data = json.dumps({"cache_name": cache_name, "assets": assets}, indent=2, sort_keys=True) + "\n"
+    if build.write(ASSET_MANIFEST, data.encode("utf-8")):
+        print(f"  ✓ sw.js CACHE_NAME = '{cache_name}'")
+        print(f"  ✓ 资源清单: {ASSET_MANIFEST}")
+    return assets
+
+def precompress_assets(build):
+    """为文本类文件生成 .gz（以及安装了brotli时的 .br）预压缩文件
+
+    server.py 会根据 Accept-Encoding 直接发送这些文件，无需实时压缩。
+    原文件未变化时沿用上次的预压缩文件（brotli 最高质量压缩较慢）。
+    """
+    encodings = [".gz", ".br"] if brotli is not None else [".gz"]
+    count = 0
+    for rel, entry in sorted(build.outputs.items()):
+        if os.path.splitext(rel)[1].lower() not in PRECOMPRESS_EXTENSIONS:
+            continue
+        if entry["size"] < PRECOMPRESS_MIN_SIZE:
+            continue
+
+        previous = build.previous.get(rel)
+        if (previous is not None and previous["sha256"] == entry["sha256"]
+                and previous.get("encodings") == encodings
+                and all(build.unchanged(rel + variant, build.previous.get(rel + variant, {}).get("sha256"))
+                        for variant in previous["variants"])):
+            variants = previous["variants"]
+        else:
+            with open(build.path(rel), "rb") as f:
+                data = f.read()
+            # 压缩结果比原文件小时才写入；mtime=0 保证相同内容生成相同的 .gz，便于比较和缓存
+            compressed = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                compressed.append((".br", brotli.compress(data, quality=11)))
+            variants = [variant for variant, output in compressed if len(output) < len(data)]
+            for variant, output in compressed:
+                if variant in variants:
+                    build.write(rel + variant, output)
+            if variants:
+                print(f"  ✓ {rel} ({', '.join(variants)})")
+        entry["encodings"] = encodings
+        entry["variants"] = variants
+        if variants:
+            count += 1
+    if brotli is None:
+        print("  ℹ 未安装brotli模块，只生成 .gz 文件 (pip install brotli)")
+    return count
+
+def create_release(build):
     """创建发布包"""
     print("=" * 60)
     print(f"构建发布包: {PROJECT_NAME} v{VERSION}")
@@ -99,44 +443,58 @@ def create_release():
         print(f"❌ 错误: 源目录不存在: {SOURCE_DIR}")
         return False
     
-    # 清理并创建构建目录
-    print(f"\n1. 清理构建目录: {BUILD_DIR}")
-    clean_dir(BUILD_DIR)
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    print(f"\n1. 增量构建: {BUILD_DIR}" if build.previous else f"\n1. 完整构建: {BUILD_DIR}")
     
-    # 复制文件
+    # 复制文件（JS/CSS 和引用它们的页面在第3步生成）
     print(f"\n2. 复制文件到: {BUILD_DIR}")
-    copied_count = 0
-    
     for filename in INCLUDE_FILES:
         src = os.path.join(SOURCE_DIR, filename)
+        ext = os.path.splitext(filename)[1]
+        if ext in FINGERPRINT_EXTENSIONS and filename not in FINGERPRINT_EXCLUDE:
+            continue
+        if filename in FINGERPRINT_REFERENCES:
+            continue
         if os.path.exists(src):
-            dst = os.path.join(BUILD_DIR, filename)
-            copy_file(src, dst)
-            copied_count += 1
+            build.copy(src, filename)
         else:
             print(f"  ⚠ 文件不存在: {src}")
     
     # 复制目录
     for dirname in INCLUDE_DIRS:
         src = os.path.join(SOURCE_DIR, dirname)
-        dst = os.path.join(BUILD_DIR, dirname)
-        copy_directory(src, dst)
+        copy_directory(build, src, dirname)
+
+    # 预设波形和场景曲线的查找表（pattern_compiler.py），与页面脚本一起发布
+    library = pattern_compiler.encode_library(pattern_compiler.build_tables(Path(SOURCE_DIR)))
+    library_version, tables = pattern_compiler.decode_library(library)
+    pattern_compiler.verify_patterns(tables)
+    if build.write(pattern_compiler.OUTPUT_NAME, library):
+        print(f"  ✓ 生成: {pattern_compiler.OUTPUT_NAME} ({len(tables)} 个表, 版本 {library_version})")
     
+    # 生成带内容哈希的文件名（只处理网页资源）
+    print(f"\n3. 生成带内容哈希的文件名")
+    fingerprinted = fingerprint_assets(build)
+    print(f"  共 {len(fingerprinted)} 个文件")
+
     # 复制根目录的文档与文件
-    print(f"\n3. 复制项目文档与脚本")
+    print(f"\n4. 复制项目文档与脚本")
     for doc in ROOT_INCLUDE_FILES:
         if os.path.exists(doc):
-            dst = os.path.join(BUILD_DIR, doc)
-            copy_file(doc, dst)
+            build.copy(doc, doc)
         else:
             print(f"  ⚠ 文件不存在: {doc}")
 
     for directory in ROOT_INCLUDE_DIRS:
-        dst = os.path.join(BUILD_DIR, directory)
-        copy_directory(directory, dst)
+        copy_directory(build, directory, directory)
+    
+    # 生成预压缩文件
+    print(f"\n5. 生成预压缩文件 (.gz/.br)")
+    precompressed_count = precompress_assets(build)
+    print(f"  共 {precompressed_count} 个文件")
     
     # 创建发布说明
-    print(f"\n4. 创建发布说明")
+    print(f"\n6. 创建发布说明")
     release_notes = f"""# {PROJECT_NAME} v{VERSION}
 
 ## 发布日期
@@ -155,9 +513,19 @@ def create_release():
 - styles.css - 样式文件
 - app.js - 主应用逻辑
 - characters.js - 角色和场景配置
+- idols.js - 女优分身数据
+- chat-demo.js - AI互动聊天演示数据
 - voice.js - 语音交互模块
 - waveform.js - 波形动画模块
 - mqtt.js - MQTT客户端
+- pattern-library.js / {pattern_compiler.OUTPUT_NAME} - 预编译的波形模式库（预设波形和场景曲线的定点数查找表，版本 {library_version}）
+
+### 带内容哈希的文件名
+- *.js / *.css 发布为 name.<哈希>.ext，页面和 sw.js 中的引用已改写
+- {ASSET_MANIFEST} - 资源清单（原文件名 -> 带哈希的文件名），server.py 据此对这些文件发送长期缓存头
+
+### 预压缩文件
+- *.gz / *.br - 文本类文件的预压缩版本，server.py 按 Accept-Encoding 自动选择
 
 ### PWA支持
 - manifest.json - Web App清单
@@ -196,56 +564,247 @@ def create_release():
 如有问题请联系开发团队。
 """
     
-    release_notes_path = os.path.join(BUILD_DIR, "RELEASE_NOTES.md")
-    with open(release_notes_path, "w", encoding="utf-8") as f:
-        f.write(release_notes)
-    print(f"  ✓ 创建发布说明: RELEASE_NOTES.md")
+    # 内容没有任何变化时保留原发布说明（其中的构建时间不变），ZIP包也就不需要重写
+    previous_notes = build.previous.get(RELEASE_NOTES, {}).get("sha256")
+    stale = set(build.previous) - set(build.outputs) - {RELEASE_NOTES}
+    if build.written or stale or not build.unchanged(RELEASE_NOTES, previous_notes):
+        build.write(RELEASE_NOTES, release_notes.encode("utf-8"))
+        print(f"  ✓ 创建发布说明: {RELEASE_NOTES}")
+    else:
+        print(f"  ✓ 内容未变化，保留 {RELEASE_NOTES}")
+
+    # 删除源文件已不存在的输出（以及带旧哈希的JS/CSS）
+    build.prune()
     
-    print(f"\n✅ 构建完成! 已复制 {copied_count} 个文件")
+    unchanged = len(build.outputs) - build.written
+    print(f"\n✅ 构建完成! 写入 {build.written} 个文件, 删除 {build.removed} 个, {unchanged} 个未变化")
     print(f"📦 构建目录: {BUILD_DIR}")
     
     return True
 
-def create_zip():
-    """创建ZIP压缩包"""
-    print(f"\n5. 创建ZIP压缩包")
-    zip_filename = f"{RELEASE_DIR}/{PROJECT_NAME}-v{VERSION}.zip"
-    
-    if os.path.exists(zip_filename):
-        os.remove(zip_filename)
-    
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(BUILD_DIR):
-            # 排除系统文件
-            dirs[:] = [d for d in dirs if not should_exclude(d)]
-            
-            for file in files:
-                if should_exclude(file):
+class ZipWriter:
+    """顺序写ZIP包，成员的压缩数据由调用方准备好（并行压缩或从旧ZIP包复制）
+
+    zipfile 只能边压缩边写入，这里按 APPNOTE.TXT 直接写ZIP容器格式，
+    成员信息只使用 ZipInfo 的公开字段。成员大小或偏移超过 ZIP64_LIMIT 时
+    写入 ZIP64 扩展字段，中央目录超过限制时写入 ZIP64 结束记录。
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.central = []       # 中央目录条目
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def add(self, info, data=None, source=None):
+        """写入一个成员：data 为压缩后的数据；为 None 时从文件对象 source 的当前位置
+        复制 info.compress_size 字节（直接存储的文件、旧ZIP包中的成员），不整个读入内存
+        """
+        name = info.filename.encode("utf-8")
+        flags = 0 if info.filename.isascii() else ZIP_FLAG_UTF8
+        year, month, day, hour, minute, second = info.date_time
+        dos_time = hour << 11 | minute << 5 | second // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        offset = self.file.tell()
+        zip64 = info.file_size > ZIP64_LIMIT or info.compress_size > ZIP64_LIMIT
+        version = ZIP64_VERSION if zip64 or offset > ZIP64_LIMIT else ZIP_VERSION
+
+        # 本地文件头：需要 ZIP64 时两个大小都写在扩展字段中
+        if zip64:
+            extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, info.file_size, info.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b""
+            sizes = (info.compress_size, info.file_size)
+        self.file.write(ZIP_LOCAL_HEADER.pack(ZIP_LOCAL_SIGNATURE, version, flags, info.compress_type,
+                                              dos_time, dos_date, info.CRC, *sizes,
+                                              len(name), len(extra)) + name + extra)
+        if data is not None:
+            self.file.write(data)
+        else:
+            remaining = info.compress_size
+            while remaining:
+                chunk = source.read(min(remaining, HASH_CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError(f"{info.filename}: 数据比记录的大小短")
+                self.file.write(chunk)
+                remaining -= len(chunk)
+
+        # 中央目录条目：只有超过限制的字段写入 ZIP64 扩展字段（按 原大小、压缩大小、偏移 的顺序）
+        values = []
+        file_size, compress_size, header_offset = info.file_size, info.compress_size, offset
+        if file_size > ZIP64_LIMIT:
+            values.append(file_size)
+            file_size = 0xFFFFFFFF
+        if compress_size > ZIP64_LIMIT:
+            values.append(compress_size)
+            compress_size = 0xFFFFFFFF
+        if header_offset > ZIP64_LIMIT:
+            values.append(header_offset)
+            header_offset = 0xFFFFFFFF
+        extra = struct.pack(f"<HH{len(values)}Q", ZIP64_EXTRA_ID, 8 * len(values), *values) if values else b""
+        self.central.append(ZIP_CENTRAL_HEADER.pack(
+            ZIP_CENTRAL_SIGNATURE, info.create_system << 8 | version, version, flags,
+            info.compress_type, dos_time, dos_date, info.CRC, compress_size, file_size,
+            len(name), len(extra), 0, 0, 0, info.external_attr, header_offset) + name + extra)
+
+    def copy(self, source, info):
+        """从旧ZIP包（以二进制方式打开的文件）原样复制一个成员的压缩数据"""
+        source.seek(info.header_offset)
+        header = ZIP_LOCAL_HEADER.unpack(source.read(ZIP_LOCAL_HEADER.size))
+        if header[0] != ZIP_LOCAL_SIGNATURE:
+            raise ValueError(f"{info.filename}: 本地文件头损坏")
+        source.seek(header[-2] + header[-1], os.SEEK_CUR)     # 跳过文件名和扩展字段
+        self.add(info, source=source)
+
+    def close(self):
+        start = self.file.tell()
+        for entry in self.central:
+            self.file.write(entry)
+        end = self.file.tell()
+        count, size = len(self.central), end - start
+        if count >= 0xFFFF or size > ZIP64_LIMIT or start > ZIP64_LIMIT:
+            self.file.write(ZIP64_END_RECORD.pack(ZIP64_END_SIGNATURE, ZIP64_END_RECORD.size - 12,
+                                                  ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                                  count, count, size, start))
+            self.file.write(ZIP64_END_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, end, 1))
+            count, size, start = 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF
+        self.file.write(ZIP_END_RECORD.pack(ZIP_END_SIGNATURE, 0, 0, count, count, size, start, 0))
+        self.file.close()
+
+def deflate(data, level=ZIP_COMPRESS_LEVEL):
+    """ZIP 使用的原始 DEFLATE 流（不带 zlib 头）"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def worth_compressing(data, compressed_size):
+    return compressed_size <= len(data) * (1 - ZIP_MIN_SAVING)
+
+def prepare_zip_member(path, arcname):
+    """计算一个成员的CRC并决定是否压缩，返回 (ZipInfo, 压缩数据或 None)
+
+    在工作线程中运行（zlib 压缩和CRC计算时释放GIL）。直接存储的成员返回 None，
+    写入时再从文件复制，媒体文件不需要整个读入内存。
+    """
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    info.compress_type = zipfile.ZIP_STORED
+    info.compress_size = info.file_size
+    if os.path.splitext(arcname)[1].lower() in ZIP_STORED_EXTENSIONS:
+        crc = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+        info.CRC = crc
+        return info, None
+
+    with open(path, "rb") as f:
+        data = f.read()
+    info.CRC = zlib.crc32(data)
+    if len(data) > ZIP_SAMPLE_SIZE:
+        sample = data[:ZIP_SAMPLE_SIZE]
+        if not worth_compressing(sample, len(deflate(sample, 1))):
+            return info, None
+    compressed = deflate(data)
+    if not worth_compressing(data, len(compressed)):
+        return info, None
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.compress_size = len(compressed)
+    return info, compressed
+
+def create_zip(build, previous, jobs=None):
+    """创建ZIP压缩包，返回清单中的ZIP记录
+
+    成员按路径排序。上一个ZIP包未被改动时，内容未变化的成员直接复制其压缩数据；
+    其余成员由 jobs 个线程并行压缩（媒体文件直接存储），按顺序写入，
+    结果与线程完成的先后无关。成员完全相同时不重写ZIP包。
+    """
+    print(f"\n7. 创建ZIP压缩包")
+    members = {rel: entry["sha256"] for rel, entry in sorted(build.outputs.items())}
+    old_members = {}
+    if previous and previous.get("format") == ZIP_FORMAT and os.path.exists(ZIP_FILE) and \
+            file_stat(ZIP_FILE) == (previous["size"], previous["mtime_ns"]):
+        old_members = previous["members"]
+    if old_members == members:
+        print(f"  ✓ 内容未变化，保留 {ZIP_FILE}")
+        return previous
+
+    # 先写临时文件：复制成员时还要读取旧的ZIP包
+    tmp = f"{ZIP_FILE}.tmp"
+    counts = {"deflated": 0, "stored": 0, "reused": 0}
+    old_infos = {}
+    if old_members:
+        with zipfile.ZipFile(ZIP_FILE) as old_zip:
+            old_infos = {info.filename: info for info in old_zip.infolist()}
+    old_file = open(ZIP_FILE, "rb") if old_infos else None
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor, \
+                ZipWriter(tmp) as writer:
+            pending = {arcname: executor.submit(prepare_zip_member, build.path(arcname), arcname)
+                       for arcname, digest in members.items()
+                       if old_members.get(arcname) != digest or arcname not in old_infos}
+            for arcname in members:
+                if arcname not in pending:
+                    writer.copy(old_file, old_infos[arcname])
+                    counts["reused"] += 1
                     continue
-                
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, BUILD_DIR)
-                zipf.write(file_path, arcname)
-                print(f"  ✓ 添加: {arcname}")
+                info, data = pending.pop(arcname).result()
+                if data is None:
+                    with open(build.path(arcname), "rb") as f:
+                        writer.add(info, source=f)
+                    counts["stored"] += 1
+                    print(f"  ✓ 添加: {arcname} (不压缩)")
+                else:
+                    writer.add(info, data)
+                    counts["deflated"] += 1
+                    print(f"  ✓ 添加: {arcname} (压缩到 {info.compress_size * 100 // max(info.file_size, 1)}%)")
+    finally:
+        if old_file is not None:
+            old_file.close()
+    os.replace(tmp, ZIP_FILE)
     
-    file_size = os.path.getsize(zip_filename) / (1024 * 1024)  # MB
-    print(f"\n✅ ZIP包创建完成: {zip_filename} ({file_size:.2f} MB)")
+    size, mtime_ns = file_stat(ZIP_FILE)
+    print(f"\n✅ ZIP包创建完成: {ZIP_FILE} ({size / (1024 * 1024):.2f} MB, "
+          f"压缩 {counts['deflated']} 个成员, 直接存储 {counts['stored']} 个, 沿用 {counts['reused']} 个)")
     
-    return zip_filename
+    return {"format": ZIP_FORMAT, "size": size, "mtime_ns": mtime_ns, "members": members}
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description=f'构建 {PROJECT_NAME} 发布包（默认增量构建）')
+    parser.add_argument('--clean', action='store_true',
+                        help='清空构建目录，忽略构建清单，完整重新构建')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='ZIP包压缩线程数 (默认: CPU核数)')
+    args = parser.parse_args()
+
     try:
+        if args.clean:
+            print(f"清理构建目录: {BUILD_DIR}")
+            clean_dir(BUILD_DIR)
+            manifest = {}
+        else:
+            manifest = load_manifest(BUILD_MANIFEST)
+        build = Build(BUILD_DIR, manifest)
+
         # 创建发布包
-        if not create_release():
+        if not create_release(build):
             return
         
         # 创建ZIP压缩包
-        zip_file = create_zip()
+        zip_record = create_zip(build, manifest.get("zip"), args.jobs)
+        save_manifest(BUILD_MANIFEST, {"sources": build.sources, "outputs": build.outputs,
+                                       "zip": zip_record})
         
         print("\n" + "=" * 60)
         print("🎉 发布包构建完成!")
-        print(f"📦 ZIP文件: {zip_file}")
+        print(f"📦 ZIP文件: {ZIP_FILE}")
         print(f"📁 解压目录: {BUILD_DIR}")
         print("=" * 60)
         
@@ -255,4 +814,4 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+设备控制命令日志（python3 server.py start --mqtt --journal data/journal）
+
+内置MQTT代理转发给设备的每条 device/control 消息都记录到该设备的日志文件中，
+之后可以按时间范围查看（审计），或把一段会话按原速/加速重新发给设备（回放）：
+
+    GET  /api/journal                                       所有设备的日志概况
+    GET  /api/journal?device=ID&start=<秒>&end=<秒>          一段时间内的命令
+    POST /api/journal/replay  {"device": ID, "start": ..., "end": ..., "speed": 2}
+
+存储方式:
+    - 每个设备一个固定大小的文件（按 mmap 映射），头部之后是 capacity 个定长记录
+      组成的环形缓冲区；第 seq 条记录写在 seq % capacity 号槽位，写满后覆盖最旧的
+      记录，磁盘占用不超过 设备数 × 文件大小
+    - 追加只写一个槽位和头部的下一个序号，时间复杂度 O(1)；写入进入内核页缓存，
+      进程崩溃不会丢失，由内核按需写回磁盘（关闭时 flush）
+    - 同一设备的记录时间戳单调不减，按时间范围读取时在环中二分查找，
+      返回的是映射内存的 memoryview 切片，不复制记录内容
+
+文件格式（小端）:
+    头部 256 字节: magic 'SCJL', 版本 u16, 保留 u16, 记录大小 u32, 记录数 u32,
+                   下一个序号 u64, 设备ID长度 u16, 设备ID 128 字节
+    记录 256 字节: 序号 u64, 时间戳 f64（Unix 秒）, payload 的 CRC32 u32,
+                   payload 长度 u16, QoS u8, 标志 u8, payload（最多 232 字节）
+"""
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl    # Windows 上没有，平滑重启期间新旧进程写同一设备日志时不加锁
+except ImportError:
+    fcntl = None
+
+# 日志配置
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_RECORDS = 16384         # 每个设备保留的记录数（每个设备约4MB）
+JOURNAL_MAX_DEVICES = 256       # 最多记录的设备数，超过后新设备的命令不再记录（磁盘上限约1GB）
+DEFAULT_QUERY_LIMIT = 1000      # 查询时默认最多返回的记录数
+
+# 回放配置
+REPLAY_MAX_SPEED = 100.0        # 最大回放倍速
+REPLAY_MAX_GAP = 10.0           # 回放时两条命令之间的最长等待（秒，已按倍速缩放），跳过会话中的长时间空闲
+
+# 文件格式
+JOURNAL_MAGIC = b'SCJL'
+JOURNAL_VERSION = 1
+HEADER_SIZE = 256
+RECORD_SIZE = 256
+MAX_DEVICE_ID_BYTES = 128
+HEADER = struct.Struct('<4sHHIIQH128s')
+HEAD_OFFSET = 16                # 头部中"下一个序号"字段的偏移
+RECORD = struct.Struct('<QdIHBB')
+PAYLOAD_CAPACITY = RECORD_SIZE - RECORD.size
+
+# 记录标志
+FLAG_TRUNCATED = 0x01           # payload 超过 PAYLOAD_CAPACITY 被截断（不能回放）
+FLAG_REPLAY = 0x02              # 由回放发出的命令
+
+
+class JournalError(ValueError):
+    """日志文件或查询参数不合法（返回400）"""
+
+
+class DeviceJournal:
+    """一个设备的环形命令日志（映射到内存的定长文件）
+
+    下一个序号只保存在映射的文件头部：平滑重启期间新旧两个进程可能同时写同一个
+    设备的日志，追加时在文件锁内读取并更新头部，两个进程的记录不会互相覆盖。
+    """
+
+    def __init__(self, path, device_id=None, capacity=JOURNAL_RECORDS):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self.file = open(path, 'x+b')
+            created = True
+        except FileExistsError:
+            self.file = open(path, 'r+b')
+            created = False
+        try:
+            with self.file_lock():
+                if created:
+                    encoded = device_id.encode('utf-8')
+                    header = HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, 0, RECORD_SIZE,
+                                         capacity, 0, len(encoded), encoded)
+                    self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+                    self.file.flush()
+                    # 一次分配完整大小，之后文件大小不再变化；预先分配磁盘空间，
+                    # 避免磁盘满时写入映射内存触发 SIGBUS
+                    size = HEADER_SIZE + RECORD_SIZE * capacity
+                    if hasattr(os, 'posix_fallocate'):
+                        os.posix_fallocate(self.file.fileno(), 0, size)
+                    else:
+                        self.file.truncate(size)
+                self.map = mmap.mmap(self.file.fileno(), 0)
+            magic, version, _, record_size, self.capacity, _, id_length, raw_id = \
+                HEADER.unpack_from(self.map)
+            if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or record_size != RECORD_SIZE:
+                raise JournalError(f'不是命令日志文件或版本不支持: {path}')
+            if len(self.map) < HEADER_SIZE + RECORD_SIZE * self.capacity:
+                raise JournalError(f'命令日志文件不完整: {path}')
+        except (OSError, ValueError, struct.error):
+            self.file.close()
+            raise
+        self.device_id = raw_id[:id_length].decode('utf-8', 'replace')
+        self.view = memoryview(self.map)
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        """跨进程的排他锁（没有 fcntl 的系统上只有进程内的锁）"""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    @property
+    def head(self):
+        """下一条记录的序号（即已写入的记录总数）"""
+        return struct.unpack_from('<Q', self.map, HEAD_OFFSET)[0]
+
+    @property
+    def first_seq(self):
+        """环中最旧一条记录的序号"""
+        return max(0, self.head - self.capacity)
+
+    # ---- 写入 ----
+
+    def append(self, payload, qos=0, flags=0, timestamp=None):
+        """追加一条命令，返回它的序号"""
+        if len(payload) > PAYLOAD_CAPACITY:
+            payload = payload[:PAYLOAD_CAPACITY]
+            flags |= FLAG_TRUNCATED
+        with self._lock, self.file_lock():
+            seq = self.head
+            # 时间戳单调不减（系统时间回拨时沿用上一条的时间），保证可以二分查找
+            timestamp = time.time() if timestamp is None else timestamp
+            if seq:
+                timestamp = max(timestamp, self.timestamp_at(seq - 1))
+            offset = self.slot_offset(seq)
+            RECORD.pack_into(self.map, offset, seq, timestamp, zlib.crc32(payload),
+                             len(payload), qos, flags)
+            self.map[offset + RECORD.size:offset + RECORD.size + len(payload)] = payload
+            struct.pack_into('<Q', self.map, HEAD_OFFSET, seq + 1)
+        return seq
+
+    # ---- 读取 ----
+
+    def slot_offset(self, seq):
+        return HEADER_SIZE + (seq % self.capacity) * RECORD_SIZE
+
+    def timestamp_at(self, seq):
+        return struct.unpack_from('<d', self.map, self.slot_offset(seq) + 8)[0]
+
+    def record_at(self, seq):
+        """返回 (序号, 时间戳, QoS, 标志, payload memoryview)，记录已被覆盖或损坏时返回 None"""
+        offset = self.slot_offset(seq)
+        stored_seq, timestamp, crc, length, qos, flags = RECORD.unpack_from(self.map, offset)
+        if stored_seq != seq or length > PAYLOAD_CAPACITY:
+            return None
+        payload = self.view[offset + RECORD.size:offset + RECORD.size + length]
+        if zlib.crc32(payload) != crc:
+            return None
+        return seq, timestamp, qos, flags, payload
+
+    def is_current(self, seq):
+        """槽位中仍是序号 seq 的记录（没有被环绕写入覆盖）"""
+        return struct.unpack_from('<Q', self.map, self.slot_offset(seq))[0] == seq
+
+    def seek(self, timestamp, lo, hi):
+        """[lo, hi) 中第一条时间戳 >= timestamp 的记录的序号"""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp_at(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=None, end=None):
+        """时间范围 [start, end)（Unix 秒）内记录的序号范围 (lo, hi)"""
+        with self._lock:
+            lo, hi = self.first_seq, self.head
+            if start is not None:
+                lo = self.seek(start, lo, hi)
+            if end is not None:
+                hi = self.seek(end, lo, hi)
+        return lo, hi
+
+    def read(self, lo, hi):
+        """逐条返回序号 [lo, hi) 的记录，payload 是映射内存的切片（不复制）
+
+        只在写入线程（代理的事件循环）中、且不跨 await 使用时记录不会变化；
+        其他线程读取或需要在等待之后使用时，槽位可能已被覆盖，应使用 copy()。
+        """
+        for seq in range(max(lo, self.first_seq), hi):
+            record = self.record_at(seq)
+            if record is not None:
+                yield record
+
+    def copy(self, lo, hi, limit):
+        """复制序号 [lo, hi) 中最多 limit 条记录（其他线程读取时使用）"""
+        records = []
+        for seq, timestamp, qos, flags, payload in self.read(lo, hi):
+            data = bytes(payload)
+            # 复制期间被覆盖的记录丢弃
+            if self.is_current(seq):
+                records.append((seq, timestamp, qos, flags, data))
+                if len(records) >= limit:
+                    break
+        return records
+
+    def summary(self):
+        with self._lock:
+            lo, hi = self.first_seq, self.head
+            first = self.timestamp_at(lo) if hi > lo else None
+            last = self.timestamp_at(hi - 1) if hi > lo else None
+        return {
+            'device': self.device_id,
+            'records': hi - lo,
+            'total': hi,
+            'capacity': self.capacity,
+            'first': first,
+            'last': last,
+        }
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.flush()
+            self.map.close()
+        except BufferError:
+            # 仍有未释放的记录切片（如回放被中断），交给垃圾回收
+            pass
+        self.file.close()
+
+
+class CommandJournal:
+    """日志目录：按设备ID打开各设备的 DeviceJournal"""
+
+    def __init__(self, directory, capacity=JOURNAL_RECORDS, max_devices=JOURNAL_MAX_DEVICES):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_devices = max_devices
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.journals = {}          # 设备ID -> DeviceJournal
+        self.records_written = 0
+        self.records_dropped = 0    # 超过设备数上限或无法创建日志文件而没有记录的命令
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(JOURNAL_SUFFIX):
+                try:
+                    journal = DeviceJournal(os.path.join(directory, name))
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"⚠️  跳过无法读取的命令日志 {name}: {e}")
+                    continue
+                self.journals[journal.device_id] = journal
+
+    def path_for(self, device_id):
+        # 设备ID可能含有任意字符，文件名使用哈希，设备ID保存在文件头部
+        digest = hashlib.sha1(device_id.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, digest + JOURNAL_SUFFIX)
+
+    def get(self, device_id):
+        return self.journals.get(device_id)
+
+    def append(self, device_id, payload, qos=0, flags=0):
+        """记录一条发给设备的命令，返回序号；设备数已达上限时返回 None"""
+        journal = self.journals.get(device_id)
+        if journal is None:
+            with self._lock:
+                journal = self.journals.get(device_id)
+                if journal is None:
+                    if (len(self.journals) >= self.max_devices
+                            or len(device_id.encode('utf-8')) > MAX_DEVICE_ID_BYTES):
+                        self.records_dropped += 1
+                        return None
+                    try:
+                        journal = DeviceJournal(self.path_for(device_id), device_id, self.capacity)
+                    except (OSError, ValueError, struct.error) as e:
+                        print(f"⚠️  无法创建设备 {device_id} 的命令日志: {e}")
+                        self.records_dropped += 1
+                        return None
+                    self.journals[device_id] = journal
+        seq = journal.append(payload, qos, flags)
+        self.records_written += 1
+        return seq
+
+    def summary(self):
+        return {'devices': [journal.summary() for _, journal in sorted(self.journals.items())],
+                'capacity': self.capacity,
+                'max_devices': self.max_devices}
+
+    def close(self):
+        with self._lock:
+            for journal in self.journals.values():
+                journal.close()
+            self.journals = {}
+
+    def render_metrics(self):
+        return [
+            '# HELP journal_records_written_total Control commands recorded in device journals.',
+            '# TYPE journal_records_written_total counter',
+            f'journal_records_written_total {self.records_written}',
+            '# HELP journal_records_dropped_total Control commands not recorded (device limit reached or journal unusable).',
+            '# TYPE journal_records_dropped_total counter',
+            f'journal_records_dropped_total {self.records_dropped}',
+            '# HELP journal_devices Devices with a command journal.',
+            '# TYPE journal_devices gauge',
+            f'journal_devices {len(self.journals)}',
+        ]
+
+
+def record_to_json(record):
+    """把一条记录转换为查询接口返回的JSON对象"""
+    seq, timestamp, qos, flags, payload = record
+    item = {'seq': seq, 'timestamp': timestamp, 'qos': qos}
+    if flags & FLAG_REPLAY:
+        item['replay'] = True
+    if flags & FLAG_TRUNCATED:
+        item['truncated'] = True
+    text = bytes(payload).decode('utf-8', 'replace')
+    try:
+        item['message'] = json.loads(text)
+    except ValueError:
+        item['payload'] = text
+    return item
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def main():
+    """离线查看日志目录（不需要启动服务器）"""
+    parser = argparse.ArgumentParser(description='查看设备控制命令日志')
+    parser.add_argument('directory', help='日志目录（server.py start --journal 使用的目录）')
+    parser.add_argument('--device', help='只显示该设备的命令')
+    parser.add_argument('--last', type=int, default=20, help='显示最近的多少条命令 (默认: 20)')
+    args = parser.parse_args()
+
+    journal = CommandJournal(args.directory)
+    try:
+        if args.device is None:
+            for item in journal.summary()['devices']:
+                span = (f"{format_time(item['first'])} ~ {format_time(item['last'])}"
+                        if item['records'] else '-')
+                print(f"📟 {item['device']}: {item['records']}/{item['capacity']} 条 "
+                      f"(共写入 {item['total']} 条)  {span}")
+            return
+        device = journal.get(args.device)
+        if device is None:
+            print(f"❌ 没有设备 {args.device} 的命令日志")
+            return
+        lo, hi = device.range()
+        for record in device.copy(max(lo, hi - args.last), hi, args.last):
+            item = record_to_json(record)
+            command = item.get('message', {}).get('command', item.get('payload'))
+            mark = ' [回放]' if item.get('replay') else ''
+            print(f"{item['seq']:>8}  {format_time(item['timestamp'])}{mark}  "
+                  f"{json.dumps(command, ensure_ascii=False)}")
+    finally:
+        journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+标注 -> 控制曲线编译器
+
+把视频标注工具收集的观看反馈（快点/慢点/轻点/重点…）编译成按固定采样率的
+速度/强度曲线，以紧凑的二进制格式保存在视频旁边（video.mp4 -> video.mp4.curve）。
+客户端播放视频时加载曲线（control-curve.js），按播放时间直接查表发送控制命令，
+不需要在播放时计算。
+
+用法:
+    # 编译 idols.js / characters.js 中所有有标注的视频
+    python3 curve_compiler.py --annotations data/annotations
+
+    # 只编译指定视频（标注的 video 字段与视频路径相同）
+    python3 curve_compiler.py --annotations data/annotations --video resource/idol/koroko/video.mp4
+
+    # 查看已生成的曲线
+    python3 curve_compiler.py --show web-prototype/resource/idol/koroko/video.mp4.curve
+
+编译步骤:
+    1. 从标注索引按 1/采样率 的时间桶统计各标注数量（annotation_index.py）
+    2. 每种标注按 LABEL_EFFECTS 折算为速度/强度的升降，除以会话数得到
+       "每个观看者每秒的反馈量"
+    3. 标注时间向前平移 REACTION_DELAY（观看者的反应延迟），再做高斯平滑
+    4. 按 95 分位数归一化后映射到 BASELINE ± SPAN，取整为 0-100
+
+曲线文件格式（小端）:
+    头部 32 字节: magic 'SCCV', 版本 u16, 通道数 u16, 采样率 f32,
+                  采样数 u32, 会话数 u32, 标注数 u32, 保留 8 字节
+    数据: 采样数 × 通道数 个 u8（0-100），按采样交错存放：速度, 强度, 速度, 强度, ...
+"""
+
+import argparse
+import math
+import os
+import re
+import struct
+import sys
+from pathlib import Path
+
+from annotation_index import MAX_BUCKETS, AnnotationIndex
+
+# 配置
+SCRIPT_DIR = Path(__file__).parent
+WEB_ROOT = SCRIPT_DIR / 'web-prototype'
+VIDEO_SOURCES = ['idols.js', 'characters.js']   # 从这些文件的 videoPath 中查找视频
+
+SAMPLE_RATE = 10.0          # 每秒采样数
+REACTION_DELAY = 1.0        # 观看者从感受到变化到按下标注的平均延迟（秒）
+SMOOTHING_SIGMA = 2.0       # 高斯平滑的标准差（秒）
+BASELINE = 50               # 没有反馈时的速度/强度（0-100）
+SPAN = 40                   # 反馈最强处相对基线的最大偏移
+SIGNAL_FLOOR = 0.02         # 归一化的最小尺度（每个观看者每秒的反馈量），少量标注不会被放大成满幅
+MIN_SESSIONS = 3            # 会话数少于此值的视频不编译
+
+# 标注 -> (速度变化, 强度变化)，不在表中的自定义标注不参与编译
+LABEL_EFFECTS = {
+    '快点': (1.0, 0.0),
+    '慢点': (-1.0, 0.0),
+    '重点': (0.0, 1.0),
+    '轻点': (0.0, -1.0),
+    '兴奋': (0.5, 0.5),
+    '平静': (-0.5, -0.5),
+    '紧张': (-0.5, -0.5),
+    '难过': (-0.5, -1.0),
+    '舒适': (0.0, 0.0),      # 保持当前状态
+}
+CHANNELS = ('speed', 'intensity')
+
+# 曲线文件格式
+CURVE_SUFFIX = '.curve'
+CURVE_MAGIC = b'SCCV'
+CURVE_VERSION = 1
+CURVE_HEADER = struct.Struct('<4sHHfIII8x')
+
+
+def find_videos(web_root):
+    """idols.js / characters.js 中出现的视频路径"""
+    videos = []
+    for name in VIDEO_SOURCES:
+        path = web_root / name
+        if path.exists():
+            videos += re.findall(r"videoPath:\s*'([^']+)'", path.read_text(encoding='utf-8'))
+    return list(dict.fromkeys(videos))
+
+
+def gaussian_smooth(values, sigma):
+    """高斯平滑（sigma 以采样点为单位），两端按边界值延伸"""
+    radius = int(math.ceil(3 * sigma))
+    if radius == 0 or not values:
+        return list(values)
+    kernel = [math.exp(-0.5 * (k / sigma) ** 2) for k in range(-radius, radius + 1)]
+    total = sum(kernel)
+    kernel = [weight / total for weight in kernel]
+    padded = [values[0]] * radius + list(values) + [values[-1]] * radius
+    return [sum(weight * padded[i + k] for k, weight in enumerate(kernel))
+            for i in range(len(values))]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def label_counts(index, video, bucket, end):
+    """按采样间隔统计 LABEL_EFFECTS 中各标注的数量，超过单次查询的桶数上限时分段查询"""
+    counts = {label: [] for label in LABEL_EFFECTS}
+    total = 0
+    start = 0.0
+    while start < end:
+        stop = min(end, start + bucket * (MAX_BUCKETS - 1))
+        hist = index.histogram(video, bucket=bucket, start=start, end=stop,
+                               labels=list(LABEL_EFFECTS))
+        for label, row in hist['labels'].items():
+            counts[label] += row
+        total += hist['total']
+        start += bucket * hist['buckets']
+    return counts, total
+
+
+def compile_curve(index, video, info, rate=SAMPLE_RATE):
+    """根据一个视频的标注生成曲线，info 为标注索引 summary() 中这个视频的条目
+
+    返回 (各通道的采样值列表, 统计信息)。
+    """
+    sigma = SMOOTHING_SIGMA * rate
+    shift = int(round(REACTION_DELAY * rate))
+    # 曲线延续到最后一个标注之后，平滑的尾部回到基线
+    end = info['duration'] + 3 * SMOOTHING_SIGMA
+    counts, total = label_counts(index, video, 1.0 / rate, end)
+    samples = len(counts[next(iter(LABEL_EFFECTS))])
+    sessions = max(1, info['sessions'])
+
+    channels = []
+    for channel in range(len(CHANNELS)):
+        drive = [0.0] * samples
+        for label, row in counts.items():
+            effect = LABEL_EFFECTS[label][channel]
+            if effect:
+                for i, count in enumerate(row):
+                    if count:
+                        drive[i] += effect * count
+        # 每个观看者每秒的反馈量；t 时刻的标注是对 t - REACTION_DELAY 时内容的反应
+        drive = [value * rate / sessions for value in drive[shift:]] + [0.0] * min(shift, samples)
+        smoothed = gaussian_smooth(drive, sigma)
+        scale = max(percentile([abs(value) for value in smoothed], 95), SIGNAL_FLOOR)
+        channels.append([
+            max(0, min(100, int(round(BASELINE + SPAN * max(-1.0, min(1.0, value / scale))))))
+            for value in smoothed
+        ])
+    stats = {
+        'samples': samples,
+        'duration': samples / rate,
+        'sessions': info['sessions'],
+        'annotations': total,
+        'ignored': info['annotations'] - total,
+    }
+    return channels, stats
+
+
+def encode_curve(channels, rate, sessions, annotations):
+    """把各通道的采样值打包为曲线文件内容"""
+    samples = len(channels[0])
+    header = CURVE_HEADER.pack(CURVE_MAGIC, CURVE_VERSION, len(channels), rate,
+                               samples, sessions, annotations)
+    return header + bytes(value for sample in zip(*channels) for value in sample)
+
+
+def decode_curve(data):
+    """解析曲线文件，返回 (头部字段, 各通道的采样值列表)"""
+    magic, version, channel_count, rate, samples, sessions, annotations = \
+        CURVE_HEADER.unpack_from(data)
+    if magic != CURVE_MAGIC or version != CURVE_VERSION:
+        raise ValueError('不是曲线文件或版本不支持')
+    body = data[CURVE_HEADER.size:CURVE_HEADER.size + samples * channel_count]
+    channels = [list(body[i::channel_count]) for i in range(channel_count)]
+    header = {'version': version, 'channels': channel_count, 'rate': rate,
+              'samples': samples, 'sessions': sessions, 'annotations': annotations}
+    return header, channels
+
+
+def write_curve(path, data):
+    """先写临时文件再替换，服务器不会发送写了一半的曲线"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def sparkline(values, width=60):
+    """用字符画概览曲线"""
+    blocks = ' ▁▂▃▄▅▆▇█'
+    if not values:
+        return ''
+    step = max(1, len(values) // width)
+    points = [sum(values[i:i + step]) / len(values[i:i + step]) for i in range(0, len(values), step)]
+    return ''.join(blocks[min(8, int(value / 100 * 8 + 0.5))] for value in points)
+
+
+def show_curve(path):
+    with open(path, 'rb') as f:
+        header, channels = decode_curve(f.read())
+    print(f"📈 {path}")
+    print(f"   采样率 {header['rate']:g} Hz, {header['samples']} 个采样 "
+          f"({header['samples'] / header['rate']:.1f} 秒), "
+          f"{header['sessions']} 个会话, {header['annotations']} 条标注")
+    for name, values in zip(CHANNELS, channels):
+        print(f"   {name:<9} {min(values):>3}-{max(values):<3} {sparkline(values)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把视频标注编译为控制曲线')
+    parser.add_argument('--annotations', metavar='DIR',
+                        help='标注存储目录（server.py start --annotations 使用的目录）')
+    parser.add_argument('--video', action='append', default=None,
+                        help='要编译的视频路径（相对于 --root，可重复），默认为 idols.js/characters.js 中的所有视频')
+    parser.add_argument('--root', default=str(WEB_ROOT),
+                        help='视频所在的服务目录 (默认: web-prototype)')
+    parser.add_argument('--rate', type=float, default=SAMPLE_RATE,
+                        help=f'采样率 Hz (默认: {SAMPLE_RATE:g})')
+    parser.add_argument('--min-sessions', type=int, default=MIN_SESSIONS,
+                        help=f'会话数少于此值的视频不编译 (默认: {MIN_SESSIONS})')
+    parser.add_argument('--show', metavar='FILE', nargs='+',
+                        help='查看已生成的曲线文件')
+    args = parser.parse_args()
+
+    if args.show:
+        for path in args.show:
+            show_curve(path)
+        return
+    if not args.annotations:
+        parser.error('需要 --annotations DIR')
+    if not (0 < args.rate <= 1000):
+        parser.error('--rate 必须在 0-1000 之间')
+
+    root = Path(args.root)
+    index = AnnotationIndex(args.annotations)
+    available = {video['video']: video for video in index.summary()['videos']}
+    videos = args.video or find_videos(root)
+    compiled = 0
+    for video in videos:
+        info = available.get(video)
+        if info is None:
+            print(f"  - {video}: 没有标注，跳过")
+            continue
+        if info['sessions'] < args.min_sessions:
+            print(f"  - {video}: 只有 {info['sessions']} 个会话（少于 {args.min_sessions}），跳过")
+            continue
+        video_path = root / video
+        if not video_path.exists():
+            print(f"  ⚠ {video}: 视频文件不存在: {video_path}")
+            continue
+        channels, stats = compile_curve(index, video, info, args.rate)
+        curve_path = f'{video_path}{CURVE_SUFFIX}'
+        write_curve(curve_path, encode_curve(channels, args.rate, stats['sessions'], stats['annotations']))
+        compiled += 1
+        print(f"  ✓ {video}: {stats['samples']} 个采样 ({stats['duration']:.1f} 秒), "
+              f"{stats['sessions']} 个会话, {stats['annotations']} 条标注"
+              + (f"（{stats['ignored']} 条自定义标注未使用）" if stats['ignored'] else ''))
+        for name, values in zip(CHANNELS, channels):
+            print(f"      {name:<9} {sparkline(values)}")
+    print(f"\n✅ 已生成 {compiled} 条曲线")
+    if compiled == 0 and not args.video:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
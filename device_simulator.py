@@ -0,0 +1,918 @@
+#!/usr/bin/env python3
+"""
+设备模拟器（控制链路压测）
+
+在一个 asyncio 进程中模拟上万台设备：每台设备建立自己的 MQTT 连接，订阅
+device/control/<设备ID>，按延迟模型处理命令后在 device/status/<设备ID> 上报
+状态（带命令回执），并定时发送 device/heartbeat/<设备ID> 心跳，行为与真实设备
+对 mqtt.js 的约定相同。可选的控制端按固定速率向随机设备发送命令，结束时输出
+实际达到的消息速率和延迟分位数，便于在一台 Linux 机器上评估和回归测试控制链路。
+
+用法:
+    # 先启动带内置MQTT代理的服务器
+    python3 server.py start --mqtt --no-browser
+
+    # 1万台设备，控制端每秒发送5000条命令，运行60秒
+    python3 device_simulator.py --devices 10000 --rate 5000 --duration 60
+
+    # 只模拟设备（由真实页面发送命令），直到按 Ctrl+C
+    python3 device_simulator.py --devices 100 --rate 0 --duration 0
+
+    # 保存结果并与之前的结果比较
+    python3 device_simulator.py --output sim.json --compare sim-baseline.json
+
+    # 外部 broker（TCP）或 HTTPS 服务器（自签名证书）
+    python3 device_simulator.py --broker mqtt://127.0.0.1:1883
+    python3 device_simulator.py --broker wss://127.0.0.1:8080/mqtt --insecure
+
+统计口径:
+    送达延迟  控制端发出命令（消息 timestamp）到设备收到的时间
+    回执延迟  控制端发出命令到收到设备状态回执的时间（含设备处理延迟）
+模拟器和服务器在同一台机器上时两者使用同一个时钟，延迟才有意义。
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import ssl
+import struct
+import sys
+import time
+import urllib.parse
+
+from mqtt_broker import (CONNACK, CONNECT, DISCONNECT, PINGREQ, PUBACK, PUBLISH,
+                         SUBACK, SUBSCRIBE, MQTTError, PacketReader, build_packet,
+                         build_publish, encode_string, raise_nofile_limit, split_packet,
+                         websocket_accept_key, websocket_frame)
+
+try:
+    import resource     # 统计模拟器自身的CPU时间（Windows 上没有）
+except ImportError:
+    resource = None
+
+try:
+    import uvloop       # 可选依赖，安装后事件循环的开销约减半
+except ImportError:
+    uvloop = None
+
+# 配置
+BROKER_URL = 'ws://127.0.0.1:8080/mqtt'
+DEVICES = 1000                  # 模拟的设备数
+DEVICE_PREFIX = 'sim'           # 设备ID为 <前缀>-00001 …，同时运行多个模拟器时需各自不同
+COMMAND_RATE = 1000             # 控制端每秒发送的命令总数，0表示只模拟设备
+DURATION = 60                   # 压测时长（秒），0表示一直运行到 Ctrl+C
+REPORT_INTERVAL = 5             # 输出一次统计的间隔（秒）
+HEARTBEAT_INTERVAL = 30         # 设备心跳间隔（秒），与 app.js 相同
+KEEPALIVE = 60                  # MQTT keepalive（秒）
+CONNECT_RATE = 1000             # 每秒最多建立的设备连接数，避免瞬间挤满服务器的连接队列
+MAX_CONNECTING = 64             # 同时进行握手的连接数
+CONNECT_TIMEOUT = 10            # 单个连接（TCP + WebSocket + CONNACK/SUBACK）的超时（秒）
+RECONNECT_DELAY = 1.0           # 断线后首次重连的等待（秒），之后加倍
+RECONNECT_MAX_DELAY = 30.0      # 重连等待的上限（秒）
+CONTROL_TICK = 0.01             # 控制端按此间隔补发到期的命令（秒）
+
+# 设备处理命令的延迟模型：对数正态分布（中位数 × e^(σ·N(0,1))），同一台设备的命令
+# 依次处理（单片机串行执行），另有一定比例的命令在设备端丢失（无线链路）
+LATENCY_MEDIAN_MS = 40.0
+LATENCY_SIGMA = 0.5
+COMMAND_LOSS = 0.0
+
+# 控制端发送的命令类型及比例（参数与 mqtt.js 的 DeviceCommands 相同）
+COMMAND_MIX = [
+    ('speed', 0.4),
+    ('intensity', 0.4),
+    ('pattern', 0.1),
+    ('status_request', 0.07),
+    ('stop', 0.03),
+]
+PATTERNS = ('wave', 'pulse', 'random')
+
+# 延迟直方图：对数分桶，每桶相差约 5%，最小 0.01ms
+HISTOGRAM_MIN_MS = 0.01
+HISTOGRAM_STEPS = 20            # 每个 e 倍的桶数
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图（毫秒），内存占用与样本数无关"""
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        # 不同进程的时钟可能有微小差异，负值按最小桶计
+        ms = max(ms, HISTOGRAM_MIN_MS)
+        index = int(math.log(ms / HISTOGRAM_MIN_MS) * HISTOGRAM_STEPS)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        if not self.total:
+            return None
+        rank = pct / 100 * self.total
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(HISTOGRAM_MIN_MS * math.exp((index + 0.5) / HISTOGRAM_STEPS), self.max)
+        return self.max
+
+    def summary(self):
+        result = {'count': self.total,
+                  'mean_ms': round(self.sum / self.total, 3) if self.total else None}
+        for pct in PERCENTILES:
+            value = self.percentile(pct)
+            result[f'p{pct}_ms'] = None if value is None else round(value, 3)
+        result['max_ms'] = round(self.max, 3) if self.total else None
+        return result
+
+
+class Stats:
+    """模拟器的计数器；interval 直方图每次输出统计后清空"""
+
+    MESSAGE_COUNTERS = ('commands_sent', 'commands_received', 'commands_lost', 'status_sent',
+                        'heartbeats_sent', 'acks_received', 'disconnects')
+    COUNTERS = MESSAGE_COUNTERS + ('connects', 'connect_errors')
+
+    def __init__(self):
+        self.connects = 0
+        self.connect_errors = 0
+        self.online = 0
+        self.last_error = None
+        self.reset()
+
+    def reset(self):
+        """清零消息计数和延迟（建立连接期间的消息不计入压测结果）"""
+        for name in self.MESSAGE_COUNTERS:
+            setattr(self, name, 0)
+        self.delivery = LatencyHistogram()
+        self.round_trip = LatencyHistogram()
+        self.interval_delivery = LatencyHistogram()
+        self.interval_round_trip = LatencyHistogram()
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+
+class Target:
+    """--broker 地址：ws/wss 为 WebSocket（server.py 内置代理），mqtt/mqtts 为 TCP"""
+
+    def __init__(self, url, insecure=False):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('ws', 'wss', 'mqtt', 'mqtts'):
+            raise ValueError(f'不支持的地址: {url}（应为 ws://、wss://、mqtt:// 或 mqtts://）')
+        self.url = url
+        self.websocket = parts.scheme in ('ws', 'wss')
+        secure = parts.scheme in ('wss', 'mqtts')
+        self.host = parts.hostname or '127.0.0.1'
+        self.port = parts.port or {'ws': 80, 'wss': 443, 'mqtt': 1883, 'mqtts': 8883}[parts.scheme]
+        self.path = parts.path or '/mqtt'
+        self.ssl = None
+        if secure:
+            self.ssl = ssl.create_default_context()
+            if insecure:
+                # server.py 默认使用自签名证书
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+
+
+class Link:
+    """到代理的一条连接，收发 MQTT 报文（WebSocket 时加上/去掉帧）"""
+
+    def __init__(self, reader, writer, websocket):
+        self.reader = reader
+        self.writer = writer
+        self.websocket = websocket
+        self.buffer = bytearray()
+
+    @classmethod
+    async def open(cls, target):
+        reader, writer = await asyncio.open_connection(target.host, target.port, ssl=target.ssl)
+        link = cls(reader, writer, target.websocket)
+        if target.websocket:
+            try:
+                await link.handshake(target)
+            except BaseException:
+                link.close()
+                raise
+        return link
+
+    async def handshake(self, target):
+        key = websocket_key()
+        self.writer.write(
+            f'GET {target.path} HTTP/1.1\r\n'
+            f'Host: {target.host}:{target.port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            'Sec-WebSocket-Protocol: mqtt\r\n'
+            '\r\n'.encode('ascii'))
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        status = head.split('\r\n', 1)[0]
+        if status.split()[1:2] != ['101']:
+            raise MQTTError(f'WebSocket握手失败: {status}')
+        if websocket_accept_key(key) not in head:
+            raise MQTTError('WebSocket握手失败: Sec-WebSocket-Accept 不匹配')
+
+    def send(self, packet):
+        if self.writer.is_closing():
+            return
+        if self.websocket:
+            packet = websocket_frame(packet, mask=os.urandom(4))
+        self.writer.write(packet)
+
+    async def read_packet(self):
+        """读取一个完整的 MQTT 报文，返回 (首字节, 内容)"""
+        while True:
+            packet = split_packet(self.buffer)
+            if packet is not None:
+                return packet
+            if self.websocket:
+                self.buffer += await self.read_frame()
+            else:
+                data = await self.reader.read(65536)
+                if not data:
+                    raise ConnectionResetError('连接已关闭')
+                self.buffer += data
+
+    async def read_frame(self):
+        """读取服务器发来的一个数据帧（不带掩码），应答 ping"""
+        while True:
+            head = await self.reader.readexactly(2)
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(length)
+            if opcode in (0x0, 0x2):
+                return payload
+            if opcode == 0x8:
+                raise ConnectionResetError('WebSocket closed')
+            if opcode == 0x9:
+                self.writer.write(websocket_frame(payload, opcode=0xA, mask=os.urandom(4)))
+
+    def close(self):
+        self.writer.close()
+
+
+def websocket_key():
+    return base64.b64encode(os.urandom(16)).decode('ascii')
+
+
+def connect_packet(client_id, keepalive, will=None):
+    """MQTT 3.1.1 CONNECT（clean session），will 为 (主题, 内容) 的保留消息"""
+    flags = 0x02
+    payload = encode_string(client_id)
+    if will is not None:
+        flags |= 0x04 | 0x20
+        payload += encode_string(will[0]) + encode_string(will[1])
+    body = encode_string('MQTT') + bytes((4, flags)) + struct.pack('!H', keepalive) + payload
+    return build_packet(CONNECT << 4, body)
+
+
+def subscribe_packet(packet_id, topic_filter, qos):
+    body = struct.pack('!H', packet_id) + encode_string(topic_filter) + bytes((qos,))
+    return build_packet((SUBSCRIBE << 4) | 0x02, body)
+
+
+def parse_publish(first, body):
+    """返回 (主题, QoS, 报文ID, 内容)"""
+    qos = (first >> 1) & 0x03
+    reader = PacketReader(body)
+    topic = reader.string()
+    packet_id = reader.uint16() if qos else None
+    return topic, qos, packet_id, reader.rest()
+
+
+async def open_session(target, client_id, subscriptions, will=None):
+    """建立连接并完成 CONNECT/SUBSCRIBE，返回 Link"""
+    link = await Link.open(target)
+    try:
+        link.send(connect_packet(client_id, KEEPALIVE, will))
+        first, body = await link.read_packet()
+        if first >> 4 != CONNACK or len(body) < 2 or body[1] != 0:
+            raise MQTTError(f'连接被拒绝: {body.hex()}')
+        for packet_id, (topic_filter, qos) in enumerate(subscriptions, 1):
+            link.send(subscribe_packet(packet_id, topic_filter, qos))
+            first, body = await link.read_packet()
+            if first >> 4 != SUBACK or body[-1] & 0x80:
+                raise MQTTError(f'订阅 {topic_filter} 失败')
+    except BaseException:
+        link.close()
+        raise
+    return link
+
+
+def now_ms():
+    return time.time() * 1000
+
+
+class LatencyModel:
+    """设备处理一条命令所需的时间（秒）"""
+
+    def __init__(self, median_ms, sigma, loss):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.loss = loss
+
+    def sample(self, rng):
+        return self.median * math.exp(self.sigma * rng.gauss(0.0, 1.0))
+
+
+class SimulatedDevice:
+    """一台模拟设备：一个连接、一份设备状态，命令按延迟模型依次处理"""
+
+    def __init__(self, fleet, device_id, rng):
+        self.fleet = fleet
+        self.device_id = device_id
+        self.rng = rng
+        self.control_topic = f'device/control/{device_id}'
+        self.status_topic = f'device/status/{device_id}'
+        self.heartbeat_topic = f'device/heartbeat/{device_id}'
+        self.link = None
+        self.timer = None
+        self.busy_until = 0.0
+        self.started = time.time()
+        self.battery = rng.uniform(40, 100)
+        self.state = {'running': False, 'speed': 0, 'intensity': 0, 'pattern': 'wave', 'mode': None}
+
+    async def run(self):
+        fleet = self.fleet
+        stats = fleet.stats
+        delay = RECONNECT_DELAY
+        while fleet.running:
+            try:
+                async with fleet.connecting:
+                    await fleet.pace_connect()
+                    will = (self.status_topic, self.status_payload(online=False))
+                    self.link = await asyncio.wait_for(
+                        open_session(fleet.target, self.device_id,
+                                     [(self.control_topic, fleet.qos)], will),
+                        CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, MQTTError, ValueError) as e:
+                stats.connect_errors += 1
+                stats.last_error = f'{type(e).__name__}: {e}'
+                await asyncio.sleep(delay * (0.5 + self.rng.random()))
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            stats.connects += 1
+            stats.online += 1
+            try:
+                self.publish_status()
+                self.schedule_heartbeat(self.rng.uniform(0, fleet.heartbeat_period))
+                await self.serve()
+            except (OSError, asyncio.IncompleteReadError, MQTTError, ValueError) as e:
+                stats.last_error = f'{type(e).__name__}: {e}'
+            finally:
+                stats.online -= 1
+                if self.timer is not None:
+                    self.timer.cancel()
+                if fleet.running:
+                    self.link.close()
+                    self.link = None
+            if fleet.running:
+                stats.disconnects += 1
+                await asyncio.sleep(delay * (0.5 + self.rng.random()))
+
+    async def serve(self):
+        while True:
+            first, body = await self.link.read_packet()
+            if first >> 4 == PUBLISH:
+                topic, qos, packet_id, payload = parse_publish(first, body)
+                if qos:
+                    # MQTT 协议栈收到即应答，应用层随后处理
+                    self.link.send(build_packet(PUBACK << 4, struct.pack('!H', packet_id)))
+                self.receive(payload)
+
+    def receive(self, payload):
+        fleet = self.fleet
+        stats = fleet.stats
+        stats.commands_received += 1
+        try:
+            message = json.loads(payload)
+            command = message['command']
+            sent_at = message.get('timestamp')
+        except (ValueError, KeyError, TypeError):
+            return
+        if isinstance(sent_at, (int, float)):
+            latency = now_ms() - sent_at
+            stats.delivery.add(latency)
+            stats.interval_delivery.add(latency)
+        if fleet.latency.loss and self.rng.random() < fleet.latency.loss:
+            stats.commands_lost += 1
+            return
+        # 同一台设备的命令依次处理
+        loop = fleet.loop
+        self.busy_until = max(loop.time(), self.busy_until) + fleet.latency.sample(self.rng)
+        loop.call_at(self.busy_until, self.apply, command, sent_at)
+
+    def apply(self, command, sent_at):
+        if self.link is None or not isinstance(command, dict):
+            return
+        command_type = command.get('type')
+        parameters = command.get('parameters') or {}
+        state = self.state
+        if command_type in ('stop', 'emergency_stop', 'ai_mode_stop', 'free_mode_stop'):
+            state.update(running=False, speed=0, intensity=0, mode=None)
+        elif command_type in ('speed', 'stroke_speed', 'rotation_speed'):
+            state.update(running=True, speed=parameters.get('value', state['speed']))
+        elif command_type in ('intensity', 'suction_intensity'):
+            state.update(running=True, intensity=parameters.get('value', state['intensity']))
+        elif command_type == 'pattern':
+            state['pattern'] = parameters.get('type', state['pattern'])
+        elif command_type == 'preset':
+            state.update(running=True, mode=parameters.get('mode'))
+        elif command_type == 'waveform_update':
+            for key in ('speed', 'intensity', 'pattern'):
+                if parameters.get(key) is not None:
+                    state[key] = parameters[key]
+        elif command_type in ('ai_mode_start', 'free_mode_start'):
+            state.update(running=True, mode=command_type[:-len('_start')])
+        self.publish_status({'type': command_type, 'timestamp': sent_at})
+
+    def status_payload(self, online=True, ack=None):
+        status = {'deviceId': self.device_id, 'timestamp': int(now_ms()), 'online': online}
+        if online:
+            status.update(self.state, battery=int(self.battery))
+        if ack is not None:
+            status['ack'] = ack
+        return json.dumps(status, separators=(',', ':')).encode('utf-8')
+
+    def publish_status(self, ack=None):
+        # 在线状态作为保留消息，页面订阅后立即得到设备的最新状态
+        self.link.send(build_publish(self.status_topic, self.status_payload(ack=ack),
+                                     0, ack is None, 4))
+        self.fleet.stats.status_sent += 1
+
+    def schedule_heartbeat(self, delay):
+        self.timer = self.fleet.loop.call_later(delay, self.heartbeat)
+
+    def heartbeat(self):
+        fleet = self.fleet
+        if fleet.heartbeat:
+            if self.state['running']:
+                self.battery = max(0.0, self.battery - 0.01 * fleet.heartbeat)
+            payload = json.dumps({
+                'deviceId': self.device_id,
+                'timestamp': int(now_ms()),
+                'uptime': int(time.time() - self.started),
+                'battery': int(self.battery),
+                'rssi': -40 - int(self.rng.random() * 40),
+            }, separators=(',', ':')).encode('utf-8')
+            self.link.send(build_publish(self.heartbeat_topic, payload, 0, False, 4))
+            fleet.stats.heartbeats_sent += 1
+        else:
+            self.link.send(build_packet(PINGREQ << 4))
+        self.schedule_heartbeat(fleet.heartbeat_period)
+
+
+class Controller:
+    """控制端：按固定速率向随机设备发送命令，第一个控制端同时订阅状态回执"""
+
+    def __init__(self, fleet, index, rate, collect_acks):
+        self.fleet = fleet
+        self.client_id = f'{fleet.prefix}-controller-{index}'
+        self.rate = rate
+        self.collect_acks = collect_acks
+        self.rng = random.Random(fleet.seed * 7919 + index)
+        self.link = None
+        self.reader = None
+        self.packet_ids = itertools.cycle(range(1, 65536))
+        self.types = [command_type for command_type, _ in COMMAND_MIX]
+        self.weights = [weight for _, weight in COMMAND_MIX]
+
+    async def connect(self):
+        fleet = self.fleet
+        subscriptions = [('device/status/+', 0)] if self.collect_acks else []
+        self.link = await asyncio.wait_for(
+            open_session(fleet.target, self.client_id, subscriptions), CONNECT_TIMEOUT)
+        self.reader = asyncio.ensure_future(self.read_acks())
+
+    async def send_commands(self, deadline):
+        """发送命令直到 deadline；连接断开时重连，断开期间到期的命令不补发"""
+        fleet = self.fleet
+        while fleet.sending and (deadline is None or fleet.loop.time() < deadline):
+            try:
+                if self.link is None:
+                    await self.connect()
+                await self.send_until(deadline)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    MQTTError, ValueError) as e:
+                fleet.stats.last_error = f'controller {type(e).__name__}: {e}'
+                self.close()
+                self.link = None
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def send_until(self, deadline):
+        fleet = self.fleet
+        loop = fleet.loop
+        started = loop.time()
+        sent = 0
+        keepalive_at = started + KEEPALIVE / 2
+        while fleet.sending and (deadline is None or loop.time() < deadline):
+            if self.link.writer.is_closing() or self.reader.done():
+                raise ConnectionResetError('控制端连接已断开')
+            now = loop.time()
+            due = int((now - started) * self.rate) - sent
+            for _ in range(due):
+                device = self.rng.choice(fleet.devices)
+                self.link.send(build_publish(device.control_topic, self.command_payload(),
+                                             fleet.qos, False, 4, next(self.packet_ids)))
+            sent += max(due, 0)
+            fleet.stats.commands_sent += max(due, 0)
+            if now >= keepalive_at:
+                self.link.send(build_packet(PINGREQ << 4))
+                keepalive_at = now + KEEPALIVE / 2
+            # 代理接收不及时等待缓冲区排空，实际速率会低于目标速率
+            await self.link.writer.drain()
+            await asyncio.sleep(CONTROL_TICK)
+
+    def command_payload(self):
+        command_type = self.rng.choices(self.types, self.weights)[0]
+        if command_type in ('speed', 'intensity'):
+            parameters = {'value': self.rng.randint(0, 100)}
+        elif command_type == 'pattern':
+            parameters = {'type': self.rng.choice(PATTERNS)}
+        else:
+            parameters = {}
+        timestamp = now_ms()
+        return json.dumps({
+            'timestamp': timestamp,
+            'command': {'type': command_type, 'parameters': parameters, 'timestamp': int(timestamp)},
+        }, separators=(',', ':')).encode('utf-8')
+
+    async def read_acks(self):
+        stats = self.fleet.stats
+        try:
+            while True:
+                first, body = await self.link.read_packet()
+                if first >> 4 != PUBLISH or not self.collect_acks:
+                    continue
+                _, _, _, payload = parse_publish(first, body)
+                try:
+                    ack = json.loads(payload).get('ack')
+                    sent_at = ack['timestamp']
+                except (ValueError, AttributeError, KeyError, TypeError):
+                    continue
+                if isinstance(sent_at, (int, float)):
+                    stats.acks_received += 1
+                    latency = now_ms() - sent_at
+                    stats.round_trip.add(latency)
+                    stats.interval_round_trip.add(latency)
+        except (OSError, asyncio.IncompleteReadError, MQTTError, ValueError) as e:
+            stats.last_error = f'controller {type(e).__name__}: {e}'
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.link is not None:
+            self.link.send(build_packet(DISCONNECT << 4))
+            self.link.close()
+
+
+class Fleet:
+    """所有模拟设备和控制端"""
+
+    def __init__(self, options):
+        self.options = options
+        self.target = Target(options.broker, options.insecure)
+        self.prefix = options.prefix
+        self.seed = options.seed
+        self.qos = options.qos
+        self.heartbeat = options.heartbeat
+        self.heartbeat_period = options.heartbeat or KEEPALIVE / 2
+        self.latency = LatencyModel(options.latency_ms, options.latency_sigma, options.loss)
+        self.stats = Stats()
+        self.running = True
+        self.sending = True             # 控制端是否继续发送命令
+        self.loop = None
+        self.connecting = None
+        self.next_connect = 0.0
+        width = max(5, len(str(options.devices)))
+        self.devices = [SimulatedDevice(self, f'{self.prefix}-{i:0{width}d}',
+                                        random.Random(self.seed * 1000003 + i))
+                        for i in range(1, options.devices + 1)]
+
+    async def pace_connect(self):
+        """按 CONNECT_RATE 匀速建立连接"""
+        now = self.loop.time()
+        slot = max(now, self.next_connect)
+        self.next_connect = slot + 1.0 / self.options.connect_rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def close(self):
+        """正常断开（发送 DISCONNECT，代理不发布遗嘱）"""
+        self.running = False
+        for device in self.devices:
+            if device.timer is not None:
+                device.timer.cancel()
+            if device.link is not None:
+                device.link.send(build_packet(DISCONNECT << 4))
+                device.link.close()
+                device.link = None
+
+
+def cpu_seconds():
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.1f}ms'
+
+
+def print_interval(fleet, elapsed, previous, interval):
+    """输出一个统计周期内的速率和延迟"""
+    stats = fleet.stats
+    current = stats.snapshot()
+
+    def rate(name):
+        return (current[name] - previous[name]) / interval
+
+    delivery = stats.interval_delivery
+    round_trip = stats.interval_round_trip
+    print(f"[{elapsed:>5.0f}s] 在线 {stats.online}/{len(fleet.devices)}  "
+          f"命令 发送 {rate('commands_sent'):.0f}/s 送达 {rate('commands_received'):.0f}/s "
+          f"回执 {rate('acks_received'):.0f}/s  "
+          f"状态 {rate('status_sent'):.0f}/s 心跳 {rate('heartbeats_sent'):.0f}/s  "
+          f"送达 p50 {format_ms(delivery.percentile(50))} p99 {format_ms(delivery.percentile(99))}  "
+          f"回执 p50 {format_ms(round_trip.percentile(50))} p99 {format_ms(round_trip.percentile(99))}"
+          + (f"  断线 {int(current['disconnects'] - previous['disconnects'])}"
+             if current['disconnects'] > previous['disconnects'] else ''))
+    stats.interval_delivery = LatencyHistogram()
+    stats.interval_round_trip = LatencyHistogram()
+    return current
+
+
+async def report_loop(fleet, started):
+    interval = fleet.options.report
+    previous = fleet.stats.snapshot()
+    while True:
+        await asyncio.sleep(interval)
+        previous = print_interval(fleet, fleet.loop.time() - started, previous, interval)
+
+
+async def wait_online(fleet, timeout):
+    """等待所有设备连上，返回用时（秒）"""
+    started = fleet.loop.time()
+    last_print = started
+    while fleet.stats.online < len(fleet.devices) and fleet.loop.time() - started < timeout:
+        await asyncio.sleep(0.1)
+        if fleet.loop.time() - last_print >= fleet.options.report:
+            last_print = fleet.loop.time()
+            print(f"   已连接 {fleet.stats.online}/{len(fleet.devices)}"
+                  + (f"（失败 {fleet.stats.connect_errors} 次，最近: {fleet.stats.last_error}）"
+                     if fleet.stats.connect_errors else ''))
+    return fleet.loop.time() - started
+
+
+async def simulate(options, stop):
+    fleet = Fleet(options)
+    fleet.loop = asyncio.get_running_loop()
+    fleet.connecting = asyncio.Semaphore(MAX_CONNECTING)
+    print(f"🚀 模拟 {len(fleet.devices)} 台设备 ({fleet.devices[0].device_id} … "
+          f"{fleet.devices[-1].device_id}) → {fleet.target.url}")
+    print(f"   处理延迟 中位数 {options.latency_ms:g}ms σ={options.latency_sigma:g}"
+          + (f" 丢失 {options.loss:.1%}" if options.loss else '')
+          + (f"，心跳 {options.heartbeat:g}s" if options.heartbeat else "，不发送心跳")
+          + f"，QoS {options.qos}" + (f"，uvloop" if uvloop is not None else ''))
+
+    tasks = [asyncio.ensure_future(device.run()) for device in fleet.devices]
+    controllers = []
+    try:
+        connect_time = await wait_online(
+            fleet, len(fleet.devices) / options.connect_rate + CONNECT_TIMEOUT * 3)
+        if fleet.stats.online < len(fleet.devices):
+            print(f"⚠️  {connect_time:.1f} 秒内只连上 {fleet.stats.online}/{len(fleet.devices)} 台设备"
+                  + (f"（最近的错误: {fleet.stats.last_error}）" if fleet.stats.last_error else ''))
+        else:
+            print(f"✅ {len(fleet.devices)} 台设备已在线，用时 {connect_time:.1f} 秒")
+
+        if options.rate > 0:
+            for i in range(options.controllers):
+                controllers.append(Controller(fleet, i, options.rate / options.controllers, i == 0))
+            print(f"📊 {options.controllers} 个控制端，目标 {options.rate:g} 条命令/秒"
+                  + (f"，运行 {options.duration:g} 秒" if options.duration else "，按 Ctrl+C 停止"))
+        else:
+            print("📊 只模拟设备" + (f"，运行 {options.duration:g} 秒" if options.duration else "，按 Ctrl+C 停止"))
+
+        fleet.stats.reset()
+        started = fleet.loop.time()
+        cpu_start = cpu_seconds()
+        deadline = started + options.duration if options.duration else None
+        reporter = asyncio.ensure_future(report_loop(fleet, started))
+        workers = [asyncio.ensure_future(controller.send_commands(deadline))
+                   for controller in controllers]
+        waiters = [asyncio.ensure_future(stop.wait())]
+        if deadline is not None:
+            waiters.append(asyncio.ensure_future(asyncio.sleep(options.duration)))
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        fleet.sending = False
+        elapsed = fleet.loop.time() - started
+        cpu = cpu_seconds() - cpu_start
+        for task in waiters + [reporter]:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # 等待最后一批命令送达和回执（不计入时长）
+        await asyncio.sleep(min(1.0, options.latency_ms / 1000 * 10))
+        return build_report(options, fleet, connect_time, elapsed, cpu)
+    finally:
+        fleet.running = False
+        for controller in controllers:
+            controller.close()
+        fleet.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def build_report(options, fleet, connect_time, elapsed, cpu):
+    stats = fleet.stats
+    counters = stats.snapshot()
+    rates = {name: round(counters[name] / elapsed, 2) for name in
+             ('commands_sent', 'commands_received', 'acks_received', 'status_sent', 'heartbeats_sent')}
+    return {
+        'timestamp': datetime.datetime.now().astimezone().isoformat(timespec='seconds'),
+        'config': {
+            'broker': options.broker,
+            'devices': options.devices,
+            'rate': options.rate,
+            'controllers': options.controllers,
+            'duration': round(elapsed, 3),
+            'qos': options.qos,
+            'heartbeat': options.heartbeat,
+            'latency_ms': options.latency_ms,
+            'latency_sigma': options.latency_sigma,
+            'loss': options.loss,
+            'uvloop': uvloop is not None,
+        },
+        'results': {
+            'online': stats.online,
+            'connect_seconds': round(connect_time, 3),
+            'connect_errors': stats.connect_errors,
+            'disconnects': stats.disconnects,
+            'counters': counters,
+            'rates': rates,
+            'delivered_ratio': round(counters['commands_received'] / counters['commands_sent'], 4)
+            if counters['commands_sent'] else None,
+            'delivery_latency': stats.delivery.summary(),
+            'round_trip_latency': stats.round_trip.summary(),
+            'simulator_cpu_percent': round(cpu / elapsed * 100, 1) if elapsed else None,
+        },
+    }
+
+
+def print_summary(report):
+    results = report['results']
+    rates = results['rates']
+    counters = results['counters']
+    print()
+    print(f"📈 结果（{report['config']['duration']:.1f} 秒，{results['online']}/{report['config']['devices']} 台设备在线）")
+    print(f"   命令: 发送 {counters['commands_sent']} 条 ({rates['commands_sent']:.0f}/s), "
+          f"送达 {counters['commands_received']} 条 ({rates['commands_received']:.0f}/s), "
+          f"回执 {counters['acks_received']} 条 ({rates['acks_received']:.0f}/s)"
+          + (f", 设备端丢失 {counters['commands_lost']} 条" if counters['commands_lost'] else ''))
+    if results['delivered_ratio'] is not None and results['delivered_ratio'] < 1:
+        print(f"   送达率 {results['delivered_ratio']:.2%}（未送达: 被代理合并为同类型的新值，"
+              f"或目标设备不在线；测量原始吞吐时服务器加 --mqtt-coalesce 0）")
+    print(f"   上报: 状态 {rates['status_sent']:.0f}/s, 心跳 {rates['heartbeats_sent']:.0f}/s")
+    for name, key in (('送达延迟', 'delivery_latency'), ('回执延迟', 'round_trip_latency')):
+        latency = results[key]
+        if latency['count']:
+            print(f"   {name}: " + '  '.join(f"p{pct} {format_ms(latency[f'p{pct}_ms'])}" for pct in PERCENTILES)
+                  + f"  最大 {format_ms(latency['max_ms'])}")
+    print(f"   连接: 建立用时 {results['connect_seconds']:.1f} 秒, 失败 {results['connect_errors']} 次, "
+          f"断线 {results['disconnects']} 次")
+    print(f"🖥️  模拟器 CPU {results['simulator_cpu_percent']}% 单核"
+          + ("（接近100%时瓶颈在模拟器，结果低估了服务器的能力）"
+             if (results['simulator_cpu_percent'] or 0) > 90 else ''))
+
+
+def print_comparison(report, baseline_path):
+    """与之前保存的结果比较速率和延迟"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n📈 与 {baseline_path} 比较 ({baseline.get('timestamp')}):")
+    old, new = baseline['results'], report['results']
+    for key in ('commands_sent', 'commands_received', 'acks_received'):
+        before, after = old['rates'][key], new['rates'][key]
+        change = f" ({(after - before) / before * 100:+.1f}%)" if before else ''
+        print(f"   {key:<20} {before:.0f}/s → {after:.0f}/s{change}")
+    for name in ('delivery_latency', 'round_trip_latency'):
+        for pct in ('p50_ms', 'p99_ms'):
+            before, after = old[name].get(pct), new[name].get(pct)
+            if before and after is not None:
+                print(f"   {name + ' ' + pct:<20} {before}ms → {after}ms "
+                      f"({(after - before) / before * 100:+.1f}%)")
+
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description='模拟大量设备，压测 MQTT 控制链路')
+    parser.add_argument('--broker', default=BROKER_URL,
+                        help=f'代理地址 ws://、wss://、mqtt:// 或 mqtts:// (默认: {BROKER_URL})')
+    parser.add_argument('--insecure', action='store_true',
+                        help='wss/mqtts 不校验证书（server.py 的自签名证书）')
+    parser.add_argument('--devices', type=int, default=DEVICES,
+                        help=f'模拟的设备数 (默认: {DEVICES})')
+    parser.add_argument('--prefix', default=DEVICE_PREFIX,
+                        help=f'设备ID前缀，同时运行多个模拟器时需各不相同 (默认: {DEVICE_PREFIX})')
+    parser.add_argument('--rate', type=float, default=COMMAND_RATE,
+                        help=f'控制端每秒发送的命令总数，0表示只模拟设备 (默认: {COMMAND_RATE})')
+    parser.add_argument('--controllers', type=int, default=1,
+                        help='控制端连接数，命令速率平均分配 (默认: 1)')
+    parser.add_argument('--duration', type=float, default=DURATION,
+                        help=f'压测时长（秒），0表示一直运行到 Ctrl+C (默认: {DURATION})')
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0,
+                        help='控制命令的 QoS (默认: 0)')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL,
+                        help=f'设备心跳间隔（秒），0表示不发送心跳 (默认: {HEARTBEAT_INTERVAL})')
+    parser.add_argument('--latency-ms', type=float, default=LATENCY_MEDIAN_MS,
+                        help=f'设备处理命令的延迟中位数 (默认: {LATENCY_MEDIAN_MS:g})')
+    parser.add_argument('--latency-sigma', type=float, default=LATENCY_SIGMA,
+                        help=f'处理延迟的对数标准差，越大长尾越明显 (默认: {LATENCY_SIGMA:g})')
+    parser.add_argument('--loss', type=float, default=COMMAND_LOSS,
+                        help='设备端丢失命令的比例 0-1（不回执）(默认: 0)')
+    parser.add_argument('--connect-rate', type=float, default=CONNECT_RATE,
+                        help=f'每秒最多建立的连接数 (默认: {CONNECT_RATE})')
+    parser.add_argument('--report', type=float, default=REPORT_INTERVAL,
+                        help=f'输出统计的间隔（秒）(默认: {REPORT_INTERVAL})')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子 (默认: 1)')
+    parser.add_argument('--output', default=None, metavar='FILE',
+                        help='把结果保存为JSON')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='与之前保存的结果比较')
+    options = parser.parse_args(args)
+    if options.devices < 1:
+        parser.error('--devices 必须大于0')
+    if options.rate < 0 or options.duration < 0 or options.heartbeat < 0:
+        parser.error('--rate/--duration/--heartbeat 不能为负数')
+    if options.heartbeat > KEEPALIVE:
+        parser.error(f'--heartbeat 不能超过 keepalive ({KEEPALIVE} 秒)')
+    if options.controllers < 1 or options.connect_rate <= 0 or options.report <= 0:
+        parser.error('--controllers/--connect-rate/--report 必须大于0')
+    if not 0 <= options.loss < 1:
+        parser.error('--loss 必须在 0-1 之间')
+    try:
+        Target(options.broker)
+    except ValueError as e:
+        parser.error(str(e))
+    return options
+
+
+def main():
+    options = parse_options()
+    raise_nofile_limit()
+    if resource is not None:
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft != resource.RLIM_INFINITY and soft < options.devices + 100:
+            print(f"⚠️  文件描述符上限 {soft} 不足以建立 {options.devices} 个连接，"
+                  f"请先执行 ulimit -n {options.devices + 1024}")
+
+    async def run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+        return await simulate(options, stop)
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        report = asyncio.run(run())
+    except KeyboardInterrupt:
+        return
+    print_summary(report)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存: {options.output}")
+    if options.compare:
+        print_comparison(report, options.compare)
+    if report['results']['online'] == 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
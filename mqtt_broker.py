@@ -0,0 +1,912 @@
+#!/usr/bin/env python3
+"""
+内置 MQTT over WebSocket 代理（broker）
+
+server.py 启动时加上 --mqtt 后，浏览器端 mqtt.js 可以直接连接
+ws://<服务器地址>:8080/mqtt，不再依赖外部 broker：
+
+    python3 server.py start --mqtt
+
+HTTP 请求处理线程完成 WebSocket 握手后，把连接的文件描述符交给本模块，
+由一个独立线程中的 asyncio 事件循环处理所有 MQTT 连接，因此上千个长连接
+不会占用 HTTP 线程池。
+
+支持范围:
+    - MQTT 3.1.1 和 MQTT 5（协议级别 4/5）
+    - 只允许 device/control、device/status、device/heartbeat 三类主题
+      （订阅时可以使用 + 和 # 通配符）
+    - QoS 0/1/2 发布（向订阅者最多以 QoS 1 转发）、保留消息、遗嘱消息、心跳
+    - 不保存离线会话：所有连接都按 clean session 处理
+    - device/control 消息按设备和命令类型合并（拖动滑块时只转发最新值）
+    - 可选：转发给设备的 device/control 消息记录到命令日志，并可按原速/加速回放
+      （command_journal.py，python3 server.py start --mqtt --journal DIR）
+    - 根据 device/heartbeat 跟踪设备在线状态，上线/离线时发布 device/status
+      （presence.py）
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import socket
+import struct
+import threading
+
+from command_journal import FLAG_REPLAY, FLAG_TRUNCATED, REPLAY_MAX_GAP
+from presence import HEARTBEAT_TOPIC_PREFIX, PRESENCE_TIMEOUT, TICK, PresenceTracker
+
+try:
+    import resource     # Windows 上没有，无法调整文件描述符上限
+except ImportError:
+    resource = None
+
+# WebSocket 配置
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_SUBPROTOCOLS = ('mqtt', 'mqttv3.1')   # 按优先顺序选择客户端提供的子协议
+
+# MQTT 配置
+TOPIC_FAMILIES = ('device/control', 'device/status', 'device/heartbeat')
+MAX_PACKET_SIZE = 256 * 1024        # 单个 MQTT 报文的最大字节数，超过时断开连接
+CONNECT_TIMEOUT = 10                # 建立连接后等待 CONNECT 报文的秒数
+KEEPALIVE_GRACE = 1.5               # 超过 keepalive 的多少倍没有收到报文时断开
+MAX_PENDING_BYTES = 1024 * 1024     # 客户端接收太慢、待发送数据超过此值时丢弃 QoS 0 消息
+SNAPSHOT_TIMEOUT = 5                # HTTP线程等待事件循环生成在线状态快照的秒数
+
+# 控制消息合并配置
+# 拖动速度/强度滑块时每个 input 事件都会发送一条命令，代理按 (设备ID, 命令类型)
+# 合并：一个周期内第一条立即转发，其余只保留最新值，在周期结束时转发。
+COALESCE_RATE = 20                              # 每秒最多转发的次数（每个设备、每种命令），0表示不合并
+COALESCE_PASSTHROUGH = frozenset({'stop', 'preset'})   # 立即转发的命令类型
+CONTROL_TOPIC_PREFIX = 'device/control/'
+
+# 报文类型
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+# MQTT 5 原因码
+REASON_NOT_AUTHORIZED = 0x87
+REASON_TOPIC_FILTER_INVALID = 0x8F
+REASON_UNSUPPORTED_VERSION = 0x84
+REASON_DISCONNECT_WITH_WILL = 0x04
+REASON_SESSION_TAKEN_OVER = 0x8E
+REASON_SERVER_SHUTTING_DOWN = 0x8B
+SUBACK_FAILURE = 0x80
+
+
+class MQTTError(Exception):
+    """协议错误，连接会被关闭"""
+
+
+def websocket_accept_key(key):
+    """根据 Sec-WebSocket-Key 计算 Sec-WebSocket-Accept"""
+    digest = hashlib.sha1((key.strip() + WEBSOCKET_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def choose_subprotocol(header_value):
+    """从 Sec-WebSocket-Protocol 中选择一个支持的子协议，没有时返回 None"""
+    offered = [item.strip().lower() for item in (header_value or '').split(',')]
+    for protocol in WEBSOCKET_SUBPROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return None
+
+
+def websocket_frame(payload, opcode=0x2, mask=None):
+    """WebSocket 帧（默认二进制帧）
+
+    服务器发出的帧不加掩码；客户端（device_simulator.py）发出的帧必须带4字节掩码。
+    """
+    n = len(payload)
+    masked = 0x80 if mask else 0
+    if n < 126:
+        header = bytes((0x80 | opcode, masked | n))
+    elif n < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, masked | 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, masked | 127, n)
+    if mask:
+        return header + mask + unmask(payload, mask)
+    return header + payload
+
+
+def unmask(data, mask):
+    """加上或去掉帧的掩码（异或运算两个方向相同；按整数一次异或，比逐字节快得多）"""
+    n = len(data)
+    if n == 0:
+        return data
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+
+def encode_length(n):
+    """MQTT 剩余长度（变长整数）"""
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def encode_string(value):
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def build_packet(first_byte, body=b''):
+    return bytes((first_byte,)) + encode_length(len(body)) + body
+
+
+def build_publish(topic, payload, qos, retain, version, packet_id=None):
+    """PUBLISH 报文，MQTT 5 需要在可变报头中加入（空的）属性"""
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    if version == 5:
+        body += b'\x00'
+    return build_packet((PUBLISH << 4) | (qos << 1) | (1 if retain else 0), body + payload)
+
+
+def is_valid_topic(topic):
+    """发布主题：不能含通配符，且必须属于允许的主题族"""
+    if not topic or '+' in topic or '#' in topic or '\x00' in topic:
+        return False
+    return any(topic == family or topic.startswith(family + '/') for family in TOPIC_FAMILIES)
+
+
+def is_valid_filter(topic_filter):
+    """订阅过滤器：通配符位置合法，且只能匹配 device/ 下的主题"""
+    if not topic_filter.startswith('device/') or '\x00' in topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if '#' in level and (level != '#' or i != len(levels) - 1):
+            return False
+        if '+' in level and level != '+':
+            return False
+    return True
+
+
+def topic_matches(topic_filter, topic):
+    """判断主题是否匹配订阅过滤器（支持 + 和 #）"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def split_packet(buf):
+    """从缓冲区（bytearray）头部切出一个完整报文 (首字节, 内容)，数据不足时返回 None"""
+    if len(buf) < 2:
+        return None
+    length, multiplier, pos = 0, 1, 1
+    while True:
+        if pos >= len(buf):
+            return None
+        byte = buf[pos]
+        length += (byte & 0x7F) * multiplier
+        pos += 1
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if pos > 4:
+            raise MQTTError('非法的剩余长度')
+    if length > MAX_PACKET_SIZE:
+        raise MQTTError('报文过大')
+    if len(buf) < pos + length:
+        return None
+    first, body = buf[0], bytes(buf[pos:pos + length])
+    del buf[:pos + length]
+    return first, body
+
+
+class PacketReader:
+    """从字节串中按顺序读取 MQTT 字段"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def byte(self):
+        if self.pos >= len(self.data):
+            raise MQTTError('报文过短')
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def uint16(self):
+        if self.pos + 2 > len(self.data):
+            raise MQTTError('报文过短')
+        value = struct.unpack_from('!H', self.data, self.pos)[0]
+        self.pos += 2
+        return value
+
+    def binary(self):
+        n = self.uint16()
+        if self.pos + n > len(self.data):
+            raise MQTTError('报文过短')
+        value = bytes(self.data[self.pos:self.pos + n])
+        self.pos += n
+        return value
+
+    def string(self):
+        try:
+            return self.binary().decode('utf-8')
+        except UnicodeDecodeError:
+            raise MQTTError('非法的UTF-8字符串')
+
+    def varint(self):
+        value, shift = 0, 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+            if shift > 21:
+                raise MQTTError('非法的变长整数')
+
+    def skip_properties(self):
+        """跳过 MQTT 5 属性（本代理不使用客户端发送的属性）"""
+        n = self.varint()
+        if self.pos + n > len(self.data):
+            raise MQTTError('报文过短')
+        self.pos += n
+
+    def rest(self):
+        value = bytes(self.data[self.pos:])
+        self.pos = len(self.data)
+        return value
+
+
+class MQTTConnection:
+    """一个 WebSocket 上的 MQTT 客户端连接"""
+
+    def __init__(self, broker, reader, writer, address):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.client_id = None
+        self.version = 4
+        self.keepalive = 0
+        self.will = None                # (topic, payload, qos, retain)
+        self.subscriptions = {}         # 过滤器 -> QoS
+        self.pending_qos2 = set()       # 已收到、尚未 PUBREL 的 QoS 2 报文ID
+        self.packet_ids = itertools.cycle(range(1, 65536))
+        self.buffer = bytearray()
+        self.closing = False
+
+    # ---- WebSocket 层 ----
+
+    async def read_frame(self):
+        """读取一个数据帧的内容，处理 ping/close 控制帧"""
+        while True:
+            head = await self.reader.readexactly(2)
+            opcode = head[0] & 0x0F
+            length = head[1] & 0x7F
+            if not head[1] & 0x80:
+                raise MQTTError('客户端帧没有掩码')
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            if length > MAX_PACKET_SIZE:
+                raise MQTTError('WebSocket帧过大')
+            mask = await self.reader.readexactly(4)
+            payload = unmask(await self.reader.readexactly(length), mask)
+            if opcode in (0x0, 0x2):
+                return payload
+            if opcode == 0x8:
+                self.send_raw(websocket_frame(payload[:2], opcode=0x8))
+                raise ConnectionResetError('WebSocket closed')
+            if opcode == 0x9:
+                self.send_raw(websocket_frame(payload, opcode=0xA))
+            elif opcode != 0xA:
+                # MQTT over WebSocket 只允许二进制帧
+                raise MQTTError(f'不支持的WebSocket帧类型 {opcode}')
+
+    async def read_packet(self):
+        """读取一个完整的 MQTT 报文，返回 (首字节, 内容)
+
+        MQTT 报文和 WebSocket 帧的边界没有对应关系，帧内容先放入缓冲区再切分。
+        """
+        while True:
+            packet = split_packet(self.buffer)
+            if packet is not None:
+                return packet
+            self.buffer += await self.read_frame()
+
+    def send_raw(self, frame):
+        if not self.writer.is_closing():
+            self.writer.write(frame)
+
+    def send(self, packet):
+        self.send_raw(websocket_frame(packet))
+
+    def is_congested(self):
+        return self.writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES
+
+    # ---- MQTT 层 ----
+
+    async def run(self):
+        first, body = await asyncio.wait_for(self.read_packet(), CONNECT_TIMEOUT)
+        if first >> 4 != CONNECT:
+            raise MQTTError('第一个报文不是CONNECT')
+        if not self.handle_connect(body):
+            return
+        timeout = self.keepalive * KEEPALIVE_GRACE if self.keepalive else None
+        while not self.closing:
+            first, body = await asyncio.wait_for(self.read_packet(), timeout)
+            self.dispatch(first, body)
+
+    def handle_connect(self, body):
+        packet = PacketReader(body)
+        protocol = packet.string()
+        self.version = packet.byte()
+        if protocol != 'MQTT' or self.version not in (4, 5):
+            # 按客户端可能理解的格式回复后关闭
+            if self.version == 5:
+                self.send(build_packet(CONNACK << 4, bytes((0, REASON_UNSUPPORTED_VERSION, 0))))
+            else:
+                self.version = 4
+                self.send(build_packet(CONNACK << 4, b'\x00\x01'))
+            return False
+        flags = packet.byte()
+        self.keepalive = packet.uint16()
+        if self.version == 5:
+            packet.skip_properties()
+        client_id = packet.string()
+        if flags & 0x04:
+            if self.version == 5:
+                packet.skip_properties()
+            will_topic = packet.string()
+            will_payload = packet.binary()
+            if not is_valid_topic(will_topic):
+                raise MQTTError(f'遗嘱主题不允许: {will_topic}')
+            self.will = (will_topic, will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+        # 用户名/密码：局域网开发用途，不做认证
+
+        properties = b''
+        if not client_id:
+            if self.version == 4 and not flags & 0x02:
+                # 3.1.1：空客户端ID必须使用 clean session
+                self.send(build_packet(CONNACK << 4, b'\x00\x02'))
+                return False
+            client_id = f'auto-{next(self.broker.client_counter)}'
+            # MQTT 5：通过 Assigned Client Identifier 属性告知客户端
+            properties = b'\x12' + encode_string(client_id)
+        self.client_id = client_id
+        self.broker.register(self)
+        if self.version == 5:
+            self.send(build_packet(CONNACK << 4,
+                                   b'\x00\x00' + encode_length(len(properties)) + properties))
+        else:
+            self.send(build_packet(CONNACK << 4, b'\x00\x00'))
+        return True
+
+    def dispatch(self, first, body):
+        ptype = first >> 4
+        if ptype == PUBLISH:
+            self.handle_publish(first, body)
+        elif ptype in (PUBACK, PUBREC, PUBCOMP):
+            # 向订阅者最多以 QoS 1 发送且不重传，确认报文无需处理
+            pass
+        elif ptype == PUBREL:
+            packet_id = PacketReader(body).uint16()
+            self.pending_qos2.discard(packet_id)
+            self.send(build_packet(PUBCOMP << 4, struct.pack('!H', packet_id)))
+        elif ptype == SUBSCRIBE:
+            self.handle_subscribe(body)
+        elif ptype == UNSUBSCRIBE:
+            self.handle_unsubscribe(body)
+        elif ptype == PINGREQ:
+            self.send(build_packet(PINGRESP << 4))
+        elif ptype == DISCONNECT:
+            reason = body[0] if self.version == 5 and body else 0
+            if reason != REASON_DISCONNECT_WITH_WILL:
+                # 正常断开，不发送遗嘱
+                self.will = None
+            self.closing = True
+        else:
+            raise MQTTError(f'不支持的报文类型 {ptype}')
+
+    def handle_publish(self, first, body):
+        qos = (first >> 1) & 0x03
+        retain = bool(first & 0x01)
+        if qos == 3:
+            raise MQTTError('非法的QoS')
+        packet = PacketReader(body)
+        topic = packet.string()
+        packet_id = packet.uint16() if qos else None
+        if self.version == 5:
+            packet.skip_properties()
+        payload = packet.rest()
+
+        allowed = is_valid_topic(topic)
+        if allowed and not (qos == 2 and packet_id in self.pending_qos2):
+            self.broker.publish(topic, payload, qos, retain, sender=self)
+        elif not allowed:
+            self.broker.publishes_rejected += 1
+
+        reason = b''
+        if self.version == 5 and not allowed:
+            reason = bytes((REASON_NOT_AUTHORIZED,))
+        if qos == 1:
+            self.send(build_packet(PUBACK << 4, struct.pack('!H', packet_id) + reason))
+        elif qos == 2:
+            if allowed:
+                self.pending_qos2.add(packet_id)
+            self.send(build_packet(PUBREC << 4, struct.pack('!H', packet_id) + reason))
+
+    def handle_subscribe(self, body):
+        packet = PacketReader(body)
+        packet_id = packet.uint16()
+        if self.version == 5:
+            packet.skip_properties()
+        codes = bytearray()
+        new_filters = []
+        while packet.remaining():
+            topic_filter = packet.string()
+            options = packet.byte()
+            qos = min(options & 0x03, 1)
+            if is_valid_filter(topic_filter):
+                self.broker.subscribe(self, topic_filter, qos)
+                new_filters.append(topic_filter)
+                codes.append(qos)
+            elif self.version == 5:
+                codes.append(REASON_TOPIC_FILTER_INVALID)
+            else:
+                codes.append(SUBACK_FAILURE)
+        if not codes:
+            raise MQTTError('SUBSCRIBE没有主题')
+        props = b'\x00' if self.version == 5 else b''
+        self.send(build_packet(SUBACK << 4, struct.pack('!H', packet_id) + props + bytes(codes)))
+        for topic_filter in new_filters:
+            self.broker.send_retained(self, topic_filter)
+
+    def handle_unsubscribe(self, body):
+        packet = PacketReader(body)
+        packet_id = packet.uint16()
+        if self.version == 5:
+            packet.skip_properties()
+        codes = bytearray()
+        while packet.remaining():
+            found = self.broker.unsubscribe(self, packet.string())
+            codes.append(0x00 if found else 0x11)   # 0x11: 没有该订阅（仅MQTT 5）
+        body = struct.pack('!H', packet_id)
+        if self.version == 5:
+            body += b'\x00' + bytes(codes)
+        self.send(build_packet(UNSUBACK << 4, body))
+
+    def deliver(self, topic, payload, qos, retain, encoded):
+        """向本连接发送一条消息，encoded 缓存按协议版本编码好的 QoS 0 帧"""
+        if qos == 0:
+            if self.is_congested():
+                self.broker.messages_dropped += 1
+                return
+            frame = encoded.get(self.version)
+            if frame is None:
+                frame = encoded[self.version] = websocket_frame(
+                    build_publish(topic, payload, 0, retain, self.version))
+            self.send_raw(frame)
+        else:
+            self.send(build_publish(topic, payload, qos, retain, self.version,
+                                    packet_id=next(self.packet_ids)))
+        self.broker.messages_sent += 1
+
+    def kick(self, reason):
+        """服务端主动断开（MQTT 5 发送带原因码的 DISCONNECT）"""
+        if self.version == 5:
+            self.send(build_packet(DISCONNECT << 4, bytes((reason, 0))))
+        self.will = None
+        self.closing = True
+        self.writer.close()
+
+
+class ControlCoalescer:
+    """按 (设备ID, 命令类型) 合并 device/control 消息
+
+    每个键在一个周期（1/rate 秒）内的第一条消息立即转发，之后的消息只保留最新
+    一条，在距该键上次转发满一个周期时转发，被覆盖的消息计入 collapsed，
+    每个键的转发速率不超过 rate。stop/preset 等命令立即转发，并丢弃该设备
+    尚未转发的命令，避免停止后又收到旧的速度值。
+    """
+
+    def __init__(self, broker, rate=COALESCE_RATE, passthrough=COALESCE_PASSTHROUGH):
+        self.broker = broker
+        self.interval = 1.0 / rate
+        self.passthrough = passthrough
+        self.pending = {}       # (设备ID, 命令类型) -> (topic, payload, qos, retain)
+        self.last_sent = {}     # (设备ID, 命令类型) -> 上次转发时间
+        self.timers = {}        # (设备ID, 命令类型) -> 转发暂存消息的 TimerHandle
+        self.collapsed = {}     # 命令类型 -> 被合并掉的消息数
+
+    def submit(self, topic, payload, qos, retain):
+        """返回 True 表示消息已暂存，由周期任务转发；False 表示应立即转发"""
+        command_type = parse_command_type(payload)
+        if command_type is None:
+            return False
+        device_id = topic[len(CONTROL_TOPIC_PREFIX):]
+        if command_type in self.passthrough:
+            for key in [key for key in self.pending if key[0] == device_id]:
+                del self.pending[key]
+                self.timers.pop(key).cancel()
+                self.count_collapsed(key[1])
+            return False
+        key = (device_id, command_type)
+        if key in self.pending:
+            self.count_collapsed(command_type)
+            self.pending[key] = (topic, payload, qos, retain)
+            return True
+        now = self.broker.loop.time()
+        last_sent = self.last_sent.get(key, float('-inf'))
+        if now - last_sent >= self.interval:
+            self.last_sent[key] = now
+            return False
+        self.pending[key] = (topic, payload, qos, retain)
+        self.timers[key] = self.broker.loop.call_at(last_sent + self.interval, self.flush, key)
+        return True
+
+    def count_collapsed(self, command_type):
+        self.collapsed[command_type] = self.collapsed.get(command_type, 0) + 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = self.broker.loop.time()
+            # 只保留最近一个周期内转发过的键，空闲设备不占用内存
+            self.last_sent = {key: sent for key, sent in self.last_sent.items()
+                              if now - sent < self.interval or key in self.pending}
+
+    def flush(self, key):
+        """转发一个键暂存的消息（该键上次转发满一个周期时由定时器调用）"""
+        del self.timers[key]
+        self.last_sent[key] = self.broker.loop.time()
+        self.broker.route(*self.pending.pop(key))
+
+
+class MQTTBroker:
+    """在独立线程中运行 asyncio 事件循环的 MQTT 代理"""
+
+    def __init__(self, coalesce_rate=COALESCE_RATE, journal=None, presence_timeout=PRESENCE_TIMEOUT):
+        self.loop = None
+        self.coalescer = ControlCoalescer(self, coalesce_rate) if coalesce_rate > 0 else None
+        self.journal = journal          # command_journal.CommandJournal，None 表示不记录
+        self.presence = (PresenceTracker(self.announce_presence, presence_timeout)
+                         if presence_timeout > 0 else None)
+        self.replays = {}               # 目标设备ID -> 正在进行的回放任务
+        self.thread = None
+        self.clients = {}               # 客户端ID -> MQTTConnection
+        self.exact = {}                 # 不含通配符的过滤器 -> {连接: QoS}
+        self.wildcard = {}              # 含通配符的过滤器 -> {连接: QoS}
+        self.retained = {}              # 主题 -> (payload, qos)
+        self.client_counter = itertools.count(1)
+        self.connections_total = 0
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.publishes_rejected = 0
+        self.replay_counter = itertools.count(1)
+        self.replays_total = 0
+        self.replays_cancelled = 0
+        self.replayed_messages = 0
+
+    # ---- 线程接口（在HTTP处理线程中调用） ----
+
+    def start(self):
+        raise_nofile_limit()
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            if self.coalescer is not None:
+                self.loop.create_task(self.coalescer.run())
+            if self.presence is not None:
+                self.loop.create_task(self.track_presence())
+            ready.set()
+            self.loop.run_forever()
+            # 停止后取消剩余任务（合并器定时任务、尚未结束的连接）
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name='mqtt-broker', daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        """断开所有客户端并停止事件循环
+
+        连接和会话不转移到平滑重启的新进程：客户端（MQTT 5 收到原因码 0x8B 的
+        DISCONNECT）需要重新连接。不发送遗嘱，设备不会被误报离线。
+        """
+        if self.loop is None:
+            return
+
+        def close_all():
+            for conn in list(self.clients.values()):
+                conn.kick(REASON_SERVER_SHUTTING_DOWN)
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(close_all)
+        self.thread.join(timeout=5)
+
+    def start_replay(self, journal, lo, hi, speed, target_id):
+        """把设备日志中序号 [lo, hi) 的命令按 speed 倍速发给 target_id，返回回放编号
+
+        同一目标设备上正在进行的回放会被取代；目标设备收到实时控制命令时回放停止。
+        """
+        replay_id = next(self.replay_counter)
+
+        def begin():
+            previous = self.replays.pop(target_id, None)
+            if previous is not None:
+                previous.cancel()
+            self.replays_total += 1
+            self.replays[target_id] = self.loop.create_task(
+                self.replay(journal, lo, hi, speed, target_id))
+
+        self.loop.call_soon_threadsafe(begin)
+        return replay_id
+
+    def presence_snapshot(self, device_id=None, include_offline=False, limit=None):
+        """设备在线状态快照（在HTTP处理线程中调用，由事件循环线程生成）
+
+        事件循环繁忙或已停止时抛出 concurrent.futures.TimeoutError，
+        事件循环已关闭时抛出 RuntimeError。
+        """
+        async def take():
+            return self.presence.snapshot(device_id, include_offline, limit)
+
+        future = asyncio.run_coroutine_threadsafe(take(), self.loop)
+        try:
+            return future.result(SNAPSHOT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def cancel_replay(self, target_id):
+        """停止发往 target_id 的回放（在HTTP处理线程中调用）"""
+        self.loop.call_soon_threadsafe(self.stop_replay, target_id)
+
+    def adopt(self, fd, address):
+        """接管一个已完成 WebSocket 握手的连接（文件描述符）"""
+        self.loop.call_soon_threadsafe(
+            lambda: self.loop.create_task(self.serve(fd, address)))
+
+    # ---- 事件循环内部 ----
+
+    async def serve(self, fd, address):
+        sock = socket.socket(fileno=fd)
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_PACKET_SIZE)
+        except OSError:
+            sock.close()
+            return
+        self.connections_total += 1
+        conn = MQTTConnection(self, reader, writer, address)
+        try:
+            await conn.run()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError, OSError, MQTTError):
+            pass
+        finally:
+            self.unregister(conn)
+            writer.close()
+
+    def register(self, conn):
+        old = self.clients.get(conn.client_id)
+        if old is not None:
+            # 同一客户端ID重新连接，断开旧连接
+            old.kick(REASON_SESSION_TAKEN_OVER)
+            self.unregister(old)
+        self.clients[conn.client_id] = conn
+
+    def unregister(self, conn):
+        if conn.client_id is None:
+            return
+        if self.clients.get(conn.client_id) is conn:
+            del self.clients[conn.client_id]
+        for topic_filter in list(conn.subscriptions):
+            self.unsubscribe(conn, topic_filter)
+        will, conn.will = conn.will, None
+        if will is not None:
+            self.publish(*will, sender=None)
+
+    def subscribe(self, conn, topic_filter, qos):
+        index = self.wildcard if ('+' in topic_filter or '#' in topic_filter) else self.exact
+        index.setdefault(topic_filter, {})[conn] = qos
+        conn.subscriptions[topic_filter] = qos
+
+    def unsubscribe(self, conn, topic_filter):
+        if conn.subscriptions.pop(topic_filter, None) is None:
+            return False
+        for index in (self.exact, self.wildcard):
+            subscribers = index.get(topic_filter)
+            if subscribers is not None:
+                subscribers.pop(conn, None)
+                if not subscribers:
+                    del index[topic_filter]
+        return True
+
+    def publish(self, topic, payload, qos, retain, sender=None):
+        """处理客户端发布的消息（控制消息先经过合并）"""
+        self.messages_received += 1
+        if (self.presence is not None and sender is not None
+                and topic.startswith(HEARTBEAT_TOPIC_PREFIX) and len(topic) > len(HEARTBEAT_TOPIC_PREFIX)):
+            self.presence.heartbeat(topic[len(HEARTBEAT_TOPIC_PREFIX):])
+        if self.replays and sender is not None and topic.startswith(CONTROL_TOPIC_PREFIX):
+            # 用户重新控制设备时停止回放
+            self.stop_replay(topic[len(CONTROL_TOPIC_PREFIX):])
+        if (self.coalescer is not None and sender is not None
+                and topic.startswith(CONTROL_TOPIC_PREFIX)
+                and self.coalescer.submit(topic, payload, qos, retain)):
+            return
+        self.route(topic, payload, qos, retain)
+
+    def route(self, topic, payload, qos, retain, journal_flags=0, record=True):
+        """把消息转发给所有匹配的订阅者，record=False 时不写入命令日志"""
+        if record and self.journal is not None and topic.startswith(CONTROL_TOPIC_PREFIX):
+            self.journal.append(topic[len(CONTROL_TOPIC_PREFIX):], payload, qos, journal_flags)
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        # 同一连接通过多个过滤器匹配时只发送一次，取最高 QoS
+        targets = dict(self.exact.get(topic, ()))
+        for topic_filter, subscribers in self.wildcard.items():
+            if topic_matches(topic_filter, topic):
+                for conn, sub_qos in subscribers.items():
+                    if sub_qos > targets.get(conn, -1):
+                        targets[conn] = sub_qos
+        encoded = {}
+        for conn, sub_qos in targets.items():
+            # 转发时保留标志清零（只有因订阅而补发的保留消息才带该标志）
+            conn.deliver(topic, payload, min(qos, sub_qos), False, encoded)
+
+    async def replay(self, journal, lo, hi, speed, target_id):
+        """按记录的时间间隔（除以 speed）重新发送命令
+
+        被截断的记录和之前回放发出的记录（FLAG_REPLAY）不发送。回放到同一设备时
+        不写入日志，不覆盖正在回放的范围。
+        """
+        topic = CONTROL_TOPIC_PREFIX + target_id
+        previous = None
+        try:
+            # 开始时一次复制整个范围：等待期间新的命令可能环绕覆盖这些槽位，
+            # 映射内存的切片到发送时已是别的记录
+            records = journal.copy(lo, hi, max(hi - lo, 1))
+            record = self.journal is None or self.journal.get(target_id) is not journal
+            for _, timestamp, qos, flags, payload in records:
+                if flags & (FLAG_TRUNCATED | FLAG_REPLAY):
+                    continue
+                if previous is not None:
+                    await asyncio.sleep(min((timestamp - previous) / speed, REPLAY_MAX_GAP))
+                previous = timestamp
+                self.route(topic, payload, min(qos, 1), False,
+                           journal_flags=FLAG_REPLAY, record=record)
+                self.replayed_messages += 1
+        finally:
+            if self.replays.get(target_id) is asyncio.current_task():
+                del self.replays[target_id]
+
+    async def track_presence(self):
+        while True:
+            await asyncio.sleep(TICK)
+            self.presence.expire()
+
+    def announce_presence(self, topic, payload):
+        """发布设备上线/离线（由 PresenceTracker 调用）
+
+        离线消息总是保留，替换设备之前的在线状态；上线消息只在没有保留状态或保留的
+        是 presence 消息时保留，不覆盖设备自己发布的（带速度/强度等的）保留状态。
+        """
+        current = self.retained.get(topic)
+        retain = (b'"online":false' in payload or current is None
+                  or b'"source":"presence"' in current[0])
+        self.route(topic, payload, 0, retain)
+
+    def stop_replay(self, target_id):
+        task = self.replays.pop(target_id, None)
+        if task is not None:
+            task.cancel()
+            self.replays_cancelled += 1
+
+    def send_retained(self, conn, topic_filter):
+        qos = conn.subscriptions.get(topic_filter, 0)
+        if '+' not in topic_filter and '#' not in topic_filter:
+            # 设备只订阅自己的主题：直接查表，不随保留消息数（在线设备数）增长
+            message = self.retained.get(topic_filter)
+            matches = [(topic_filter, message)] if message is not None else []
+        else:
+            matches = [(topic, message) for topic, message in self.retained.items()
+                       if topic_matches(topic_filter, topic)]
+        for topic, (payload, retained_qos) in matches:
+            conn.deliver(topic, payload, min(qos, retained_qos), True, {})
+
+    # ---- 统计 ----
+
+    def render_metrics(self):
+        """Prometheus 文本格式的指标行（由 server.py 的 /__metrics 输出）"""
+        lines = [
+            '# HELP mqtt_clients_connected Connected MQTT clients.',
+            '# TYPE mqtt_clients_connected gauge',
+            f'mqtt_clients_connected {len(self.clients)}',
+            '# HELP mqtt_connections_total MQTT WebSocket connections accepted.',
+            '# TYPE mqtt_connections_total counter',
+            f'mqtt_connections_total {self.connections_total}',
+            '# HELP mqtt_messages_total MQTT messages, by direction.',
+            '# TYPE mqtt_messages_total counter',
+            f'mqtt_messages_total{{direction="received"}} {self.messages_received}',
+            f'mqtt_messages_total{{direction="sent"}} {self.messages_sent}',
+            f'mqtt_messages_total{{direction="dropped"}} {self.messages_dropped}',
+            f'mqtt_messages_total{{direction="rejected"}} {self.publishes_rejected}',
+        ]
+        if self.coalescer is not None:
+            lines += ['# HELP mqtt_control_coalesced_total Control messages collapsed into a newer value.',
+                      '# TYPE mqtt_control_coalesced_total counter']
+            for command_type, count in sorted(dict(self.coalescer.collapsed).items()):
+                lines.append(f'mqtt_control_coalesced_total{{type="{command_type}"}} {count}')
+        if self.journal is not None:
+            lines += [
+                '# HELP mqtt_replays_total Journal replays started.',
+                '# TYPE mqtt_replays_total counter',
+                f'mqtt_replays_total {self.replays_total}',
+                '# HELP mqtt_replays_cancelled_total Journal replays stopped before the end.',
+                '# TYPE mqtt_replays_cancelled_total counter',
+                f'mqtt_replays_cancelled_total {self.replays_cancelled}',
+                '# HELP mqtt_replays_active Journal replays in progress.',
+                '# TYPE mqtt_replays_active gauge',
+                f'mqtt_replays_active {len(self.replays)}',
+                '# HELP mqtt_replayed_messages_total Control messages re-issued by replays.',
+                '# TYPE mqtt_replayed_messages_total counter',
+                f'mqtt_replayed_messages_total {self.replayed_messages}',
+            ]
+            lines += self.journal.render_metrics()
+        if self.presence is not None:
+            lines += self.presence.render_metrics()
+        lines += [
+            '# HELP mqtt_retained_messages Retained messages held by the broker.',
+            '# TYPE mqtt_retained_messages gauge',
+            f'mqtt_retained_messages {len(self.retained)}',
+        ]
+        return lines
+
+
+def parse_command_type(payload):
+    """取出 mqtt.js sendCommand 消息中的命令类型：{"command": {"type": ...}}"""
+    try:
+        command = json.loads(payload).get('command')
+        command_type = command.get('type')
+    except (ValueError, AttributeError, RecursionError):
+        return None
+    return command_type if isinstance(command_type, str) else None
+
+
+def raise_nofile_limit():
+    """把文件描述符软上限提高到硬上限，以支持上千个并发连接"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > 65536:
+            hard = 65536
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
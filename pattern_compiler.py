@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+波形模式编译器
+
+把 waveform.js 的预设波形（wave/pulse/random）和 characters.js 中每个场景的
+强度曲线预先计算为定点数查找表，打包成一个二进制文件 web-prototype/patterns.lut。
+浏览器（pattern-library.js）和设备加载同一个文件，按相位/时间直接查表，
+两边播放的曲线完全一致，动画每帧也不再计算三角函数。
+
+用法:
+    # 生成 web-prototype/patterns.lut（build_release.py 构建时也会生成）
+    python3 pattern_compiler.py
+
+    # 查看已生成的模式库
+    python3 pattern_compiler.py --show web-prototype/patterns.lut
+
+    # 对照 calculateY() 的实时公式检查查表结果
+    python3 pattern_compiler.py --check web-prototype/patterns.lut
+
+查找表:
+    shape/<波形>  一个周期的基本波形，Q15 有符号定点数（-32767..32767 对应 -1..1），
+                  按相位索引：下标 = floor(相位 / 2π × 每周期采样数) mod 长度。
+                  预设模式 = 载波(x·f + φ) × 调制波(x·调制频率 + φ)，见 PATTERNS
+    scene/<场景>  场景全程的强度曲线，Q15（0..32767 对应 0..1），按秒索引：
+                  下标 = floor(秒 × 采样率)，超出范围时取两端的值
+
+文件格式（小端，可直接 mmap）:
+    头部 32 字节: magic 'SCPL', 格式版本 u16, 表数 u16, 内容哈希 8 字节,
+                  数据区偏移 u32, 文件大小 u32, 保留 8 字节
+    目录: 每个表 40 字节: 名称 24 字节（UTF-8，补零）, 类型 u8（0=shape, 1=scene）,
+          保留 u8, 周期数 u16, 采样率 f32（shape: 每周期采样数; scene: 每秒采样数）,
+          数据偏移 u32（相对文件开头，16 字节对齐）, 采样数 u32
+    数据: 各表的 int16 数组
+内容哈希是目录和数据区的 SHA-256 前8字节，客户端和设备据此确认使用同一版本。
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import re
+import struct
+import sys
+from pathlib import Path
+
+# 配置
+SCRIPT_DIR = Path(__file__).parent
+SOURCE_DIR = SCRIPT_DIR / 'web-prototype'
+OUTPUT_NAME = 'patterns.lut'
+SCENARIO_SOURCE = 'characters.js'   # 从 SCENARIOS 中读取场景的 id/时长/强度
+
+SHAPE_RESOLUTION = 256      # 基本波形每个周期的采样数
+SCENE_RATE = 4.0            # 场景曲线每秒采样数
+Q15 = 32767                 # 定点数 1.0 对应的整数值
+
+# 基本波形：名称 -> (周期数, 函数)，θ 为相位
+SHAPES = {
+    'sine': (1, lambda theta: math.sin(theta)),
+    'swell': (1, lambda theta: 0.5 + 0.5 * math.sin(theta)),
+}
+# waveform.js calculateY() 的预设模式：模式 -> (载波, 调制波, 调制频率)
+# 载波相位为 x × 每条波的频率 + φ，调制波相位为 x × 调制频率 + φ。三条波的载波
+# 频率不同而调制频率相同，所以两者分别查表，不能合成一张表
+PATTERNS = {
+    'wave': ('sine', None, 0.0),
+    'pulse': ('sine', 'sine', 0.01),
+    'random': ('sine', 'swell', 0.005),
+}
+
+# 检查查找表用的对照：calculateY() 中的实时公式（不含中心线和振幅）
+CHECK_FORMULAS = {
+    'wave': lambda x, f, phase: math.sin(x * f + phase),
+    'pulse': lambda x, f, phase: math.sin(x * f + phase) * math.sin(x * 0.01 + phase),
+    'random': lambda x, f, phase: (math.sin(x * f + phase)
+                                   * (0.5 + 0.5 * math.sin(x * 0.005 + phase))),
+}
+CHECK_FREQUENCIES = (0.02, 0.03, 0.04)  # waveform.js 中三条波的频率
+CHECK_PHASES = 12                       # 在 0..2π 内检查的相位数（updatePhases 使相位保持在此范围）
+CHECK_WIDTH = 1920                      # 检查的画布宽度（像素）
+# 查表按下标取整，误差不超过 斜率 × 采样间隔；载波和调制波的斜率都不超过 1
+CHECK_TOLERANCE = 2 * 2 * math.pi / SHAPE_RESOLUTION + 2 / Q15
+
+# 场景强度曲线 = 峰值 × 进程包络 × (1 + 起伏)
+SCENE_PEAKS = {             # SCENARIOS 中 intensity 字段 -> 峰值强度（0-1）
+    'soft': 0.45,
+    'gentle': 0.55,
+    'moderate': 0.7,
+    'intense': 0.9,
+}
+SCENE_ENVELOPE = [          # (场景进度, 峰值的比例)，对应语音播报的 开始/进行/高潮/结束
+    (0.0, 0.3),
+    (0.2, 0.6),
+    (0.7, 1.0),
+    (0.9, 1.0),
+    (1.0, 0.3),
+]
+SCENE_RIPPLE = 0.2          # 节奏起伏的相对幅度
+SCENE_RIPPLE_PERIOD = 6 * math.pi   # 起伏周期（秒），与 app.js 波形图的 sin(now / 3000) 相同
+
+# 文件格式
+LIBRARY_MAGIC = b'SCPL'
+LIBRARY_VERSION = 1
+LIBRARY_HEADER = struct.Struct('<4sHH8sII8x')
+TABLE_ENTRY = struct.Struct('<24sBBHfII')
+TABLE_ALIGN = 16
+KIND_SHAPE = 0
+KIND_SCENE = 1
+KIND_NAMES = {KIND_SHAPE: 'shape', KIND_SCENE: 'scene'}
+
+
+def to_q15(value):
+    return max(-Q15, min(Q15, int(round(value * Q15))))
+
+
+def compile_shape(function, cycles, resolution=SHAPE_RESOLUTION):
+    """波形一个完整周期的定点数采样"""
+    samples = resolution * cycles
+    return [to_q15(function(2 * math.pi * i / resolution)) for i in range(samples)]
+
+
+def lookup_shape(table, theta):
+    """与 pattern-library.js 的 shape() 相同的查表方式"""
+    _, _, rate, values = table
+    return values[math.floor(theta / (2 * math.pi) * rate) % len(values)] / Q15
+
+
+def lookup_pattern(tables, pattern, carrier, modulator):
+    """与 pattern-library.js 的 pattern() 相同：载波和调制波分别查表后相乘"""
+    carrier_shape, modulator_shape, _ = PATTERNS[pattern]
+    value = lookup_shape(tables[f'shape/{carrier_shape}'], carrier)
+    if modulator_shape is not None:
+        value *= lookup_shape(tables[f'shape/{modulator_shape}'], modulator)
+    return value
+
+
+def check_patterns(tables):
+    """对照 calculateY() 的实时公式检查每种预设模式，返回 {模式: 最大误差}"""
+    errors = {}
+    for pattern, formula in CHECK_FORMULAS.items():
+        modulation = PATTERNS[pattern][2]
+        worst = 0.0
+        for frequency in CHECK_FREQUENCIES:
+            for i in range(CHECK_PHASES + 1):
+                phase = 2 * math.pi * i / CHECK_PHASES
+                for x in range(0, CHECK_WIDTH, 2):
+                    value = lookup_pattern(tables, pattern, x * frequency + phase,
+                                           x * modulation + phase)
+                    worst = max(worst, abs(value - formula(x, frequency, phase)))
+        errors[pattern] = worst
+    return errors
+
+
+def verify_patterns(tables):
+    """查表结果超出 CHECK_TOLERANCE 时抛出 ValueError，生成的模式库不会与页面曲线不一致"""
+    for pattern, error in check_patterns(tables).items():
+        if error > CHECK_TOLERANCE:
+            raise ValueError(f'模式 {pattern} 查表结果与实时公式相差 {error:.4f}')
+
+
+def envelope_at(progress):
+    """SCENE_ENVELOPE 的分段线性插值"""
+    for (x0, y0), (x1, y1) in zip(SCENE_ENVELOPE, SCENE_ENVELOPE[1:]):
+        if progress <= x1:
+            return y0 + (y1 - y0) * (progress - x0) / (x1 - x0)
+    return SCENE_ENVELOPE[-1][1]
+
+
+def compile_scene(duration_minutes, intensity, rate=SCENE_RATE):
+    """场景全程的强度曲线"""
+    peak = SCENE_PEAKS.get(intensity, SCENE_PEAKS['moderate'])
+    samples = max(1, int(duration_minutes * 60 * rate))
+    values = []
+    for i in range(samples):
+        seconds = i / rate
+        level = peak * envelope_at(i / samples)
+        level *= 1 + SCENE_RIPPLE * math.sin(2 * math.pi * seconds / SCENE_RIPPLE_PERIOD)
+        values.append(to_q15(max(0.0, min(1.0, level))))
+    return values
+
+
+def find_scenarios(source_dir):
+    """从 characters.js 的 SCENARIOS 中读取 [(id, 时长分钟, 强度)]"""
+    path = source_dir / SCENARIO_SOURCE
+    text = path.read_text(encoding='utf-8')
+    block = re.search(r'const SCENARIOS = \{(.*?)\n\};', text, re.S)
+    if block is None:
+        raise ValueError(f'{path} 中没有 SCENARIOS')
+    scenarios = []
+    for body in re.findall(r'\n    \w+: \{(.*?)\n    \}', block.group(1), re.S):
+        fields = dict(re.findall(r"(\w+):\s*'?([^',\n]+)'?,?", body))
+        scenarios.append((fields['id'], float(fields['duration']), fields.get('intensity', 'moderate')))
+    return scenarios
+
+
+def build_tables(source_dir):
+    """返回 [(名称, 类型, 周期数, 采样率, 采样值列表)]"""
+    tables = [(f'shape/{name}', KIND_SHAPE, cycles, float(SHAPE_RESOLUTION),
+               compile_shape(function, cycles))
+              for name, (cycles, function) in SHAPES.items()]
+    for scenario_id, duration, intensity in find_scenarios(source_dir):
+        tables.append((f'scene/{scenario_id}', KIND_SCENE, 1, SCENE_RATE,
+                       compile_scene(duration, intensity)))
+    return tables
+
+
+def align(offset):
+    return (offset + TABLE_ALIGN - 1) // TABLE_ALIGN * TABLE_ALIGN
+
+
+def encode_library(tables):
+    """把查找表打包为模式库文件内容"""
+    offset = align(LIBRARY_HEADER.size + TABLE_ENTRY.size * len(tables))
+    data_offset = offset
+    directory = []
+    data = bytearray()
+    for name, kind, cycles, rate, values in tables:
+        encoded = name.encode('utf-8')
+        if len(encoded) > 24:
+            raise ValueError(f'表名过长: {name}')
+        directory.append(TABLE_ENTRY.pack(encoded, kind, 0, cycles, rate, offset, len(values)))
+        data += b'\0' * (offset - data_offset - len(data))
+        data += struct.pack(f'<{len(values)}h', *values)
+        offset = align(data_offset + len(data))
+    directory = b''.join(directory)
+    directory += b'\0' * (data_offset - LIBRARY_HEADER.size - len(directory))
+    digest = hashlib.sha256(directory + data).digest()[:8]
+    size = data_offset + len(data)
+    header = LIBRARY_HEADER.pack(LIBRARY_MAGIC, LIBRARY_VERSION, len(tables), digest,
+                                 data_offset, size)
+    return header + directory + bytes(data)
+
+
+def decode_library(data):
+    """解析模式库，返回 (版本哈希, {名称: (类型, 周期数, 采样率, 采样值列表)})"""
+    magic, version, count, digest, data_offset, size = LIBRARY_HEADER.unpack_from(data)
+    if magic != LIBRARY_MAGIC or version != LIBRARY_VERSION:
+        raise ValueError('不是模式库文件或版本不支持')
+    if len(data) < size:
+        raise ValueError('模式库文件不完整')
+    tables = {}
+    for i in range(count):
+        name, kind, _, cycles, rate, offset, samples = \
+            TABLE_ENTRY.unpack_from(data, LIBRARY_HEADER.size + i * TABLE_ENTRY.size)
+        values = list(struct.unpack_from(f'<{samples}h', data, offset))
+        tables[name.rstrip(b'\0').decode('utf-8')] = (kind, cycles, rate, values)
+    return digest.hex(), tables
+
+
+def write_library(path, data):
+    """先写临时文件再替换，服务器不会发送写了一半的模式库"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def compile_library(source_dir, output):
+    """生成模式库文件，返回 (版本哈希, 表数, 文件大小)"""
+    data = encode_library(build_tables(Path(source_dir)))
+    version, tables = decode_library(data)
+    verify_patterns(tables)
+    write_library(output, data)
+    return version, len(tables), len(data)
+
+
+def show_library(path):
+    with open(path, 'rb') as f:
+        version, tables = decode_library(f.read())
+    print(f"📦 {path}  版本 {version}, {len(tables)} 个表")
+    for name, (kind, cycles, rate, values) in tables.items():
+        if kind == KIND_SHAPE:
+            detail = f"{cycles} 个周期 × {rate:g} 采样"
+        else:
+            detail = f"{len(values) / rate / 60:g} 分钟 × {rate:g} Hz"
+        print(f"   {name:<18} {len(values):>6} 个采样  {detail:<20} "
+              f"{min(values) / Q15:+.2f}..{max(values) / Q15:+.2f}")
+
+
+def show_check(path):
+    """打印每种预设模式查表与实时公式的最大误差，超出容差时返回 False"""
+    with open(path, 'rb') as f:
+        _, tables = decode_library(f.read())
+    try:
+        errors = check_patterns(tables)
+    except KeyError as e:
+        print(f"❌ 模式库中缺少表 {e}")
+        return False
+    passed = True
+    for pattern, error in errors.items():
+        ok = error <= CHECK_TOLERANCE
+        passed = passed and ok
+        print(f"   {'✓' if ok else '✗'} {pattern:<8} 最大误差 {error:.4f} (容差 {CHECK_TOLERANCE:.4f})")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把预设波形和场景曲线编译为定点数查找表')
+    parser.add_argument('--source', default=str(SOURCE_DIR),
+                        help='网页目录，从中读取 characters.js (默认: web-prototype)')
+    parser.add_argument('--output', default=None,
+                        help=f'输出文件 (默认: <source>/{OUTPUT_NAME})')
+    parser.add_argument('--show', metavar='FILE',
+                        help='查看已生成的模式库')
+    parser.add_argument('--check', metavar='FILE',
+                        help='对照 waveform.js 的实时公式检查模式库中的预设模式')
+    args = parser.parse_args()
+
+    if args.check:
+        if not show_check(args.check):
+            sys.exit(1)
+        return
+    if args.show:
+        show_library(args.show)
+        return
+    output = args.output or os.path.join(args.source, OUTPUT_NAME)
+    try:
+        version, count, size = compile_library(args.source, output)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"❌ 编译失败: {e}")
+        sys.exit(1)
+    print(f"✅ 已生成 {output}: {count} 个表, {size} 字节, 版本 {version}")
+
+
+if __name__ == '__main__':
+    main()
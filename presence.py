@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+设备在线状态（presence）
+
+内置MQTT代理收到 device/heartbeat/<设备ID> 时记录设备在线；超过超时时间
+没有心跳则判定离线。上线/离线时在 device/status/<设备ID> 发布保留消息：
+
+    {"deviceId": "dev01", "online": false, "lastSeen": 1760000000123,
+     "timestamp": 1760000090500, "source": "presence"}
+
+在线设备和最近离线设备的列表通过 GET /api/presence 查询
+（python3 server.py start --mqtt，--presence-timeout 修改超时时间）。
+
+超时检测使用分层时间轮（TimerWheel）：
+    - 每层 64 个槽，第0层每槽一个刻度（TICK 秒），第 n 层每槽 64^n 个刻度，
+      4层可覆盖约97天；定时器按到期刻度放入对应层的槽，插入 O(1)
+    - 每个刻度只处理第0层的一个槽；高层的槽在轮到时整体下放到低层（级联），
+      每个定时器最多被移动 层数 次
+    - 心跳只更新设备的截止时间，不移动定时器；定时器到期时截止时间已推后的设备
+      重新放入时间轮，因此每个设备每个超时周期最多处理一次，与心跳频率无关
+上线（第一次心跳）和离线（定时器到期）都是 O(1)，不需要扫描所有设备。
+"""
+
+import collections
+import json
+import math
+import time
+
+# 配置
+PRESENCE_TIMEOUT = 90           # 超过此时间（秒）没有心跳判定离线（app.js 每30秒一次心跳，允许丢失两次）
+TICK = 0.5                      # 时间轮刻度（秒），离线判定最多延后一个刻度
+WHEEL_BITS = 6                  # 每层 2^6 = 64 个槽
+WHEEL_LEVELS = 4                # 层数，可表示的最长超时 = TICK × 64^4
+MAX_OFFLINE = 10000             # 保留最后在线时间的离线设备数，超过时忘记最早离线的设备
+HEARTBEAT_TOPIC_PREFIX = 'device/heartbeat/'
+STATUS_TOPIC_PREFIX = 'device/status/'
+
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+MAX_TICKS = (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1
+
+
+class TimerWheel:
+    """分层时间轮，键到期时由 advance() 返回"""
+
+    def __init__(self, now, tick=TICK):
+        self.tick = tick
+        self.current = int(now / tick)      # 已处理到的刻度
+        self.levels = [[{} for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)]
+
+    def schedule(self, key, deadline):
+        """在 deadline（与 now 相同的时钟）之后让 key 到期，同一个键只能有一个定时器"""
+        expires = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        self._insert(key, min(expires, self.current + MAX_TICKS))
+
+    def _insert(self, key, expires):
+        # 按距离到期的刻度数选择层：第 n 层放 64^n ~ 64^(n+1) 个刻度之后到期的定时器
+        delta = expires - self.current
+        level = 0
+        while level < WHEEL_LEVELS - 1 and delta >> (WHEEL_BITS * (level + 1)):
+            level += 1
+        slot = (expires >> (WHEEL_BITS * level)) & WHEEL_MASK
+        self.levels[level][slot][key] = expires
+
+    def advance(self, now):
+        """处理到 now 为止的所有刻度，返回到期的键列表"""
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # 低层转完一圈时，把高层对应槽中的定时器下放
+            for level in range(1, WHEEL_LEVELS):
+                if self.current & ((1 << (WHEEL_BITS * level)) - 1):
+                    break
+                slot = (self.current >> (WHEEL_BITS * level)) & WHEEL_MASK
+                bucket = self.levels[level][slot]
+                if bucket:
+                    self.levels[level][slot] = {}
+                    for key, expires in bucket.items():
+                        self._insert(key, expires)
+            slot = self.current & WHEEL_MASK
+            bucket = self.levels[0][slot]
+            if bucket:
+                self.levels[0][slot] = {}
+                expired.extend(bucket)
+        return expired
+
+
+class DeviceState:
+    __slots__ = ('deadline', 'last_seen', 'online_since')
+
+    def __init__(self, deadline, last_seen):
+        self.deadline = deadline        # 单调时钟，超过时离线
+        self.last_seen = last_seen      # Unix 秒，最后一次心跳
+        self.online_since = last_seen
+
+
+class PresenceTracker:
+    """根据心跳维护设备在线状态，状态变化时调用 publish(topic, payload)
+
+    所有方法都在代理的事件循环线程中调用。
+    """
+
+    def __init__(self, publish, timeout=PRESENCE_TIMEOUT, now=None):
+        self.publish = publish
+        self.timeout = timeout
+        self.wheel = TimerWheel(time.monotonic() if now is None else now)
+        self.online = {}                                # 设备ID -> DeviceState
+        self.offline = collections.OrderedDict()        # 设备ID -> 最后在线时间（Unix 秒），按离线先后
+        self.heartbeats = 0
+        self.transitions = {'online': 0, 'offline': 0}
+
+    def heartbeat(self, device_id, now=None, wall=None):
+        """收到设备心跳：更新截止时间，新上线的设备放入时间轮"""
+        now = time.monotonic() if now is None else now
+        wall = time.time() if wall is None else wall
+        self.heartbeats += 1
+        state = self.online.get(device_id)
+        if state is not None:
+            state.deadline = now + self.timeout
+            state.last_seen = wall
+            return
+        self.offline.pop(device_id, None)
+        self.online[device_id] = DeviceState(now + self.timeout, wall)
+        self.wheel.schedule(device_id, now + self.timeout)
+        self.transitions['online'] += 1
+        self.announce(device_id, True, wall, wall)
+
+    def expire(self, now=None, wall=None):
+        """推进时间轮，判定超时的设备离线，返回本次离线的设备数"""
+        now = time.monotonic() if now is None else now
+        wall = time.time() if wall is None else wall
+        went_offline = 0
+        for device_id in self.wheel.advance(now):
+            state = self.online.get(device_id)
+            if state is None:
+                continue
+            if state.deadline > now:
+                # 到期前收到过心跳：按新的截止时间重新计时
+                self.wheel.schedule(device_id, state.deadline)
+                continue
+            del self.online[device_id]
+            self.offline[device_id] = state.last_seen
+            if len(self.offline) > MAX_OFFLINE:
+                self.offline.popitem(last=False)
+            self.transitions['offline'] += 1
+            went_offline += 1
+            self.announce(device_id, False, state.last_seen, wall)
+        return went_offline
+
+    def announce(self, device_id, online, last_seen, wall):
+        payload = json.dumps({
+            'deviceId': device_id,
+            'online': online,
+            'lastSeen': int(last_seen * 1000),
+            'timestamp': int(wall * 1000),
+            'source': 'presence',
+        }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.publish(STATUS_TOPIC_PREFIX + device_id, payload)
+
+    def snapshot(self, device_id=None, include_offline=False, limit=None):
+        """在线设备（按最后心跳从新到旧）及最近离线设备的列表"""
+        if device_id is not None:
+            state = self.online.get(device_id)
+            if state is not None:
+                return {'device': device_id, 'online': True, 'lastSeen': state.last_seen,
+                        'since': state.online_since}
+            if device_id in self.offline:
+                return {'device': device_id, 'online': False, 'lastSeen': self.offline[device_id]}
+            return None
+        devices = sorted(self.online.items(), key=lambda item: item[1].last_seen, reverse=True)
+        result = {
+            'timeout': self.timeout,
+            'online': len(self.online),
+            'devices': [{'device': key, 'lastSeen': state.last_seen, 'since': state.online_since}
+                        for key, state in devices[:limit]],
+        }
+        if include_offline:
+            result['offline'] = [{'device': key, 'lastSeen': last_seen}
+                                 for key, last_seen in reversed(self.offline.items())][:limit]
+        return result
+
+    def render_metrics(self):
+        return [
+            '# HELP presence_devices_online Devices with a heartbeat within the presence timeout.',
+            '# TYPE presence_devices_online gauge',
+            f'presence_devices_online {len(self.online)}',
+            '# HELP presence_heartbeats_total Device heartbeats received.',
+            '# TYPE presence_heartbeats_total counter',
+            f'presence_heartbeats_total {self.heartbeats}',
+            '# HELP presence_transitions_total Devices going online or offline.',
+            '# TYPE presence_transitions_total counter',
+            *(f'presence_transitions_total{{state="{state}"}} {count}'
+              for state, count in self.transitions.items()),
+        ]
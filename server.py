@@ -11,7 +11,33 @@
     python3 server.py start
     或
     python3 server.py
+
+    # 指定并发模式（默认 pool：有界线程池；single：单线程，逐个处理连接）
+    python3 server.py start --mode pool --threads 32 --queue 128
+
+    # 多进程模式：4个工作进程共享监听端口，崩溃后自动重启
+    python3 server.py start --workers 4
+
+    # 指定端口（非默认端口使用单独的PID文件，stop/status 也需要加 --port）
+    python3 server.py start --port 18080
+    python3 server.py stop --port 18080
+
+    # HTTPS（手机等非 localhost 地址使用麦克风时需要），首次启动自动生成自签名证书
+    python3 server.py start --https
+    python3 server.py cert          # 重新生成自签名证书（运行中的服务器自动加载）
+
+    # 内置MQTT代理，记录发给设备的控制命令（可查看和回放）
+    python3 server.py start --mqtt --journal data/journal
+
+    # 设备 120 秒没有心跳判定离线（默认 90 秒），在线设备: GET /api/presence
+    python3 server.py start --mqtt --presence-timeout 120
+
+    # 指定服务目录（如发布目录，可使用其中的 .gz/.br 预压缩文件）
+    python3 server.py start --root release/smart-control-prototype-v1.0.0
     
+    # 平滑重启（新进程接管监听端口，旧进程处理完剩余请求后退出）
+    python3 server.py reload
+
     # 停止服务器
     python3 server.py stop
     
@@ -26,66 +52,1588 @@
     - PID文件管理（自动保存和清理）
     - 优雅停止服务器
     - 端口冲突智能处理
+    - 有界线程池并发处理（大视频传输不再阻塞其他请求）
 
 详细说明请查看: README_SERVER.md
 """
 
+import argparse
+import concurrent.futures
+import datetime
+import email.utils
+import gzip
 import http.server
+import io
+import json
+import queue
+import random
+import secrets
+import selectors
+import socket
 import socketserver
+import ssl
+import stat
+import threading
+import time
+import traceback
+import urllib.parse
 import webbrowser
 import os
 import sys
 import subprocess
 import signal
+from collections import OrderedDict, namedtuple
+from http import HTTPStatus
 from pathlib import Path
 
+try:
+    import brotli  # 可选依赖，未安装时只提供gzip
+except ImportError:
+    brotli = None
+
+import annotation_index
+import annotation_store
+import command_journal
+import mqtt_broker
+import presence
+
+try:
+    import fcntl    # Windows 上没有，访问日志轮转时不加锁
+except ImportError:
+    fcntl = None
+
 # 配置
 PORT = 8080
 HOST = '0.0.0.0'  # 监听所有网络接口，允许通过IP地址访问
 PID_FILE = '.server.pid'
 
+# 并发配置
+SERVER_MODE = 'pool'        # pool: 有界线程池; single: 单线程（逐个处理连接）
+MAX_WORKERS = 32            # 线程池大小，即同时处理的最大连接数
+REQUEST_QUEUE_SIZE = 128    # 等待队列深度，队列满时直接返回503
+
+# HTTPS 配置（python3 server.py start --https）
+# voice.js 的麦克风/语音识别在非 localhost 地址上要求 HTTPS。
+CERT_DIR = '.certs'                 # 自签名证书的默认目录（相对于 server.py）
+TLS_HANDSHAKE_TIMEOUT = 10          # TLS 握手超时（秒），握手在工作线程中进行，不阻塞accept
+TLS_SESSION_TICKETS = 2             # TLS 1.3 每次握手发放的会话票据数，客户端重连时恢复会话
+TLS_CERT_CHECK_INTERVAL = 5.0       # 检查证书文件是否更新的最小间隔（秒）
+SELF_SIGNED_DAYS = 825              # 自签名证书有效期（天，iOS 要求不超过825天）
+
+# 平滑重启配置（python3 server.py reload）
+RELOAD_READY_TIMEOUT = 15       # 等待新进程就绪的秒数，超时则放弃重启，旧进程继续服务
+RELOAD_DRAIN_TIMEOUT = 30       # 旧进程停止接受连接后，等待处理中的请求完成的最长秒数
+
+# 多进程配置（python3 server.py start --workers N）
+WORKERS = 1                     # 工作进程数，1表示单进程
+WORKER_RESTART_DELAY = 1.0      # 工作进程启动后很快退出时，重启前等待的秒数（避免崩溃循环）
+
+# 运行指标配置（python3 server.py start --metrics）
+METRICS_PATH = '/__metrics'     # Prometheus 文本格式的指标接口
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PATH_CLASSES = {
+    '.html': 'html', '.htm': 'html',
+    '.js': 'js',
+    '.css': 'css',
+    '.png': 'image', '.jpg': 'image', '.jpeg': 'image', '.gif': 'image',
+    '.svg': 'image', '.webp': 'image', '.ico': 'image',
+    '.mp4': 'video', '.mov': 'video', '.webm': 'video',
+}
+
+# 内置MQTT代理配置（python3 server.py start --mqtt）
+MQTT_PATH = '/mqtt'             # WebSocket 地址：ws://<服务器地址>:8080/mqtt
+
+# 视频标注上传接口（python3 server.py start --annotations data/annotations）
+ANNOTATIONS_PATH = '/api/annotations'
+ANNOTATION_STATS_PATH = '/api/annotations/stats'    # 按视频和时间桶统计标注
+
+# 设备控制命令日志（python3 server.py start --mqtt --journal data/journal）
+JOURNAL_PATH = '/api/journal'                   # 查看设备日志
+JOURNAL_REPLAY_PATH = '/api/journal/replay'     # 回放一段会话
+MAX_JOURNAL_QUERY = 10000                       # 单次查询最多返回的记录数
+
+# 设备在线状态（启用 --mqtt 时根据 device/heartbeat 跟踪）
+PRESENCE_PATH = '/api/presence'
+DEFAULT_PRESENCE_LIMIT = 1000                   # 默认返回的设备数
+MAX_PRESENCE_QUERY = 100000                     # 单次查询最多返回的设备数
+
+# 访问日志配置（python3 server.py start --access-log logs/access.log）
+# 请求线程只把记录放入队列，由后台线程批量写出，不在请求路径上做磁盘/终端IO。
+# 未指定文件时按原来的文本格式输出到终端；指定文件时写 JSON Lines 并按大小轮转。
+ACCESS_LOG_QUEUE_SIZE = 10000           # 队列满时丢弃新记录（计数），不阻塞请求
+ACCESS_LOG_FLUSH_INTERVAL = 1.0         # 后台线程最长每隔多少秒写出一批
+ACCESS_LOG_BATCH_SIZE = 512             # 攒够多少条记录立即写出
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024 # 日志文件超过此大小时轮转
+ACCESS_LOG_BACKUPS = 5                  # 保留的历史文件数（access.log.1 ... access.log.5）
+ACCESS_LOG_MEDIA_SAMPLE_RATE = 0.1      # 视频的206分段请求数量很大，只按此比例抽样记录
+ACCESS_LOG_EXCLUDE = ['/favicon.ico']   # 不记录的URL路径前缀
+
+# HTTP/1.1 持久连接配置
+KEEPALIVE_TIMEOUT = 15          # 空闲连接超时（秒），超时后关闭连接
+KEEPALIVE_MAX_REQUESTS = 100    # 单个连接最多处理的请求数，达到后关闭连接
+
+# Range请求配置
+MAX_RANGES = 16             # 单个请求最多允许的区间数，超出时忽略Range返回完整内容
+COPY_BUFSIZE = 64 * 1024    # 缓冲复制时每次读取的字节数
+USE_SENDFILE = True         # 发送文件时使用内核零拷贝（sendfile），不经过Python缓冲
+
+# 热点文件缓存配置
+HOT_CACHE_MAX_BYTES = 32 * 1024 * 1024      # 缓存总字节预算，0表示关闭缓存
+HOT_CACHE_MAX_FILE_SIZE = 1024 * 1024       # 超过此大小的文件（如视频）不进入缓存
+HOT_CACHE_CHECK_INTERVAL = 1.0              # 同一文件两次 stat 校验的最小间隔（秒）
+
+# 压缩配置
+# 文本类文件按 Accept-Encoding 发送压缩版本：优先使用 build_release.py 生成的
+# .br/.gz 预压缩文件，没有时（开发模式）实时压缩并放入热点文件缓存。
+# mp4/mov/png 等已压缩的媒体文件不在此列表中，始终原样发送。
+COMPRESSIBLE_EXTENSIONS = {'.html', '.htm', '.css', '.js', '.json', '.md',
+                           '.svg', '.txt', '.xml', '.curve'}
+COMPRESSION_MIN_SIZE = 256                  # 小于此大小的文件不压缩
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+GZIP_LEVEL = 6                              # 实时压缩使用的级别（预压缩文件使用最高级别）
+BROTLI_QUALITY = 5
+
+def parse_accept_encoding(value):
+    """解析 Accept-Encoding，返回 {编码: q值}"""
+    accepted = {}
+    for item in value.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, val = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+def compress_body(body, encoding):
+    """实时压缩文件内容"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+# 缓存策略配置
+# 按URL路径前缀匹配（先匹配先生效），所有文件响应都带 ETag 和 Last-Modified，
+# 客户端可以用 If-None-Match / If-Modified-Since 重新验证，未修改时返回304。
+CACHE_CONTROL_RULES = [
+    ('/resource/', 'public, max-age=604800'),   # 图片和视频：缓存7天
+    ('/sw.js', 'no-cache'),                     # Service Worker 必须每次验证
+]
+DEFAULT_CACHE_CONTROL = 'no-cache'              # 其他文件：可缓存，但每次使用前重新验证
+
+# 发布目录中由 build_release.py 生成的资源清单（原文件名 -> name.<内容哈希>.ext）
+# 清单中带哈希的文件内容永远不变，浏览器缓存1年且不再重新验证
+ASSET_MANIFEST = 'asset-manifest.json'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def make_etag(fs, encoding=None):
+    """根据 inode、mtime 和大小生成强ETag，压缩版本附加编码名以区分"""
+    tag = f"{fs.st_ino:x}-{fs.st_mtime_ns:x}-{fs.st_size:x}"
+    if encoding is not None:
+        tag += f"-{encoding}"
+    return f'"{tag}"'
+
+def etag_matches(header_value, etag):
+    """If-None-Match 的弱比较：忽略 W/ 前缀，支持 * 和逗号分隔的多个值"""
+    if header_value.strip() == '*':
+        return True
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def find_precompressed(path, source_mtime, encoding):
+    """返回不比源文件旧的预压缩文件路径，不存在时返回 None"""
+    variant = path + ENCODING_SUFFIXES[encoding]
+    try:
+        if os.stat(variant).st_mtime >= source_mtime:
+            return variant
+    except OSError:
+        pass
+    return None
+
+def parse_range_header(value, size):
+    """解析Range请求头
+
+    返回按起始位置排序并合并后的闭区间列表 [(start, end), ...]；
+    无法识别的语法返回 None（忽略Range，返回完整内容）；
+    所有区间都无法满足时返回空列表（416）。
+    """
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        if not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+            return None
+        if first == '':
+            # 后缀区间: bytes=-500 表示最后500字节
+            if last == '':
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        if start >= size:
+            continue
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # 合并重叠或相邻的区间
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class CacheEntry:
+    """缓存中的一个文件：内容和预先生成的响应头"""
+
+    __slots__ = ('body', 'size', 'mtime', 'mtime_ns', 'ctype',
+                 'last_modified', 'etag', 'encoding', 'checked_at')
+
+    def __init__(self, body, fs, ctype, last_modified, encoding=None):
+        self.body = body
+        self.size = fs.st_size  # 源文件大小，用于失效判断
+        self.etag = make_etag(fs, encoding)
+        self.encoding = encoding
+        self.mtime = fs.st_mtime
+        self.mtime_ns = fs.st_mtime_ns
+        self.ctype = ctype
+        self.last_modified = last_modified
+        self.checked_at = time.monotonic()
+
+
+class HotAssetCache:
+    """按字节预算的LRU文件缓存
+
+    以文件路径（和内容编码）为键缓存 index.html、app.js、styles.css 等小文件
+    的内容，文件的 mtime 或大小变化时自动失效。同一文件同时有多个未命中请求时
+    只有一个线程读盘（single-flight），其余线程等待其结果。
+    """
+
+    def __init__(self, max_bytes=HOT_CACHE_MAX_BYTES,
+                 max_file_size=HOT_CACHE_MAX_FILE_SIZE,
+                 check_interval=HOT_CACHE_CHECK_INTERVAL):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.check_interval = check_interval
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, guess_type, date_time_string, encoding=None):
+        """返回 path 对应的缓存条目，文件不适合缓存或读取失败时返回 None
+
+        encoding 不为 None 时返回该编码的压缩内容（预压缩文件或实时压缩结果）。
+        """
+        key = (path, encoding)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        try:
+            fs = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(fs.st_mode) or fs.st_size > self.max_file_size:
+            return None
+        if encoding is not None and fs.st_size < COMPRESSION_MIN_SIZE:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.mtime_ns == fs.st_mtime_ns and entry.size == fs.st_size:
+                    entry.checked_at = now
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._remove(key)
+                self.invalidations += 1
+            event = self._loading.get(key)
+            leader = event is None
+            if leader:
+                event = self._loading[key] = threading.Event()
+
+        if not leader:
+            # 其他线程正在读取同一文件，等待其完成
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                return entry
+
+        entry = None
+        try:
+            entry = self._load(path, guess_type, date_time_string, encoding)
+        finally:
+            with self._lock:
+                self.misses += 1
+                if entry is not None:
+                    self._insert(key, entry)
+                del self._loading[key]
+            event.set()
+        return entry
+
+    def _load(self, path, guess_type, date_time_string, encoding):
+        """从磁盘读取文件（需要压缩时读取预压缩文件或实时压缩），
+
+        读取期间文件发生变化时放弃缓存。
+        """
+        try:
+            with open(path, 'rb') as f:
+                fs = os.fstat(f.fileno())
+                if fs.st_size > self.max_file_size:
+                    return None
+                variant = None
+                if encoding is not None:
+                    variant = find_precompressed(path, fs.st_mtime, encoding)
+                if variant is not None:
+                    with open(variant, 'rb') as vf:
+                        body = vf.read()
+                elif encoding == 'br' and brotli is None:
+                    return None
+                else:
+                    body = f.read()
+                    if len(body) != fs.st_size:
+                        return None
+                    if encoding is not None:
+                        body = compress_body(body, encoding)
+        except OSError:
+            return None
+        return CacheEntry(body, fs, guess_type(path),
+                          date_time_string(fs.st_mtime), encoding)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self.total_bytes += len(entry.body)
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted.body)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= len(entry.body)
+
+    def stats(self):
+        """返回缓存计数器"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+def classify_path(url_path):
+    """按扩展名把请求路径归类为 html/js/css/image/video/api/other"""
+    if url_path.endswith('/'):
+        return 'html'
+    if url_path.startswith('/api/'):
+        return 'api'
+    return PATH_CLASSES.get(os.path.splitext(url_path)[1].lower(), 'other')
+
+
+class ServerMetrics:
+    """服务器运行指标：请求数、发送字节数、延迟直方图、进行中的连接和断开次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}          # (状态码, 路径类别) -> 请求数
+        self.bytes_sent = {}        # 路径类别 -> 字节数
+        self.latency = {}           # 路径类别 -> [各区间计数..., +Inf计数]
+        self.latency_sum = {}       # 路径类别 -> 总耗时
+        self.connections_in_flight = 0
+        self.requests_in_flight = 0
+        self.broken_pipes = 0
+        self.tls_handshakes = {}    # 是否恢复会话 -> 握手次数
+        self.tls_failures = 0
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_in_flight += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections_in_flight -= 1
+
+    def request_started(self):
+        with self._lock:
+            self.requests_in_flight += 1
+
+    def request_finished(self, status, path_class, nbytes, duration):
+        """记录一个已完成的请求，path_class 为 None 时只更新进行中的请求数"""
+        with self._lock:
+            self.requests_in_flight -= 1
+            if path_class is None:
+                return
+            key = (status, path_class)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_sent[path_class] = self.bytes_sent.get(path_class, 0) + nbytes
+            buckets = self.latency.get(path_class)
+            if buckets is None:
+                buckets = self.latency[path_class] = [0] * (len(LATENCY_BUCKETS) + 1)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+            self.latency_sum[path_class] = self.latency_sum.get(path_class, 0.0) + duration
+
+    def broken_pipe(self):
+        with self._lock:
+            self.broken_pipes += 1
+
+    def tls_handshake(self, resumed):
+        with self._lock:
+            self.tls_handshakes[resumed] = self.tls_handshakes.get(resumed, 0) + 1
+
+    def tls_failure(self):
+        with self._lock:
+            self.tls_failures += 1
+
+    def render(self, cache=None):
+        """输出 Prometheus 文本格式"""
+        with self._lock:
+            lines = [
+                '# HELP http_requests_total Requests handled, by status and path class.',
+                '# TYPE http_requests_total counter',
+            ]
+            for (status, path_class), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{status="{status}",class="{path_class}"}} {count}')
+
+            lines += ['# HELP http_response_bytes_total Bytes sent (headers and body), by path class.',
+                      '# TYPE http_response_bytes_total counter']
+            for path_class, nbytes in sorted(self.bytes_sent.items()):
+                lines.append(f'http_response_bytes_total{{class="{path_class}"}} {nbytes}')
+
+            lines += ['# HELP http_request_duration_seconds Request latency, by path class.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for path_class, buckets in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += count
+                    lines.append(f'http_request_duration_seconds_bucket'
+                                 f'{{class="{path_class}",le="{bound}"}} {cumulative}')
+                cumulative += buckets[-1]
+                lines.append(f'http_request_duration_seconds_bucket'
+                             f'{{class="{path_class}",le="+Inf"}} {cumulative}')
+                lines.append(f'http_request_duration_seconds_sum{{class="{path_class}"}} '
+                             f'{self.latency_sum[path_class]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{class="{path_class}"}} '
+                             f'{cumulative}')
+
+            lines += ['# HELP http_connections_in_flight Open client connections.',
+                      '# TYPE http_connections_in_flight gauge',
+                      f'http_connections_in_flight {self.connections_in_flight}',
+                      '# HELP http_requests_in_flight Requests being processed.',
+                      '# TYPE http_requests_in_flight gauge',
+                      f'http_requests_in_flight {self.requests_in_flight}',
+                      '# HELP http_broken_pipes_total Client disconnects during a response.',
+                      '# TYPE http_broken_pipes_total counter',
+                      f'http_broken_pipes_total {self.broken_pipes}']
+            if self.tls_handshakes or self.tls_failures:
+                lines += ['# HELP tls_handshakes_total Completed TLS handshakes, by session resumption.',
+                          '# TYPE tls_handshakes_total counter']
+                for resumed, count in sorted(self.tls_handshakes.items()):
+                    lines.append(f'tls_handshakes_total{{resumed="{str(resumed).lower()}"}} {count}')
+                lines += ['# HELP tls_handshake_failures_total Failed or aborted TLS handshakes.',
+                          '# TYPE tls_handshake_failures_total counter',
+                          f'tls_handshake_failures_total {self.tls_failures}']
+
+        if cache is not None:
+            stats = cache.stats()
+            lines += ['# HELP hot_cache_events_total Hot asset cache events.',
+                      '# TYPE hot_cache_events_total counter']
+            for event in ('hits', 'misses', 'evictions', 'invalidations'):
+                lines.append(f'hot_cache_events_total{{event="{event}"}} {stats[event]}')
+            lines += ['# HELP hot_cache_bytes Bytes held by the hot asset cache.',
+                      '# TYPE hot_cache_bytes gauge',
+                      f'hot_cache_bytes {stats["bytes"]}']
+
+        lines += ['# HELP server_process_id PID of the process that answered this scrape.',
+                  '# TYPE server_process_id gauge',
+                  f'server_process_id {os.getpid()}']
+        return '\n'.join(lines) + '\n'
+
+
+class CountingWriter:
+    """统计写入字节数的输出流包装（sendfile 发送的字节通过 add 计入）"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        result = self.raw.write(data)
+        self.count += len(data)
+        return result
+
+    def add(self, nbytes):
+        self.count += nbytes
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+
+class AccessLog:
+    """非阻塞的访问日志
+
+    record() 只把记录放入有界队列（队列满时丢弃并计数），后台线程每
+    ACCESS_LOG_FLUSH_INTERVAL 秒或攒够 ACCESS_LOG_BATCH_SIZE 条时一次写出。
+    path 为 None 时输出到终端（与原来的日志格式相同），否则以追加方式写入
+    JSON Lines 文件，超过 max_bytes 时轮转。多进程模式下各工作进程写同一个
+    文件：每批记录一次 write 追加，发现文件已被其他进程轮转时重新打开。
+    """
+
+    def __init__(self, path=None, max_bytes=ACCESS_LOG_MAX_BYTES,
+                 backups=ACCESS_LOG_BACKUPS, sample_rate=ACCESS_LOG_MEDIA_SAMPLE_RATE,
+                 exclude=ACCESS_LOG_EXCLUDE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self.exclude = tuple(exclude)
+        self.queue = queue.Queue(maxsize=ACCESS_LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self.thread.start()
+
+    def is_excluded(self, path):
+        return path.startswith(self.exclude)
+
+    def record(self, path, path_class, status, **fields):
+        """记录一个已完成的请求（在请求线程中调用，不做IO）"""
+        if self.is_excluded(path):
+            return
+        entry = {'ts': time.time(), 'path': path, 'status': status}
+        if status == 206 and path_class == 'video' and self.sample_rate < 1:
+            if random.random() >= self.sample_rate:
+                return
+            # 记录抽样比例，统计时按 1/sample_rate 放大
+            entry['sample_rate'] = self.sample_rate
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """写出队列中剩余的记录并停止后台线程"""
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        if self.dropped:
+            print(f"⚠️  访问日志队列已满，丢弃了 {self.dropped} 条记录", file=sys.stderr)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            # 从第一条记录起最多等待 ACCESS_LOG_FLUSH_INTERVAL 秒，攒够一批再写
+            deadline = time.monotonic() + ACCESS_LOG_FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < ACCESS_LOG_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                # close() 放入的结束标记
+                running = False
+                batch.pop()
+            try:
+                self._write(batch)
+            except (OSError, ValueError) as e:
+                # 写日志失败不能影响服务器
+                print(f"⚠️  访问日志写入失败: {e}", file=sys.stderr)
+        if self.file is not None:
+            self.file.close()
+
+    def _write(self, batch):
+        if not batch:
+            return
+        if self.path is None:
+            sys.stderr.write(''.join(self._format_text(entry) for entry in batch))
+            sys.stderr.flush()
+            return
+        data = ''.join(json.dumps(self._format_json(entry), ensure_ascii=False) + '\n'
+                       for entry in batch).encode('utf-8')
+        self._open()
+        # 其他进程也在追加，用文件实际大小而不是 tell() 判断
+        size = os.fstat(self.file.fileno()).st_size
+        if size > 0 and size + len(data) > self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def _open(self):
+        """打开日志文件；文件已被删除或被其他进程轮转时重新打开"""
+        if self.file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        self.file = open(self.path, 'ab')
+
+    def _rotate(self):
+        """轮转日志文件，多进程时用文件锁保证同一个文件只被轮转一次"""
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            # 加锁后再次确认：等待锁期间其他进程可能已经完成轮转
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                for i in range(self.backups - 1, 0, -1):
+                    src = f"{self.path}.{i}"
+                    if os.path.exists(src):
+                        os.replace(src, f"{self.path}.{i + 1}")
+                if self.backups > 0:
+                    os.replace(self.path, f"{self.path}.1")
+                else:
+                    os.truncate(self.path, 0)
+        finally:
+            # 关闭文件同时释放锁
+            self.file.close()
+            self.file = None
+        self._open()
+
+    @staticmethod
+    def _format_json(entry):
+        entry = dict(entry)
+        entry['ts'] = datetime.datetime.fromtimestamp(entry['ts']).astimezone().isoformat(
+            timespec='milliseconds')
+        return entry
+
+    @staticmethod
+    def _format_text(entry):
+        when = time.strftime('%d/%b/%Y %H:%M:%S', time.localtime(entry['ts']))
+        return (f"{entry.get('client', '-')} - - [{when}] \"{entry.get('request', '')}\" "
+                f"{entry['status']} {entry.get('bytes', '-')} "
+                f"{entry.get('duration_ms', 0):.1f}ms\n")
+
+
+class TLSContext:
+    """HTTPS 使用的 SSLContext
+
+    所有连接共用同一个 SSLContext：OpenSSL 的服务端会话缓存（TLS 1.2 会话ID）和
+    会话票据密钥（TLS 1.3）都保存在其中，手机切换网络后重连时可以恢复会话，
+    省去完整握手。多进程模式下在 fork 之前创建，工作进程共用票据密钥。
+    证书文件更新后（每 TLS_CERT_CHECK_INTERVAL 秒最多检查一次）用新证书创建
+    新的 SSLContext 并替换，无需重启；替换后已有的会话需要重新完整握手一次。
+    """
+
+    def __init__(self, certfile, keyfile):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self._lock = threading.Lock()
+        self.checked_at = time.monotonic()
+        self.stamp = self._stamp()
+        self.context = self._create()
+
+    def _stamp(self):
+        return tuple(os.stat(path).st_mtime_ns for path in (self.certfile, self.keyfile))
+
+    def _create(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.certfile, self.keyfile)
+        context.set_alpn_protocols(['http/1.1'])
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = TLS_SESSION_TICKETS
+        return context
+
+    def wrap(self, sock):
+        """包装一个已accept的连接（握手由调用方在工作线程中进行）"""
+        self.maybe_reload()
+        return self.context.wrap_socket(sock, server_side=True,
+                                        do_handshake_on_connect=False)
+
+    def maybe_reload(self):
+        """证书或私钥文件的修改时间变化时重新加载"""
+        if time.monotonic() - self.checked_at < TLS_CERT_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if time.monotonic() - self.checked_at < TLS_CERT_CHECK_INTERVAL:
+                return
+            self.checked_at = time.monotonic()
+            try:
+                stamp = self._stamp()
+                if stamp == self.stamp:
+                    return
+                context = self._create()
+            except (OSError, ssl.SSLError) as e:
+                # 证书和私钥可能还没有都写完，下次检查时重试
+                print(f"⚠️  证书重新加载失败，继续使用原证书: {e}", file=sys.stderr)
+                return
+            self.context, self.stamp = context, stamp
+            print(f"🔐 已重新加载证书: {self.certfile}")
+
+
+def bridge_tls_connection(tls_sock, broker, client_address):
+    """把TLS上的WebSocket连接交给MQTT代理
+
+    asyncio 无法接管已完成握手的 SSLSocket，这里创建一对本地socket：一端交给
+    代理，另一端由转发线程与TLS连接双向复制明文。每个 wss:// 连接占用一个
+    转发线程（浏览器端连接数很少；局域网设备使用 ws:// 不经过这里）。
+    """
+    inner, outer = socket.socketpair()
+    broker.adopt(inner.detach(), client_address)
+
+    def pump():
+        tls_sock.settimeout(None)
+        # select.select 不支持编号 >= 1024 的fd（代理会提高文件描述符上限）
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(tls_sock, selectors.EVENT_READ)
+            selector.register(outer, selectors.EVENT_READ)
+            while True:
+                if tls_sock.pending():
+                    readable = [tls_sock]
+                else:
+                    readable = [key.fileobj for key, _ in selector.select()]
+                for sock in readable:
+                    data = sock.recv(COPY_BUFSIZE)
+                    if not data:
+                        return
+                    (outer if sock is tls_sock else tls_sock).sendall(data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            selector.close()
+            outer.close()
+            tls_sock.close()
+
+    threading.Thread(target=pump, name='mqtt-tls-bridge', daemon=True).start()
+
+
+# 一次响应要发送的内容：文件对象及其响应头信息
+Representation = namedtuple('Representation', [
+    'file', 'ctype', 'size', 'mtime', 'last_modified', 'etag', 'encoding', 'vary',
+])
+
+
 class CustomHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """自定义HTTP请求处理器，添加CORS支持"""
-    
+
+    # HTTP/1.1：支持持久连接，页面的十几个请求复用同一个TCP连接
+    protocol_version = 'HTTP/1.1'
+    # 空闲连接超时（socket超时，同时作用于读取请求）
+    timeout = KEEPALIVE_TIMEOUT
+    # 小响应（304、204等）立即发出，不等待Nagle合并
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.tls_failed = False
+        self.handed_over = False    # 连接已交给MQTT代理，不在这里关闭
+        # accept得到的原socket，服务器按它登记处理中的连接（TLS包装后 self.request 会被替换）
+        self.accepted = self.request
+        tls = getattr(self.server, 'tls', None)
+        if tls is not None:
+            self.request = self.start_tls(tls)
+        super().setup()
+        self.requests_handled = 0
+        self.request_started = None
+        self.idle = True        # 正在等待下一个请求（平滑重启时可以直接关闭）
+        self.wfile = CountingWriter(self.wfile)
+        register = getattr(self.server, 'register_handler', None)
+        if register is not None:
+            register(self)
+        self.metrics = getattr(self.server, 'metrics', None)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+    def start_tls(self, tls):
+        """在工作线程中完成TLS握手（不阻塞accept线程），返回TLS连接"""
+        sock = self.request
+        sock.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        metrics = getattr(self.server, 'metrics', None)
+        try:
+            sock = tls.wrap(sock)
+            sock.do_handshake()
+        except (ssl.SSLError, OSError):
+            # 客户端不信任自签名证书、用HTTP访问HTTPS端口等，直接关闭连接
+            self.tls_failed = True
+            if metrics is not None:
+                metrics.tls_failure()
+        else:
+            if metrics is not None:
+                metrics.tls_handshake(sock.session_reused)
+        return sock
+
+    def handle(self):
+        if not self.tls_failed:
+            super().handle()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            # TLS包装后原socket已分离，服务器关闭的是原socket，这里关闭TLS连接
+            if isinstance(self.connection, ssl.SSLSocket) and not self.handed_over:
+                self.connection.close()
+
+    def parse_request(self):
+        self.idle = False
+        self.request_started = time.perf_counter()
+        self.request_bytes_start = self.wfile.count
+        self.response_status = 0
+        if self.metrics is not None:
+            self.metrics.request_started()
+        if not super().parse_request():
+            return False
+        self.requests_handled += 1
+        return True
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    def record_request(self):
+        """请求结束时记录状态码、字节数和耗时（运行指标和访问日志）"""
+        if self.request_started is None:
+            return
+        duration = time.perf_counter() - self.request_started
+        self.request_started = None
+        nbytes = self.wfile.count - self.request_bytes_start
+        path = urllib.parse.urlsplit(getattr(self, 'path', '')).path
+        # 指标接口本身不计入请求统计
+        path_class = None if path == METRICS_PATH else classify_path(path)
+        if self.metrics is not None:
+            self.metrics.request_finished(self.response_status, path_class, nbytes, duration)
+        access_log = getattr(self.server, 'access_log', None)
+        if access_log is not None and path_class is not None and self.response_status:
+            headers = getattr(self, 'headers', None) or {}
+            access_log.record(path, path_class, self.response_status,
+                              client=self.client_address[0],
+                              method=self.command,
+                              request=self.requestline,
+                              bytes=nbytes,
+                              duration_ms=round(duration * 1000, 3),
+                              range=headers.get('Range'),
+                              referer=headers.get('Referer'),
+                              user_agent=headers.get('User-Agent'))
+
     def do_GET(self):
         # 处理favicon.ico请求，避免404错误
         if self.path.startswith('/favicon.ico'):
+            # 204 按定义没有消息体，持久连接上不需要 Content-Length
             self.send_response(204)  # No Content
             self.end_headers()
             return
+        # 接口按路径匹配，忽略查询参数（抓取端常加 ?t=... 防缓存）
+        path = urllib.parse.urlsplit(self.path).path
+        if self.metrics is not None and path == METRICS_PATH:
+            self.send_metrics()
+            return
+        if path == MQTT_PATH:
+            self.handle_mqtt_upgrade()
+            return
+        if path == ANNOTATION_STATS_PATH:
+            self.handle_annotation_stats()
+            return
+        if path == JOURNAL_PATH:
+            self.handle_journal()
+            return
+        if path == PRESENCE_PATH:
+            self.handle_presence()
+            return
         # 处理其他GET请求
-        super().do_GET()
+        # 响应头和文件开头合并到同一批TCP报文中发送，发送完毕后再取消CORK
+        self.set_tcp_cork(True)
+        try:
+            super().do_GET()
+        finally:
+            self.set_tcp_cork(False)
+
+    def send_metrics(self):
+        """输出运行指标"""
+        text = self.metrics.render(getattr(self.server, 'hot_cache', None))
+        # 命令日志的指标由代理一并输出
+        broker = getattr(self.server, 'mqtt_broker', None)
+        if broker is not None:
+            text += '\n'.join(broker.render_metrics()) + '\n'
+        store = getattr(self.server, 'annotation_store', None)
+        if store is not None:
+            text += '\n'.join(store.render_metrics()) + '\n'
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path == ANNOTATIONS_PATH:
+            self.handle_annotations()
+            return
+        if urllib.parse.urlsplit(self.path).path == JOURNAL_REPLAY_PATH:
+            self.handle_journal_replay()
+            return
+        self.send_error(HTTPStatus.NOT_FOUND, "Not found")
+
+    def send_json(self, status, payload):
+        """发送JSON响应（API接口使用）"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_annotations(self):
+        """接收视频标注工具上传的标注，写入并 fsync 后返回每条标注的ID
+
+        请求体可以是单条标注、标注数组或 {"session_id": ..., "annotations": [...]}。
+        响应中 ids 与请求中的标注一一对应，不合法的标注对应 null 并在 rejected 中说明原因。
+        """
+        store = getattr(self.server, 'annotation_store', None)
+        if store is None:
+            # 不读取请求体，响应后关闭连接，否则持久连接上残留的请求体会被当作下一个请求
+            self.close_connection = True
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'annotation store not enabled (start with --annotations DIR)'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.close_connection = True
+            self.send_json(HTTPStatus.LENGTH_REQUIRED, {'error': 'Content-Length required'})
+            return
+        if length < 0 or length > annotation_store.MAX_BODY_BYTES:
+            # 不读取请求体，响应后关闭连接
+            self.close_connection = True
+            self.send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                           {'error': f'body exceeds {annotation_store.MAX_BODY_BYTES} bytes'})
+            return
+        body = self.rfile.read(length)
+        try:
+            records, shared = annotation_store.parse_batch(json.loads(body))
+        except (ValueError, RecursionError) as e:
+            # 嵌套过深的JSON（如 "[" * 100000）在大小限制内也会使解析器递归溢出
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        if len(records) > annotation_store.MAX_BATCH_RECORDS:
+            self.send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                           {'error': f'at most {annotation_store.MAX_BATCH_RECORDS} annotations per request'})
+            return
+
+        accepted, positions, rejected = [], [], []
+        for index, record in enumerate(records):
+            try:
+                accepted.append(annotation_store.normalize_record(record, shared))
+                positions.append(index)
+            except annotation_store.AnnotationError as e:
+                rejected.append({'index': index, 'error': str(e)})
+        if rejected:
+            store.count_rejected(len(rejected))
+
+        ids = [None] * len(records)
+        if accepted:
+            try:
+                for index, record_id in zip(positions, store.append(accepted)):
+                    ids[index] = record_id
+            except queue.Full:
+                self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'annotation store busy'})
+                return
+            except TimeoutError:
+                self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'annotation commit timed out'})
+                return
+            except OSError as e:
+                self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'write failed: {e}'})
+                return
+
+        status = HTTPStatus.BAD_REQUEST if records and not accepted else HTTPStatus.OK
+        self.send_json(status, {'accepted': len(accepted), 'ids': ids, 'rejected': rejected})
+
+    def handle_annotation_stats(self):
+        """标注统计查询
+
+        不带 video 参数时返回所有视频的概况；带 video 时按时间桶统计各标注数量：
+        ?video=X&bucket=5&labels=快点,慢点&start=0&end=120&session=ID
+        """
+        index = getattr(self.server, 'annotation_index', None)
+        if index is None:
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'annotation store not enabled (start with --annotations DIR)'})
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+
+        def param(name):
+            return query[name][0] if name in query else None
+
+        if param('video') is None:
+            self.send_json(HTTPStatus.OK, index.summary())
+            return
+        try:
+            labels = None
+            if param('labels'):
+                # 去重并保持顺序
+                labels = list(dict.fromkeys(
+                    label.strip() for label in param('labels').split(',') if label.strip()))
+            result = index.histogram(
+                param('video'),
+                bucket=float(param('bucket') or annotation_index.DEFAULT_BUCKET_SECONDS),
+                start=float(param('start') or 0),
+                end=float(param('end')) if param('end') else None,
+                labels=labels,
+                session=param('session'))
+        except KeyError:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f"no annotations for video {param('video')!r}"})
+            return
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        self.send_json(HTTPStatus.OK, result)
+
+    def handle_presence(self):
+        """设备在线状态查询
+
+        ?device=ID 查询一个设备；否则返回在线设备（按最后心跳从新到旧），
+        offline=1 同时返回最近离线的设备，limit 限制列表长度。
+        """
+        broker = getattr(self.server, 'mqtt_broker', None)
+        if broker is None or broker.presence is None:
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'presence tracking not enabled (start with --mqtt)'})
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        device_id = query.get('device', [None])[0]
+        try:
+            limit = int(query.get('limit', [DEFAULT_PRESENCE_LIMIT])[0])
+            if not 0 < limit <= MAX_PRESENCE_QUERY:
+                raise ValueError(f'limit 必须在 1-{MAX_PRESENCE_QUERY} 之间')
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        include_offline = query.get('offline', ['0'])[0] not in ('0', 'false', '')
+        try:
+            snapshot = broker.presence_snapshot(device_id, include_offline, limit)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'MQTT broker not responding'})
+            return
+        if snapshot is None:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'no heartbeat from device {device_id!r}'})
+            return
+        self.send_json(HTTPStatus.OK, snapshot)
+
+    def handle_journal(self):
+        """设备控制命令日志查询
+
+        不带 device 参数时返回所有设备的概况；带 device 时返回一段时间内的命令：
+        ?device=ID&start=<Unix秒>&end=<Unix秒>&limit=1000
+        """
+        journal = getattr(self.server, 'command_journal', None)
+        if journal is None:
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'command journal not enabled (start with --mqtt --journal DIR)'})
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+
+        def param(name):
+            return query[name][0] if name in query else None
+
+        if param('device') is None:
+            self.send_json(HTTPStatus.OK, journal.summary())
+            return
+        device = journal.get(param('device'))
+        if device is None:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f"no journal for device {param('device')!r}"})
+            return
+        try:
+            start = float(param('start')) if param('start') else None
+            end = float(param('end')) if param('end') else None
+            limit = int(param('limit') or command_journal.DEFAULT_QUERY_LIMIT)
+            if not 0 < limit <= MAX_JOURNAL_QUERY:
+                raise ValueError(f'limit 必须在 1-{MAX_JOURNAL_QUERY} 之间')
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        lo, hi = device.range(start, end)
+        records = device.copy(lo, hi, limit)
+        self.send_json(HTTPStatus.OK, {
+            'device': device.device_id,
+            'records': [command_journal.record_to_json(record) for record in records],
+            # 下一页从最后一条之后开始
+            'more': bool(records) and records[-1][0] + 1 < hi,
+        })
+
+    def handle_journal_replay(self):
+        """把设备日志中的一段会话重新发给设备
+
+        请求体 {"device": ID, "start": <Unix秒>, "end": <Unix秒>, "speed": 1, "target": ID}，
+        target 默认为 device；{"target": ID, "cancel": true} 停止发往该设备的回放。
+        """
+        journal = getattr(self.server, 'command_journal', None)
+        broker = getattr(self.server, 'mqtt_broker', None)
+        if journal is None or broker is None:
+            # 不读取请求体，响应后关闭连接
+            self.close_connection = True
+            self.send_json(HTTPStatus.NOT_FOUND,
+                           {'error': 'command journal not enabled (start with --mqtt --journal DIR)'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.close_connection = True
+            self.send_json(HTTPStatus.LENGTH_REQUIRED, {'error': 'Content-Length required'})
+            return
+        if length < 0 or length > 64 * 1024:
+            self.close_connection = True
+            self.send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'body too large'})
+            return
+        try:
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('请求体必须是JSON对象')
+            target = request.get('target', request.get('device'))
+            if not isinstance(target, str) or not target:
+                raise ValueError('需要 device 或 target')
+            if request.get('cancel'):
+                broker.cancel_replay(target)
+                self.send_json(HTTPStatus.OK, {'target': target, 'cancelled': True})
+                return
+            start = float(request['start']) if request.get('start') is not None else None
+            end = float(request['end']) if request.get('end') is not None else None
+            speed = float(request.get('speed', 1))
+            if not 0 < speed <= command_journal.REPLAY_MAX_SPEED:
+                raise ValueError(f'speed 必须在 0-{command_journal.REPLAY_MAX_SPEED:g} 之间')
+        except (ValueError, TypeError, RecursionError) as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        device = journal.get(request.get('device', target))
+        if device is None:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f"no journal for device {request.get('device')!r}"})
+            return
+        lo, hi = device.range(start, end)
+        if hi <= lo:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': 'no commands in the given time range'})
+            return
+        first, last = device.timestamp_at(lo), device.timestamp_at(hi - 1)
+        replay_id = broker.start_replay(device, lo, hi, speed, target)
+        self.send_json(HTTPStatus.ACCEPTED, {
+            'replay': replay_id,
+            'device': device.device_id,
+            'target': target,
+            'records': hi - lo,
+            'start': first,
+            'end': last,
+            # 实际时长可能更短：长时间空闲按 REPLAY_MAX_GAP 压缩
+            'duration': (last - first) / speed,
+        })
+
+    def handle_mqtt_upgrade(self):
+        """完成 WebSocket 握手后把连接交给内置MQTT代理，本线程随即返回"""
+        broker = getattr(self.server, 'mqtt_broker', None)
+        if broker is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "MQTT broker not enabled (start with --mqtt)")
+            return
+        key = self.headers.get('Sec-WebSocket-Key')
+        connection = [token.strip().lower()
+                      for token in self.headers.get('Connection', '').split(',')]
+        if (self.headers.get('Upgrade', '').lower() != 'websocket'
+                or 'upgrade' not in connection or not key):
+            self.send_error(HTTPStatus.BAD_REQUEST, "Expected a WebSocket upgrade")
+            return
+        if self.headers.get('Sec-WebSocket-Version') != '13':
+            self.send_response(HTTPStatus.UPGRADE_REQUIRED)
+            self.send_header('Sec-WebSocket-Version', '13')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(HTTPStatus.SWITCHING_PROTOCOLS)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', mqtt_broker.websocket_accept_key(key))
+        subprotocol = mqtt_broker.choose_subprotocol(
+            self.headers.get('Sec-WebSocket-Protocol'))
+        if subprotocol:
+            self.send_header('Sec-WebSocket-Protocol', subprotocol)
+        # 不经过 end_headers 的 CORS/keep-alive 响应头
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+        self.wfile.flush()
+
+        # 客户端收到101后才发送第一个WebSocket帧，rfile中不会有已缓冲的数据
+        self.close_connection = True
+        if isinstance(self.connection, ssl.SSLSocket):
+            self.handed_over = True
+            bridge_tls_connection(self.connection, broker, self.client_address)
+        else:
+            broker.adopt(self.connection.detach(), self.client_address)
+
+    def set_tcp_cork(self, enabled):
+        """设置TCP_CORK（仅Linux支持，其他平台忽略）"""
+        if not hasattr(socket, 'TCP_CORK'):
+            return
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK,
+                                       1 if enabled else 0)
+        except OSError:
+            pass
     
     def end_headers(self):
         # 添加CORS头，用于MQTT测试
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Range')
+        self.send_connection_headers()
         super().end_headers()
 
+    def send_connection_headers(self):
+        """持久连接管理：达到请求上限、线程池繁忙或正在平滑重启时通知客户端关闭连接
+
+        单线程模式下保持连接会阻塞其他客户端，每个响应后都关闭连接。
+        """
+        if self.close_connection:
+            return
+        busy = getattr(self.server, 'is_saturated', None)
+        if (busy is None or busy() or getattr(self.server, 'draining', False)
+                or self.requests_handled >= KEEPALIVE_MAX_REQUESTS):
+            # send_header 会同时设置 close_connection
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Keep-Alive', f'timeout={KEEPALIVE_TIMEOUT}, '
+                             f'max={KEEPALIVE_MAX_REQUESTS - self.requests_handled}')
+
     def do_OPTIONS(self):
         # 处理预检请求
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
+    def send_head(self):
+        """发送响应头，为静态文件增加Range（206 Partial Content）支持
+
+        目录重定向和目录列表仍交给父类处理。
+        """
+        self._ranges = None
+        self._range_trailer = b''
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            index = os.path.join(path, 'index.html')
+            url_path = urllib.parse.urlsplit(self.path).path
+            if not url_path.endswith('/') or not os.path.isfile(index):
+                return super().send_head()
+            path = index
+        if path.endswith('/'):
+            return super().send_head()
+
+        compressible = os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+        rep = self.open_representation(path, compressible)
+        if rep is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        f, ctype, size = rep.file, rep.ctype, rep.size
+
+        try:
+            if self.is_not_modified(rep):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_cache_headers(rep)
+                self.end_headers()
+                f.close()
+                return None
+
+            ranges = self.get_requested_ranges(rep)
+            if ranges is None:
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Length", str(size))
+            elif not ranges:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                f.close()
+                return None
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self._ranges = [(start, end, b'')]
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", str(end - start + 1))
+            else:
+                # 多区间：multipart/byteranges
+                boundary = secrets.token_hex(16)
+                self._ranges = []
+                length = 0
+                for start, end in ranges:
+                    part_header = (f"\r\n--{boundary}\r\n"
+                                   f"Content-Type: {ctype}\r\n"
+                                   f"Content-Range: bytes {start}-{end}/{size}\r\n"
+                                   f"\r\n").encode('latin-1')
+                    self._ranges.append((start, end, part_header))
+                    length += len(part_header) + end - start + 1
+                self._range_trailer = f"\r\n--{boundary}--\r\n".encode('latin-1')
+                length += len(self._range_trailer)
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-type",
+                                 f"multipart/byteranges; boundary={boundary}")
+                self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            if rep.encoding is not None:
+                self.send_header("Content-Encoding", rep.encoding)
+            self.send_cache_headers(rep)
+            self.end_headers()
+            return f
+        except:
+            f.close()
+            raise
+
+    def send_cache_headers(self, rep):
+        """发送验证和缓存相关的响应头（200/206/304共用）"""
+        self.send_header("ETag", rep.etag)
+        self.send_header("Last-Modified", rep.last_modified)
+        self.send_header("Cache-Control",
+                         self.cache_control_for(urllib.parse.urlsplit(self.path).path))
+        if rep.vary:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def cache_control_for(self, url_path):
+        """按资源清单和 CACHE_CONTROL_RULES 返回URL路径对应的 Cache-Control"""
+        if url_path in getattr(self.server, 'immutable_paths', ()):
+            return IMMUTABLE_CACHE_CONTROL
+        for prefix, value in CACHE_CONTROL_RULES:
+            if url_path.startswith(prefix):
+                return value
+        return DEFAULT_CACHE_CONTROL
+
+    def acceptable_encodings(self):
+        """按客户端偏好（同等q值时 br 优先）返回可用的压缩编码
+
+        Range请求只针对原始内容，不做压缩协商。
+        """
+        if self.command == 'GET' and 'Range' in self.headers:
+            return []
+        accepted = parse_accept_encoding(self.headers.get('Accept-Encoding', ''))
+        wildcard = accepted.get('*', 0.0)
+        candidates = []
+        for preference, encoding in enumerate(('br', 'gzip')):
+            q = accepted.get(encoding, wildcard)
+            if q > 0:
+                candidates.append((-q, preference, encoding))
+        return [encoding for _, _, encoding in sorted(candidates)]
+
+    def open_representation(self, path, compressible):
+        """选择并打开要发送的内容
+
+        返回 Representation，文件不存在时返回 None。依次尝试：缓存中的压缩内容
+        （含实时压缩）、磁盘上的预压缩文件、缓存中的原文件、磁盘上的原文件。
+        """
+        cache = getattr(self.server, 'hot_cache', None)
+        encodings = self.acceptable_encodings() if compressible else []
+        if cache is not None:
+            for encoding in encodings + [None]:
+                entry = cache.get(path, self.guess_type, self.date_time_string, encoding)
+                if entry is not None:
+                    return Representation(io.BytesIO(entry.body), entry.ctype,
+                                          len(entry.body), entry.mtime,
+                                          entry.last_modified, entry.etag,
+                                          encoding, compressible)
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            ctype = self.guess_type(path)
+            last_modified = self.date_time_string(fs.st_mtime)
+            for encoding in encodings:
+                variant = find_precompressed(path, fs.st_mtime, encoding)
+                if variant is None:
+                    continue
+                try:
+                    vf = open(variant, 'rb')
+                except OSError:
+                    continue
+                f.close()
+                return Representation(vf, ctype, os.fstat(vf.fileno()).st_size,
+                                      fs.st_mtime, last_modified,
+                                      make_etag(fs, encoding), encoding, compressible)
+            return Representation(f, ctype, fs.st_size, fs.st_mtime, last_modified,
+                                  make_etag(fs), None, compressible)
+        except:
+            f.close()
+            raise
+
+    def is_not_modified(self, rep):
+        """根据 If-None-Match / If-Modified-Since 判断是否可以返回304
+
+        两者同时存在时只使用 If-None-Match。
+        """
+        if "If-None-Match" in self.headers:
+            return etag_matches(self.headers["If-None-Match"], rep.etag)
+        if "If-Modified-Since" not in self.headers:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(
+                self.headers["If-Modified-Since"])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            # 忽略格式错误的值
+            return False
+        if ims.tzinfo is None:
+            ims = ims.replace(tzinfo=datetime.timezone.utc)
+        if ims.tzinfo is not datetime.timezone.utc:
+            return False
+        last_modif = datetime.datetime.fromtimestamp(
+            rep.mtime, datetime.timezone.utc).replace(microsecond=0)
+        return last_modif <= ims
+
+    def get_requested_ranges(self, rep):
+        """解析本次请求的Range，返回值含义同 parse_range_header
+
+        只有GET请求处理Range；If-Range（ETag或日期）与当前文件不一致时
+        说明文件已变化，忽略Range返回完整内容。
+        """
+        value = self.headers.get("Range")
+        if self.command != 'GET' or not value:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range.strip() not in (rep.etag, rep.last_modified):
+            return None
+        return parse_range_header(value, rep.size)
+
+    def copy_ranges(self, source, outputfile):
+        """按 send_head 计算出的区间发送文件内容"""
+        for start, end, part_header in self._ranges:
+            if part_header:
+                outputfile.write(part_header)
+            self.send_file_range(source, outputfile, start, end - start + 1)
+        if self._range_trailer:
+            outputfile.write(self._range_trailer)
+
+    def send_file_range(self, source, outputfile, offset, count):
+        """发送文件从 offset 开始的 count 字节（count 为 None 表示到文件末尾）
+
+        直接写socket时使用 socket.sendfile（Linux上为 os.sendfile 零拷贝，
+        TLS连接会自动退回普通发送）；输出不是socket时使用缓冲复制。
+        """
+        if isinstance(source, io.BytesIO):
+            # 缓存中的文件：直接写出内存视图，避免再复制一次
+            with source.getbuffer() as view:
+                end = len(view) if count is None else offset + count
+                outputfile.write(view[offset:end])
+            return
+
+        if USE_SENDFILE and outputfile is self.wfile:
+            try:
+                source.fileno()
+            except (AttributeError, OSError, ValueError):
+                pass
+            else:
+                self.wfile.add(self.connection.sendfile(source, offset, count))
+                return
+
+        source.seek(offset)
+        remaining = count
+        while remaining is None or remaining > 0:
+            size = COPY_BUFSIZE if remaining is None else min(COPY_BUFSIZE, remaining)
+            buf = source.read(size)
+            if not buf:
+                break
+            outputfile.write(buf)
+            if remaining is not None:
+                remaining -= len(buf)
+
     def copyfile(self, source, outputfile):
-        """重写文件复制方法，优雅处理客户端断开连接"""
+        """重写文件复制方法，支持Range和零拷贝发送，并优雅处理客户端断开连接"""
         try:
-            super().copyfile(source, outputfile)
+            if getattr(self, '_ranges', None):
+                self.copy_ranges(source, outputfile)
+            else:
+                self.send_file_range(source, outputfile, 0, None)
         except BrokenPipeError:
             # 客户端在传输完成前断开连接（如刷新页面、关闭标签）
             # 这是正常情况，不需要记录错误
-            pass
+            self.count_broken_pipe()
         except OSError as e:
             # 其他系统错误，只在非BrokenPipeError时记录
             if e.errno != 32:  # 32是BrokenPipeError的errno
                 raise
+            self.count_broken_pipe()
+
+    def count_broken_pipe(self):
+        if self.metrics is not None:
+            self.metrics.broken_pipe()
     
+    def log_request(self, code='-', size='-'):
+        """访问日志在请求结束后由 record_request 交给后台线程写出"""
+        if getattr(self.server, 'access_log', None) is None:
+            super().log_request(code, size)
+
     def log_message(self, format, *args):
-        """重写日志方法，避免某些请求导致错误，并过滤favicon.ico请求"""
+        """重写日志方法，避免某些请求导致错误，并过滤 ACCESS_LOG_EXCLUDE 中的路径"""
         try:
-            # 过滤favicon.ico请求，避免日志中的404错误
-            if args and '/favicon.ico' in str(args[0]):
+            # 过滤favicon.ico等请求，避免日志中的404错误
+            if args and any(prefix in str(args[0]) for prefix in ACCESS_LOG_EXCLUDE):
                 return
             super().log_message(format, *args)
         except (UnicodeEncodeError, OSError) as e:
@@ -96,18 +1644,26 @@ class CustomHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         """重写请求处理方法，捕获BrokenPipeError"""
         try:
             super().handle_one_request()
-        except BrokenPipeError:
-            # 客户端断开连接，这是正常情况（如刷新页面）
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端断开连接，这是正常情况（如刷新页面、关闭空闲的持久连接）
             # 不记录错误，静默处理
-            pass
+            self.close_connection = True
+            self.count_broken_pipe()
+        except ssl.SSLError:
+            # TLS连接被客户端直接断开（没有发送close_notify），同样静默处理
+            self.close_connection = True
         except OSError as e:
             # 检查是否是BrokenPipeError (errno 32)
             if e.errno == 32:
                 # 客户端断开连接，静默处理
-                pass
+                self.close_connection = True
+                self.count_broken_pipe()
             else:
                 # 其他OSError，正常抛出
                 raise
+        finally:
+            self.record_request()
+            self.idle = True
     
     def log_error(self, format, *args):
         """重写错误日志方法，优雅处理错误"""
@@ -119,33 +1675,447 @@ class CustomHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 if "Broken pipe" in error_msg or "BrokenPipeError" in error_msg:
                     # 不记录BrokenPipeError，这是正常情况
                     return
+            if format.startswith("Request timed out"):
+                # 持久连接空闲超时，正常关闭
+                return
             super().log_error(format, *args)
         except (UnicodeEncodeError, OSError):
             # 忽略编码错误
             pass
 
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """有界线程池HTTP服务器
+
+    主线程只负责accept，连接放入有界队列，由固定数量的工作线程处理。
+    同时处理的连接数不超过 max_workers，排队的连接不超过 queue_size，
+    队列满时立即返回 503，避免无限制地创建线程。
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_workers=MAX_WORKERS, queue_size=REQUEST_QUEUE_SIZE,
+                 bind_and_activate=True):
+        self.max_workers = max(1, max_workers)
+        self.queue_size = max(1, queue_size)
+        # listen() 的 backlog 与等待队列保持一致（默认值5太小）
+        self.request_queue_size = self.queue_size
+        self._requests = queue.Queue(maxsize=self.queue_size)
+        self._workers = []
+        self._active = {}       # 处理中的连接 -> 请求处理器（处理器创建前为 None）
+        self._active_lock = threading.Lock()
+        self.draining = False
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop,
+                                      name=f'http-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """将连接放入等待队列，队列满时拒绝"""
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject_request(request)
+
+    def is_saturated(self):
+        """是否有连接在排队等待工作线程（此时不再保持空闲的持久连接）"""
+        return not self._requests.empty()
+
+    def reject_request(self, request):
+        """队列已满，返回503并关闭连接"""
+        try:
+            request.sendall(b'HTTP/1.0 503 Service Unavailable\r\n'
+                            b'Retry-After: 1\r\n'
+                            b'Content-Length: 0\r\n'
+                            b'Connection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker_loop(self):
+        """工作线程：从队列中取出连接并处理"""
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            with self._active_lock:
+                self._active[request] = None
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._active_lock:
+                    self._active.pop(request, None)
+                self.shutdown_request(request)
+
+    def register_handler(self, handler):
+        """请求处理器创建时登记，平滑重启时用于找出空闲的持久连接"""
+        with self._active_lock:
+            if handler.accepted in self._active:
+                self._active[handler.accepted] = handler
+
+    def close_idle_connections(self):
+        """关闭正在等待下一个请求的持久连接（已经发来请求数据的除外）"""
+        with self._active_lock:
+            handlers = [handler for handler in self._active.values()
+                        if handler is not None and handler.idle and handler.requests_handled]
+        if not handlers:
+            return
+        with selectors.DefaultSelector() as selector:
+            for handler in handlers:
+                try:
+                    selector.register(handler.connection, selectors.EVENT_READ, handler)
+                except (OSError, ValueError, KeyError):
+                    pass    # 连接已被工作线程关闭
+            # 有数据到达的连接让工作线程处理完这个请求
+            readable = {key.data for key, _ in selector.select(0)}
+            for key in list(selector.get_map().values()):
+                handler = key.data
+                if handler in readable or (isinstance(handler.connection, ssl.SSLSocket)
+                                           and handler.connection.pending()):
+                    continue
+                try:
+                    # 空闲连接没有待发送的数据，双向关闭底层socket：工作线程读到EOF后正常结束该连接，
+                    # 客户端收到FIN（只关闭读方向时TLS客户端会收到 decode_error 告警）
+                    socket.socket.shutdown(handler.connection, socket.SHUT_RDWR)
+                except (OSError, ValueError):
+                    pass
+
+    def drain(self, timeout):
+        """停止accept后调用：等待排队和处理中的连接完成，返回是否在 timeout 秒内完成"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.close_idle_connections()
+            with self._active_lock:
+                busy = bool(self._active)
+            if not busy and self._requests.empty():
+                return True
+            time.sleep(0.1)
+        return False
+
+    def server_close(self):
+        super().server_close()
+        # 关闭尚未处理的连接，并通知工作线程退出
+        while True:
+            try:
+                item = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        for _ in self._workers:
+            try:
+                self._requests.put_nowait(None)
+            except queue.Full:
+                break
+
+
+def create_listen_socket(options, reuse_port=False):
+    """创建监听socket
+
+    设置 SO_REUSEADDR（重启时不受TIME_WAIT影响）；reuse_port 为 True 时还设置
+    SO_REUSEPORT，允许多个工作进程各自绑定同一端口，由内核在它们之间分配连接。
+    """
+    inherited = os.environ.pop('SERVER_LISTEN_FD', None)
+    if inherited is not None:
+        # 平滑重启：使用旧进程传过来的监听socket，端口始终处于监听状态
+        return socket.socket(fileno=int(inherited))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((HOST, PORT))
+        sock.listen(options.queue)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def create_server(options, sock):
+    """根据并发模式创建HTTP服务器，使用已创建好的监听socket"""
+    if options.mode == 'single':
+        httpd = socketserver.TCPServer(sock.getsockname(), CustomHTTPRequestHandler,
+                                       bind_and_activate=False)
+    else:
+        httpd = ThreadPoolHTTPServer(sock.getsockname(), CustomHTTPRequestHandler,
+                                     max_workers=options.threads,
+                                     queue_size=options.queue,
+                                     bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    cache_bytes = int(options.cache_size * 1024 * 1024)
+    httpd.hot_cache = HotAssetCache(max_bytes=cache_bytes) if cache_bytes > 0 else None
+    httpd.metrics = ServerMetrics() if options.metrics else None
+    httpd.tls = options.tls
+    httpd.immutable_paths = options.immutable_paths
+    httpd.draining = False
+    httpd.access_log = AccessLog(options.access_log)
+    httpd.annotation_store = None
+    httpd.annotation_index = None
+    if options.annotations:
+        httpd.annotation_store = annotation_store.AnnotationStore(options.annotations)
+        httpd.annotation_index = annotation_index.AnnotationIndex(options.annotations)
+        httpd.annotation_index.warm()
+    httpd.mqtt_broker = None
+    httpd.command_journal = None
+    if options.mqtt:
+        if options.journal:
+            httpd.command_journal = command_journal.CommandJournal(
+                options.journal, capacity=options.journal_records)
+        httpd.mqtt_broker = mqtt_broker.MQTTBroker(coalesce_rate=options.mqtt_coalesce,
+                                                   journal=httpd.command_journal,
+                                                   presence_timeout=options.presence_timeout)
+        httpd.mqtt_broker.start()
+    return httpd
+
+def is_reload_successor():
+    """当前进程是否由 reload 启动（旧进程仍占用端口）"""
+    return 'SERVER_READY_FD' in os.environ
+
+def notify_ready():
+    """通知旧进程：新进程已开始服务"""
+    fd = os.environ.pop('SERVER_READY_FD', None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b'1')
+        os.close(int(fd))
+    except OSError:
+        pass
+
+def spawn_successor(options, listen_sock):
+    """平滑重启：以相同参数启动新的服务器进程，并把监听socket交给它（fd继承）
+
+    listen_sock 为 None 时（--reuseport）新进程自己绑定端口。返回新进程是否在
+    RELOAD_READY_TIMEOUT 秒内就绪；未就绪时结束新进程，当前进程继续服务。
+    """
+    print("🔄 正在启动新的服务器进程...")
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ, SERVER_READY_FD=str(write_fd))
+    pass_fds = [write_fd]
+    if listen_sock is not None:
+        env['SERVER_LISTEN_FD'] = str(listen_sock.fileno())
+        pass_fds.append(listen_sock.fileno())
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve())] + sys.argv[1:],
+                                cwd=options.launch_dir, env=env, pass_fds=pass_fds)
+    except OSError as e:
+        print(f"❌ 无法启动新的服务器进程: {e}")
+        os.close(read_fd)
+        os.close(write_fd)
+        return False
+    os.close(write_fd)
+    try:
+        # 新进程退出时管道写端关闭，read 返回空
+        with selectors.DefaultSelector() as selector:
+            selector.register(read_fd, selectors.EVENT_READ)
+            readable = selector.select(RELOAD_READY_TIMEOUT)
+        ready = bool(readable) and os.read(read_fd, 1) == b'1'
+    finally:
+        os.close(read_fd)
+    if not ready:
+        print("❌ 新服务器进程未能就绪，继续使用当前进程")
+        if proc.poll() is None:
+            proc.kill()
+        return False
+    print(f"✅ 新服务器进程 {proc.pid} 已接管端口，当前进程 {os.getpid()} 不再接受新连接，"
+          f"等待处理中的请求完成（最多 {RELOAD_DRAIN_TIMEOUT} 秒）")
+    return True
+
+def drain_server(httpd):
+    """平滑重启时等待处理中的请求完成（单线程模式下 serve_forever 返回时已经完成）"""
+    drain = getattr(httpd, 'drain', None)
+    if drain is not None and not drain(RELOAD_DRAIN_TIMEOUT):
+        print(f"⚠️  进程 {os.getpid()}: {RELOAD_DRAIN_TIMEOUT} 秒内仍有未完成的请求，强制关闭")
+
+def print_cache_stats(cache):
+    """打印热点文件缓存计数器"""
+    if cache is None:
+        return
+    stats = cache.stats()
+    print(f"📊 缓存统计: 命中 {stats['hits']}, 未命中 {stats['misses']}, "
+          f"淘汰 {stats['evictions']}, 失效 {stats['invalidations']}, "
+          f"{stats['entries']} 个文件 / {stats['bytes'] / 1024:.0f} KB")
+
+def run_worker(options, listen_sock):
+    """工作进程：运行一个完整的HTTP服务器，收到SIGTERM后退出
+
+    listen_sock 为 None 时（--reuseport）由工作进程自己绑定端口。
+    """
+    # Ctrl+C 由主进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if listen_sock is None:
+        listen_sock = create_listen_socket(options, reuse_port=True)
+    else:
+        # 多个进程共享监听socket：连接被其他进程抢先accept时不阻塞
+        listen_sock.setblocking(False)
+
+    with create_server(options, listen_sock) as httpd:
+        def request_stop(signum, frame):
+            # shutdown() 会等待 serve_forever 退出，不能在同一线程中调用
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+        def request_drain(signum, frame):
+            # 平滑重启：停止accept，处理完剩余请求后退出
+            httpd.draining = True
+            request_stop(signum, frame)
+
+        signal.signal(signal.SIGTERM, request_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, request_drain)
+        httpd.serve_forever()
+        if httpd.draining:
+            drain_server(httpd)
+        httpd.access_log.close()
+        if httpd.annotation_store is not None:
+            httpd.annotation_store.close()
+
+
+class PreforkMaster:
+    """多进程（pre-fork）模式的主进程
+
+    主进程创建监听socket后fork出N个工作进程，工作进程共享该socket，各自运行
+    线程池（或单线程）HTTP服务器。主进程不处理请求，只负责监控：工作进程
+    意外退出时自动重启；收到SIGTERM/SIGINT时通知所有工作进程退出；收到SIGHUP
+    时启动新的主进程并交出监听socket，新主进程就绪后通知工作进程处理完剩余
+    请求再退出。
+    """
+
+    def __init__(self, options, listen_sock):
+        self.options = options
+        self.listen_sock = listen_sock
+        self.workers = {}   # pid -> 启动时间
+        self.running = True
+
+    def spawn_worker(self):
+        # 避免未输出的缓冲内容在子进程中重复输出
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(self.options, self.listen_sock)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                # 不执行主进程的清理逻辑（如删除PID文件）
+                os._exit(exit_code)
+        self.workers[pid] = time.monotonic()
+        return pid
+
+    def save_pids(self):
+        save_server_pid(os.getpid(), sorted(self.workers))
+
+    def stop(self, signum=None, frame=None):
+        """通知所有工作进程退出"""
+        self.running = False
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reload(self, signum=None, frame=None):
+        """平滑重启：新主进程就绪后通知工作进程停止accept并处理完剩余请求"""
+        if not self.running:
+            return
+        if spawn_successor(self.options, self.listen_sock):
+            self.running = False
+            for pid in list(self.workers):
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                except ProcessLookupError:
+                    pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload)
+        for _ in range(self.options.workers):
+            self.spawn_worker()
+        self.save_pids()
+        notify_ready()
+        print(f"👷 已启动 {len(self.workers)} 个工作进程: "
+              f"{', '.join(str(pid) for pid in sorted(self.workers))}")
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_at = self.workers.pop(pid, None)
+            if started_at is None or not self.running:
+                continue
+            print(f"⚠️  工作进程 {pid} 意外退出 (状态 {status})，正在重启...")
+            if time.monotonic() - started_at < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            if self.running:
+                new_pid = self.spawn_worker()
+                self.save_pids()
+                print(f"👷 新工作进程: {new_pid}")
+
+def use_port(port):
+    """切换端口（--port）：非默认端口使用单独的PID文件，可与默认端口的服务器同时运行"""
+    global PORT, PID_FILE
+    if port != PORT:
+        PORT = port
+        PID_FILE = f'.server-{port}.pid'
+
+def stop_command():
+    """停止服务器的命令（非默认端口需要带 --port）"""
+    return 'python3 server.py stop' + ('' if PID_FILE == '.server.pid' else f' --port {PORT}')
+
 def get_pid_file_path():
     """获取PID文件路径"""
     script_dir = Path(__file__).parent
-    return script_dir / '.server.pid'
+    return script_dir / PID_FILE
 
-def get_server_pid():
-    """读取服务器进程ID"""
+def read_pid_file():
+    """读取PID文件，返回 {'master': PID, 'workers': [PID, ...]}，不存在时返回 None
+
+    兼容旧格式（文件中只有一个PID）。
+    """
     pid_file = get_pid_file_path()
     if pid_file.exists():
         try:
             with open(pid_file, 'r') as f:
-                return int(f.read().strip())
-        except (ValueError, IOError):
+                content = f.read().strip()
+            if content.startswith('{'):
+                data = json.loads(content)
+                return {'master': int(data['master']),
+                        'workers': [int(pid) for pid in data.get('workers', [])]}
+            return {'master': int(content), 'workers': []}
+        except (ValueError, KeyError, TypeError, IOError):
             return None
     return None
 
-def save_server_pid(pid):
-    """保存服务器进程ID"""
+def get_server_pid():
+    """读取服务器（主）进程ID"""
+    info = read_pid_file()
+    return info['master'] if info else None
+
+def get_worker_pids():
+    """读取工作进程ID列表（单进程模式下为空）"""
+    info = read_pid_file()
+    return info['workers'] if info else []
+
+def save_server_pid(pid, workers=None):
+    """保存服务器进程ID（多进程模式下同时保存工作进程ID）"""
     pid_file = get_pid_file_path()
     try:
         with open(pid_file, 'w') as f:
-            f.write(str(pid))
+            json.dump({'master': pid, 'workers': workers or []}, f)
     except IOError as e:
         print(f"警告: 无法保存PID文件: {e}")
 
@@ -162,21 +2132,38 @@ def is_port_in_use(port):
     """检查端口是否被占用"""
     import socket
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # 与监听socket一致，忽略上次运行残留的TIME_WAIT连接
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             s.bind(('0.0.0.0', port))  # 检查所有接口
             return False
         except OSError:
             return True
 
-def start_server():
+def start_server(options=None):
     """启动开发服务器"""
-    # 检查端口是否被占用
-    if is_port_in_use(PORT):
+    if options is None:
+        options = parse_start_options([])
+    use_port(options.port)
+
+    if options.workers > 1 and not hasattr(os, 'fork'):
+        print("❌ 当前系统不支持多进程模式 (--workers)，请使用单进程模式")
+        sys.exit(1)
+    if options.reuseport and not hasattr(socket, 'SO_REUSEPORT'):
+        print("❌ 当前系统不支持 SO_REUSEPORT (--reuseport)")
+        sys.exit(1)
+    if options.mqtt and options.workers > 1:
+        # 每个工作进程只能转发自己接管的连接，订阅者和发布者必须在同一进程中
+        print("❌ 内置MQTT代理 (--mqtt) 只能在单进程模式下使用")
+        sys.exit(1)
+
+    # 检查端口是否被占用（平滑重启时端口由旧进程交过来，跳过检查）
+    if not is_reload_successor() and is_port_in_use(PORT):
         pid = get_server_pid()
         if pid and is_process_running(pid):
             print(f"❌ 端口 {PORT} 已被占用")
             print(f"服务器可能正在运行中 (PID: {pid})")
-            print("💡 提示: 使用 'python3 server.py stop' 停止服务器")
+            print(f"💡 提示: 使用 '{stop_command()}' 停止服务器")
             sys.exit(1)
         else:
             print(f"⚠️  端口 {PORT} 被占用，但找不到服务器进程")
@@ -185,20 +2172,108 @@ def start_server():
             print(f"   或:   kill -9 $(lsof -ti:{PORT})")
             sys.exit(1)
     
-    # 检查web-prototype目录是否存在
+    # 检查web-prototype目录是否存在（--root 可指定其他目录，如发布目录）
     script_dir = Path(__file__).parent
-    web_prototype_dir = script_dir / 'web-prototype'
+    if options.root:
+        web_prototype_dir = Path(options.root).resolve()
+    else:
+        web_prototype_dir = script_dir / 'web-prototype'
     
     if not web_prototype_dir.exists():
         print(f"❌ 错误: 找不到 {web_prototype_dir} 目录")
         print("请确保从项目根目录运行此脚本")
         sys.exit(1)
     
+    # 平滑重启时新进程在同一目录下以相同参数启动
+    options.launch_dir = os.getcwd()
+
+    # 访问日志和标注存储的路径相对于启动时的当前目录
+    if options.access_log:
+        options.access_log = os.path.abspath(options.access_log)
+    if options.annotations:
+        options.annotations = os.path.abspath(options.annotations)
+    if options.journal:
+        options.journal = os.path.abspath(options.journal)
+
+    # 获取本机IP地址用于显示（自签名证书也包含这个地址）
+    local_ip = get_local_ip()
+
+    # HTTPS：在fork之前创建SSLContext，工作进程共用会话票据密钥
+    options.tls = None
+    options.scheme = 'http'
+    if options.https:
+        options.tls = load_tls_context(options, local_ip)
+        options.scheme = 'https'
+
     # 切换到web-prototype目录
     os.chdir(web_prototype_dir)
+    options.immutable_paths = load_asset_manifest(web_prototype_dir)
     
-    # 获取本机IP地址用于显示
-    import socket
+    scheme = options.scheme
+    print("🚀 正在启动智能飞机杯控制原型服务器...")
+    print(f"📁 服务目录: {web_prototype_dir}")
+    print(f"🌐 本地访问: {scheme}://localhost:{PORT}")
+    if local_ip != 'localhost':
+        print(f"📱 网络访问: {scheme}://{local_ip}:{PORT}")
+    print(f"📱 演示页面: {scheme}://{local_ip}:{PORT}/demo.html")
+    print(f"🎮 主应用: {scheme}://{local_ip}:{PORT}/index.html")
+    if options.immutable_paths:
+        print(f"📌 资源清单: {len(options.immutable_paths)} 个带内容哈希的文件（长期缓存）")
+    if options.tls:
+        print(f"🔐 HTTPS证书: {options.tls.certfile}（文件更新后自动重新加载）")
+    if options.mode == 'pool':
+        print(f"🧵 并发模式: 线程池 (线程数 {options.threads}, 队列深度 {options.queue})")
+    else:
+        print("🧵 并发模式: 单线程")
+    if options.workers > 1:
+        print(f"👷 多进程模式: {options.workers} 个工作进程"
+              f"{' (SO_REUSEPORT)' if options.reuseport else ''}")
+    if options.mqtt:
+        print(f"📡 MQTT代理: {'wss' if options.tls else 'ws'}://{local_ip}:{PORT}{MQTT_PATH}"
+              + (f" (控制消息合并 {options.mqtt_coalesce:g} Hz)" if options.mqtt_coalesce > 0 else ""))
+        if options.presence_timeout > 0:
+            print(f"💓 在线状态: {options.presence_timeout:g} 秒没有心跳判定离线 (GET {PRESENCE_PATH})")
+    if options.access_log:
+        print(f"📝 访问日志: {options.access_log}")
+    if options.annotations:
+        print(f"🏷️  标注存储: {options.annotations} (POST {ANNOTATIONS_PATH})")
+    if options.journal:
+        print(f"📼 命令日志: {options.journal} (每个设备 {options.journal_records} 条, GET {JOURNAL_PATH})")
+    print(f"⏹️  停止服务器: {stop_command()}")
+    print("-" * 60)
+    
+    # 启动服务器
+    try:
+        if options.workers > 1:
+            serve_prefork(options)
+        else:
+            serve_single_process(options)
+    except Exception as e:
+        print(f"❌ 启动服务器失败: {e}")
+        sys.exit(1)
+    finally:
+        # 清理PID文件（平滑重启后PID文件已属于新进程）
+        if get_server_pid() in (None, os.getpid()):
+            remove_pid_file()
+        print("✅ 服务器已停止")
+
+def load_asset_manifest(directory):
+    """读取服务目录中的资源清单，返回带内容哈希的文件的URL路径集合
+
+    开发目录（web-prototype）没有清单，返回空集合，所有文件按 CACHE_CONTROL_RULES 处理。
+    """
+    try:
+        with open(os.path.join(directory, ASSET_MANIFEST), encoding='utf-8') as f:
+            assets = json.load(f)['assets']
+        return frozenset('/' + name.lstrip('/') for name in assets.values())
+    except FileNotFoundError:
+        return frozenset()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"⚠️  资源清单 {ASSET_MANIFEST} 无效，不使用长期缓存: {e}")
+        return frozenset()
+
+def get_local_ip():
+    """获取本机局域网IP地址，获取失败时返回 'localhost'"""
     try:
         # 连接到外部地址（不实际发送数据）来获取本机IP
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -207,48 +2282,152 @@ def start_server():
         s.close()
     except:
         local_ip = 'localhost'
-    
-    print("🚀 正在启动智能飞机杯控制原型服务器...")
-    print(f"📁 服务目录: {web_prototype_dir}")
-    print(f"🌐 本地访问: http://localhost:{PORT}")
+    return local_ip
+
+def default_cert_paths():
+    """自签名证书和私钥的默认路径"""
+    cert_dir = Path(__file__).resolve().parent / CERT_DIR
+    return str(cert_dir / 'server.crt'), str(cert_dir / 'server.key')
+
+def generate_self_signed_cert(certfile, keyfile, local_ip):
+    """用 openssl 命令生成本地开发用的自签名证书
+
+    使用 ECDSA P-256 密钥（握手比RSA快），证书包含 localhost、127.0.0.1
+    和本机局域网IP，手机通过局域网地址访问时只需信任一次。
+    """
+    names = ['DNS:localhost', 'IP:127.0.0.1']
+    hostname = socket.gethostname()
+    if hostname and hostname != 'localhost':
+        names.append(f'DNS:{hostname}')
     if local_ip != 'localhost':
-        print(f"📱 网络访问: http://{local_ip}:{PORT}")
-    print(f"📱 演示页面: http://{local_ip}:{PORT}/demo.html")
-    print(f"🎮 主应用: http://{local_ip}:{PORT}/index.html")
-    print(f"⏹️  停止服务器: python3 server.py stop")
-    print("-" * 60)
-    
-    # 启动服务器
-    try:
-        with socketserver.TCPServer((HOST, PORT), CustomHTTPRequestHandler) as httpd:
-            # 保存进程ID
-            save_server_pid(os.getpid())
-            
-            # 尝试自动打开浏览器
+        names.append(f'IP:{local_ip}')
+    os.makedirs(os.path.dirname(certfile), exist_ok=True)
+    os.makedirs(os.path.dirname(keyfile), exist_ok=True)
+    # 先写入临时文件再替换，运行中的服务器不会读到写了一半的证书
+    tmp_cert, tmp_key = certfile + '.tmp', keyfile + '.tmp'
+    subprocess.run(['openssl', 'req', '-x509', '-nodes',
+                    '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-keyout', tmp_key, '-out', tmp_cert,
+                    '-days', str(SELF_SIGNED_DAYS),
+                    '-subj', '/CN=Smart Control Dev Server',
+                    '-addext', 'subjectAltName=' + ','.join(names)],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.chmod(tmp_key, 0o600)
+    os.replace(tmp_key, keyfile)
+    os.replace(tmp_cert, certfile)
+    return names
+
+def load_tls_context(options, local_ip):
+    """加载 --cert/--key 指定的证书，未指定且默认证书不存在时生成自签名证书"""
+    if options.cert:
+        certfile = os.path.abspath(options.cert)
+        keyfile = os.path.abspath(options.key or options.cert)
+    else:
+        certfile, keyfile = default_cert_paths()
+        if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+            print("🔐 未找到证书，正在生成自签名证书...")
             try:
-                webbrowser.open(f'http://{HOST}:{PORT}/demo.html')
-                print("🌐 已在浏览器中打开演示页面")
-            except:
-                pass
-            
-            print(f"✅ 服务器已启动，正在监听端口 {PORT}...")
-            print("   (按 Ctrl+C 停止服务器)")
-            
+                generate_self_signed_cert(certfile, keyfile, local_ip)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"❌ 生成自签名证书失败: {e}")
+                print("💡 提示: 请安装 openssl，或用 --cert/--key 指定已有证书")
+                sys.exit(1)
+    try:
+        return TLSContext(certfile, keyfile)
+    except (OSError, ssl.SSLError) as e:
+        print(f"❌ 加载证书失败: {e}")
+        sys.exit(1)
+
+def generate_cert_command():
+    """重新生成自签名证书（本机IP变化后使用，运行中的服务器会自动加载新证书）"""
+    certfile, keyfile = default_cert_paths()
+    try:
+        names = generate_self_signed_cert(certfile, keyfile, get_local_ip())
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"❌ 生成自签名证书失败: {e}")
+        sys.exit(1)
+    print(f"✅ 已生成自签名证书: {certfile}")
+    print(f"   私钥: {keyfile}")
+    print(f"   包含地址: {', '.join(name.split(':', 1)[1] for name in names)}")
+    print(f"   有效期: {SELF_SIGNED_DAYS} 天")
+    print("💡 提示: 首次访问时浏览器会提示证书不受信任，确认继续即可")
+
+def open_browser(options):
+    """尝试自动打开浏览器"""
+    if options.no_browser or is_reload_successor():
+        return
+    try:
+        webbrowser.open(f'{options.scheme}://{HOST}:{PORT}/demo.html')
+        print("🌐 已在浏览器中打开演示页面")
+    except:
+        pass
+
+def serve_single_process(options):
+    """单进程模式：在当前进程中运行HTTP服务器"""
+    with create_server(options, create_listen_socket(options)) as httpd:
+        # 保存进程ID
+        save_server_pid(os.getpid())
+        open_browser(options)
+
+        def hand_over():
             try:
-                httpd.serve_forever()
-            except KeyboardInterrupt:
-                print("\n")
-                print("🛑 正在停止服务器...")
+                handed_over = spawn_successor(options, httpd.socket)
             except Exception as e:
-                print(f"\n⚠️  服务器运行时出错: {e}")
-                print("正在停止服务器...")
-    except Exception as e:
-        print(f"❌ 启动服务器失败: {e}")
-        sys.exit(1)
+                # 出错时也要释放锁，否则之后的 SIGHUP 都会被忽略
+                print(f"❌ 平滑重启失败，继续使用当前进程: {e}")
+                handed_over = False
+            if handed_over:
+                httpd.draining = True
+                httpd.shutdown()
+            else:
+                reload_lock.release()
+
+        def request_reload(signum, frame):
+            # 启动新进程需要几秒，不能阻塞主线程的 serve_forever
+            if reload_lock.acquire(blocking=False):
+                threading.Thread(target=hand_over, daemon=True).start()
+
+        reload_lock = threading.Lock()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, request_reload)
+        
+        print(f"✅ 服务器已启动，正在监听端口 {PORT}...")
+        print("   (按 Ctrl+C 停止服务器)")
+        notify_ready()
+        
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\n")
+            print("🛑 正在停止服务器...")
+        except Exception as e:
+            print(f"\n⚠️  服务器运行时出错: {e}")
+            print("正在停止服务器...")
+        if httpd.draining:
+            drain_server(httpd)
+        httpd.access_log.close()
+        if httpd.annotation_store is not None:
+            httpd.annotation_store.close()
+        if httpd.mqtt_broker is not None:
+            httpd.mqtt_broker.stop()
+        if httpd.command_journal is not None:
+            httpd.command_journal.close()
+        print_cache_stats(httpd.hot_cache)
+
+def serve_prefork(options):
+    """多进程模式：主进程监控N个共享监听端口的工作进程"""
+    listen_sock = None if options.reuseport else create_listen_socket(options)
+    master = PreforkMaster(options, listen_sock)
+    open_browser(options)
+    print(f"✅ 服务器已启动，正在监听端口 {PORT}...")
+    print("   (按 Ctrl+C 停止服务器)")
+    try:
+        master.run()
     finally:
-        # 清理PID文件
-        remove_pid_file()
-        print("✅ 服务器已停止")
+        master.stop()
+        if listen_sock is not None:
+            listen_sock.close()
+    print("\n🛑 所有工作进程已退出")
 
 def is_process_running(pid):
     """检查进程是否正在运行"""
@@ -281,7 +2460,8 @@ def stop_server():
         remove_pid_file()
         sys.exit(0)
     
-    # 尝试优雅停止
+    # 尝试优雅停止（多进程模式下由主进程通知工作进程退出）
+    workers = get_worker_pids()
     try:
         print(f"🛑 正在停止服务器 (PID: {pid})...")
         os.kill(pid, signal.SIGTERM)
@@ -296,6 +2476,15 @@ def stop_server():
         if is_process_running(pid):
             print("⚠️  进程未响应，强制终止...")
             os.kill(pid, signal.SIGKILL)
+
+        # 主进程被强制终止时工作进程可能残留
+        for worker_pid in workers:
+            if is_process_running(worker_pid):
+                print(f"⚠️  强制终止残留的工作进程 {worker_pid}...")
+                try:
+                    os.kill(worker_pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
         
         remove_pid_file()
         print("✅ 服务器已停止")
@@ -311,6 +2500,148 @@ def stop_server():
         print(f"❌ 停止服务器失败: {e}")
         sys.exit(1)
 
+def reload_server():
+    """平滑重启：通知运行中的服务器启动新进程并交出监听端口"""
+    pid = get_server_pid()
+    if not pid or not is_process_running(pid):
+        print("ℹ️  服务器未运行，请使用 'python3 server.py start' 启动")
+        sys.exit(1)
+    if not hasattr(signal, 'SIGHUP'):
+        print("❌ 当前系统不支持平滑重启，请使用 stop 后再 start")
+        sys.exit(1)
+
+    print(f"🔄 正在平滑重启服务器 (PID: {pid})...")
+    os.kill(pid, signal.SIGHUP)
+    # 新进程就绪后会写入新的PID文件
+    deadline = time.time() + RELOAD_READY_TIMEOUT + 2
+    while time.time() < deadline:
+        time.sleep(0.2)
+        new_pid = get_server_pid()
+        if new_pid and new_pid != pid and is_process_running(new_pid):
+            print(f"✅ 新服务器进程 {new_pid} 已接管端口 {PORT}")
+            print(f"   旧进程 {pid} 处理完剩余请求后退出（最多 {RELOAD_DRAIN_TIMEOUT} 秒）")
+            return
+        if not is_process_running(pid):
+            break
+    print("❌ 平滑重启失败，请查看服务器输出")
+    sys.exit(1)
+
+def fetch_metrics(timeout=2):
+    """从运行中的服务器读取运行指标，未启用（404）或无法连接时返回 None"""
+    import urllib.request
+    # 服务器可能以 --https 启动（自签名证书，本机访问不校验）
+    insecure = ssl.create_default_context()
+    insecure.check_hostname = False
+    insecure.verify_mode = ssl.CERT_NONE
+    for scheme, context in (('http', None), ('https', insecure)):
+        try:
+            with urllib.request.urlopen(f'{scheme}://127.0.0.1:{PORT}{METRICS_PATH}',
+                                        timeout=timeout, context=context) as resp:
+                return resp.read().decode('utf-8')
+        except (OSError, ValueError):
+            continue
+    return None
+
+def parse_metrics(text):
+    """把Prometheus文本格式解析为 [(名称, {标签: 值}, 数值), ...]"""
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        labels = {}
+        if '{' in name:
+            name, _, label_text = name.partition('{')
+            for item in label_text.rstrip('}').split(','):
+                key, _, label_value = item.partition('=')
+                labels[key] = label_value.strip('"')
+        samples.append((name, labels, float(value)))
+    return samples
+
+def estimate_quantile(buckets, quantile):
+    """根据直方图区间 [(上界, 累计数), ...] 估算分位数（返回所在区间的上界）"""
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    target = buckets[-1][1] * quantile
+    for bound, cumulative in buckets:
+        if cumulative >= target:
+            return bound
+    return buckets[-1][0]
+
+def print_metrics_summary(text):
+    """打印运行指标摘要"""
+    samples = parse_metrics(text)
+    by_status = {}
+    by_class = {}
+    buckets = {}
+    values = {}
+    mqtt_messages = {}
+    coalesced = {}
+    tls_handshakes = {}
+    presence_transitions = {}
+    for name, labels, value in samples:
+        if name == 'http_requests_total':
+            by_status[labels['status']] = by_status.get(labels['status'], 0) + value
+            stats = by_class.setdefault(labels['class'], {'count': 0, 'bytes': 0, 'sum': 0.0})
+            stats['count'] += value
+        elif name == 'http_response_bytes_total':
+            by_class.setdefault(labels['class'], {'count': 0, 'bytes': 0, 'sum': 0.0})['bytes'] = value
+        elif name == 'http_request_duration_seconds_sum':
+            by_class.setdefault(labels['class'], {'count': 0, 'bytes': 0, 'sum': 0.0})['sum'] = value
+        elif name == 'http_request_duration_seconds_bucket':
+            bound = float('inf') if labels['le'] == '+Inf' else float(labels['le'])
+            buckets.setdefault(labels['class'], []).append((bound, value))
+        elif name == 'mqtt_messages_total':
+            mqtt_messages[labels['direction']] = value
+        elif name == 'mqtt_control_coalesced_total':
+            coalesced[labels['type']] = value
+        elif name == 'tls_handshakes_total':
+            tls_handshakes[labels['resumed']] = value
+        elif name == 'presence_transitions_total':
+            presence_transitions[labels['state']] = value
+        elif not labels:
+            values[name] = value
+
+    total = sum(by_status.values())
+    print(f"   运行指标 (进程 {int(values.get('server_process_id', 0))}):")
+    print(f"     请求总数: {int(total)}  "
+          + "  ".join(f"{status}: {int(count)}" for status, count in sorted(by_status.items())))
+    print(f"     进行中: {int(values.get('http_connections_in_flight', 0))} 个连接, "
+          f"{int(values.get('http_requests_in_flight', 0))} 个请求")
+    print(f"     客户端中途断开: {int(values.get('http_broken_pipes_total', 0))} 次")
+    if 'tls_handshake_failures_total' in values:
+        handshakes = sum(tls_handshakes.values())
+        resumed = tls_handshakes.get('true', 0)
+        print(f"     TLS握手: {int(handshakes)} 次, 会话恢复 {int(resumed)} 次"
+              + (f" ({resumed / handshakes:.0%})" if handshakes else "")
+              + f", 失败 {int(values['tls_handshake_failures_total'])} 次")
+    for path_class, stats in sorted(by_class.items()):
+        if not stats['count']:
+            continue
+        avg_ms = stats['sum'] / stats['count'] * 1000
+        p95 = estimate_quantile(sorted(buckets.get(path_class, [])), 0.95)
+        p95_text = '-' if p95 is None else ('>10s' if p95 == float('inf') else f"≤{p95 * 1000:g}ms")
+        print(f"     {path_class:<6} {int(stats['count']):>8} 次  "
+              f"{stats['bytes'] / (1024 * 1024):>9.2f} MB  平均 {avg_ms:.1f}ms  p95 {p95_text}")
+    if 'mqtt_clients_connected' in values:
+        print(f"     MQTT: {int(values['mqtt_clients_connected'])} 个客户端, "
+              f"收到 {int(mqtt_messages.get('received', 0))} 条, "
+              f"发出 {int(mqtt_messages.get('sent', 0))} 条, "
+              f"丢弃 {int(mqtt_messages.get('dropped', 0))} 条")
+        if coalesced:
+            print(f"     控制消息合并: {int(sum(coalesced.values()))} 条 ("
+                  + ", ".join(f"{t}: {int(n)}" for t, n in sorted(coalesced.items())) + ")")
+    if 'presence_devices_online' in values:
+        print(f"     在线设备: {int(values['presence_devices_online'])} 台, "
+              f"心跳 {int(values.get('presence_heartbeats_total', 0))} 次, "
+              f"上线 {int(presence_transitions.get('online', 0))} 次, "
+              f"离线 {int(presence_transitions.get('offline', 0))} 次")
+    if 'journal_devices' in values:
+        print(f"     命令日志: {int(values['journal_devices'])} 个设备, "
+              f"写入 {int(values.get('journal_records_written_total', 0))} 条, "
+              f"丢弃 {int(values.get('journal_records_dropped_total', 0))} 条, "
+              f"回放 {int(values.get('mqtt_replays_total', 0))} 次")
+
 def show_status():
     """显示服务器状态"""
     pid = get_server_pid()
@@ -327,8 +2658,20 @@ def show_status():
     if is_process_running(pid):
         print(f"✅ 服务器正在运行")
         print(f"   PID: {pid}")
+        workers = get_worker_pids()
+        if workers:
+            alive = [worker for worker in workers if is_process_running(worker)]
+            print(f"   工作进程: {len(alive)}/{len(workers)} 运行中")
+            for worker in workers:
+                state = '运行中' if worker in alive else '已退出'
+                print(f"     - {worker} ({state})")
         print(f"   地址: http://{HOST}:{PORT}")
-        print(f"   停止: python3 server.py stop")
+        print(f"   停止: {stop_command()}")
+        metrics_text = fetch_metrics()
+        if metrics_text:
+            print_metrics_summary(metrics_text)
+        else:
+            print(f"   运行指标: 未启用（启动时加 --metrics 开启 {METRICS_PATH}）")
     else:
         print("⚠️  PID文件存在，但进程不存在")
         print(f"   PID: {pid}")
@@ -339,20 +2682,126 @@ def show_help():
     """显示帮助信息"""
     print(__doc__)
 
+class StartOptionParser(argparse.ArgumentParser):
+    """start 命令的参数解析器，记录所有选项名
+
+    省略 start 直接写选项（python3 server.py --port 9000）时，main() 据此判断
+    第一个参数是否为 start 的选项。
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.option_names = set()
+        super().__init__(*args, **kwargs)
+
+    def add_argument(self, *names, **kwargs):
+        self.option_names.update(names)
+        return super().add_argument(*names, **kwargs)
+
+def build_start_parser():
+    parser = StartOptionParser(prog='python3 server.py start')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help=f'监听端口 (默认: {PORT})')
+    parser.add_argument('--no-browser', action='store_true',
+                        help='启动后不自动打开浏览器')
+    parser.add_argument('--mode', choices=['pool', 'single'], default=SERVER_MODE,
+                        help=f'并发模式 (默认: {SERVER_MODE})')
+    parser.add_argument('--threads', type=int, default=MAX_WORKERS,
+                        help=f'线程池大小 (默认: {MAX_WORKERS})')
+    parser.add_argument('--queue', type=int, default=REQUEST_QUEUE_SIZE,
+                        help=f'等待队列深度 (默认: {REQUEST_QUEUE_SIZE})')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f'工作进程数，大于1时启用多进程模式 (默认: {WORKERS})')
+    parser.add_argument('--reuseport', action='store_true',
+                        help='多进程模式下每个工作进程各自绑定端口 (SO_REUSEPORT)，'
+                             '由内核分配连接')
+    parser.add_argument('--metrics', action='store_true',
+                        help=f'启用运行指标接口 {METRICS_PATH}（Prometheus文本格式）')
+    parser.add_argument('--mqtt', action='store_true',
+                        help=f'启用内置MQTT代理（WebSocket地址 {MQTT_PATH}）')
+    parser.add_argument('--mqtt-coalesce', type=float, default=mqtt_broker.COALESCE_RATE,
+                        metavar='HZ',
+                        help='控制消息按设备和命令类型合并后每秒最多转发的次数，0表示不合并 '
+                             f'(默认: {mqtt_broker.COALESCE_RATE})')
+    parser.add_argument('--presence-timeout', type=float, default=presence.PRESENCE_TIMEOUT,
+                        metavar='SECONDS',
+                        help='内置MQTT代理超过此时间没有收到设备心跳时判定离线，0表示不跟踪在线状态 '
+                             f'(默认: {presence.PRESENCE_TIMEOUT})')
+    parser.add_argument('--access-log', default=None, metavar='FILE',
+                        help='访问日志写入FILE（JSON Lines，按大小轮转），'
+                             '默认以文本格式输出到终端')
+    parser.add_argument('--annotations', default=None, metavar='DIR',
+                        help=f'启用标注上传接口 POST {ANNOTATIONS_PATH}，'
+                             '标注追加写入DIR中的JSON Lines分段文件')
+    parser.add_argument('--journal', default=None, metavar='DIR',
+                        help='把内置MQTT代理转发给设备的控制命令记录到DIR（每个设备一个环形日志文件），'
+                             f'可通过 {JOURNAL_PATH} 查看和回放，需要 --mqtt')
+    parser.add_argument('--journal-records', type=int, default=command_journal.JOURNAL_RECORDS,
+                        metavar='N',
+                        help=f'新建设备日志时保留的最近命令数，每条占 {command_journal.RECORD_SIZE} 字节 '
+                             f'(默认: {command_journal.JOURNAL_RECORDS})')
+    parser.add_argument('--https', action='store_true',
+                        help=f'使用HTTPS（未指定证书时自动生成自签名证书到 {CERT_DIR}/）')
+    parser.add_argument('--cert', default=None, metavar='FILE',
+                        help='HTTPS证书文件（PEM，文件更新后自动重新加载）')
+    parser.add_argument('--key', default=None, metavar='FILE',
+                        help='HTTPS私钥文件（PEM，默认与证书在同一文件中）')
+    parser.add_argument('--root', default=None,
+                        help='服务目录 (默认: web-prototype)')
+    parser.add_argument('--cache-size', type=float,
+                        default=HOT_CACHE_MAX_BYTES / (1024 * 1024),
+                        help='热点文件缓存大小，单位MB，0表示关闭 '
+                             f'(默认: {HOT_CACHE_MAX_BYTES // (1024 * 1024)})')
+    return parser
+
+def parse_start_options(args):
+    """解析start命令的参数"""
+    parser = build_start_parser()
+    options = parser.parse_args(args)
+    if options.cert or options.key:
+        options.https = True
+    if options.key and not options.cert:
+        parser.error('--key 需要同时指定 --cert')
+    if options.journal and not options.mqtt:
+        parser.error('--journal 需要同时指定 --mqtt')
+    if options.journal_records < 1:
+        parser.error('--journal-records 必须大于0')
+    if options.presence_timeout < 0:
+        parser.error('--presence-timeout 不能为负数')
+    return options
+
+def parse_port_option(args):
+    """解析stop/status命令的参数"""
+    parser = argparse.ArgumentParser(prog=f'python3 server.py {sys.argv[1]}')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help=f'服务器端口 (默认: {PORT})')
+    use_port(parser.parse_args(args).port)
+
+def is_start_option(arg):
+    """参数是否为 start 命令的选项（-h/--help 仍显示命令列表）"""
+    name = arg.split('=', 1)[0]
+    return name not in ('-h', '--help') and name in build_start_parser().option_names
+
 def main():
     """主函数"""
-    if len(sys.argv) < 2:
-        # 没有参数时，默认启动服务器
-        start_server()
+    if len(sys.argv) < 2 or is_start_option(sys.argv[1]):
+        # 没有命令或直接写 start 的选项时，默认启动服务器
+        start_server(parse_start_options(sys.argv[1:]))
     else:
         command = sys.argv[1].lower()
         
         if command == 'start':
-            start_server()
+            start_server(parse_start_options(sys.argv[2:]))
         elif command == 'stop':
+            parse_port_option(sys.argv[2:])
             stop_server()
+        elif command == 'reload':
+            parse_port_option(sys.argv[2:])
+            reload_server()
         elif command == 'status':
+            parse_port_option(sys.argv[2:])
             show_status()
+        elif command == 'cert':
+            generate_cert_command()
         elif command in ['help', '--help', '-h']:
             show_help()
         else:
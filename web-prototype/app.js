@@ -28,6 +28,10 @@ class SmartControlApp {
         this.editingCharacter = null;     // 当前正在编辑的角色
         this.browseMode = 'ai';           // 角色浏览模式：'ai' 或 'idol'
         this.selectionMode = 'ai';        // 角色选择模式：'ai' 或 'idol'
+        this.detachControlCurve = null;   // 停止跟随女优视频控制曲线的函数
+        this.controlCurvePath = null;     // 正在加载或跟随的曲线对应的视频路径
+        this.aiModeElapsed = 0;           // AI模式场景已运行的毫秒数（不含暂停时间）
+        this.aiModeResumedAt = null;      // 最近一次开始/继续运行的时间戳
         
         // 波形图相关属性
         this.waveformData = [];           // 存储波形数据点 {time: timestamp, speed: 0-100}
@@ -76,6 +80,19 @@ class SmartControlApp {
         this.setupQuickConnect();          // 初始化快速连接入口
         this.refreshQuickConnectUI();      // 同步快速连接状态
         this.updateHomeConnectionState();  // 同步首页功能可用性
+        this.loadPatternLibrary();         // 加载预编译的波形模式库
+    }
+
+    // 加载 pattern_compiler.py 生成的模式库，没有时波形仍实时计算
+    loadPatternLibrary() {
+        if (typeof PatternLibrary === 'undefined') return;
+        PatternLibrary.load();
+    }
+
+    // 当前模式库的版本（随命令发给设备，设备据此确认使用同一份查找表）
+    patternLibraryVersion() {
+        const library = typeof PatternLibrary !== 'undefined' ? PatternLibrary.current : null;
+        return library ? library.version : null;
     }
 
     /**
@@ -405,6 +422,12 @@ class SmartControlApp {
     switchScreen(screenName) {
         console.log('Switching to screen:', screenName);
         
+        // 离开女优详情页时停止按视频曲线发送命令
+        if (this.detachControlCurve && screenName !== 'idolDetail') {
+            this.detachControlCurve();
+            this.detachControlCurve = null;
+        }
+
         // Hide all screens
         document.querySelectorAll('.screen').forEach(screen => {
             screen.classList.remove('active');
@@ -2071,6 +2094,7 @@ class SmartControlApp {
             videoBg.play().catch(err => {
                 // Auto-play prevented, ignore
             });
+            this.followControlCurve(videoBg, idol.videoPath);
         }
         
         // Update basic info
@@ -2109,6 +2133,29 @@ class SmartControlApp {
         }
     }
 
+    // 按视频的控制曲线（由观看者标注编译而成）随播放进度发送速度/强度
+    async followControlCurve(video, videoPath) {
+        if (this.detachControlCurve) {
+            this.detachControlCurve();
+            this.detachControlCurve = null;
+        }
+        this.controlCurvePath = videoPath;
+        if (typeof ControlCurve === 'undefined') return;
+
+        const curve = await ControlCurve.load(videoPath);
+        // 加载期间可能已离开详情页或切换到了其他女优
+        if (!curve || this.currentScreen !== 'idolDetail' || this.controlCurvePath !== videoPath) {
+            return;
+        }
+        if (this.detachControlCurve) {
+            this.detachControlCurve();
+        }
+        this.detachControlCurve = curve.attach(video, ({ speed, intensity }) => {
+            this.sendCommand(DeviceCommands.setSpeed(speed));
+            this.sendCommand(DeviceCommands.setIntensity(intensity));
+        });
+    }
+
     // Render scenarios for character browsing
     renderCharacterScenarios() {
         const scenarioGrid = document.getElementById('characterScenariosGrid');
@@ -2517,6 +2564,10 @@ class SmartControlApp {
         });
 
         const wasPaused = this.aiModeState === 'paused';
+        if (!wasPaused) {
+            this.aiModeElapsed = 0;
+        }
+        this.aiModeResumedAt = Date.now();
 
         this.aiModeState = 'running';
         this.aiModeRunning = true;
@@ -2565,7 +2616,8 @@ class SmartControlApp {
 
         const command = wasPaused && DeviceCommands.resumeAIMode
             ? DeviceCommands.resumeAIMode()
-            : DeviceCommands.startAIMode(this.currentCharacter.id, this.currentScenario.id);
+            : DeviceCommands.startAIMode(this.currentCharacter.id, this.currentScenario.id,
+                this.patternLibraryVersion());
         this.sendCommand(command);
 
         if (wasPaused) {
@@ -2582,6 +2634,8 @@ class SmartControlApp {
         this.aiModeRunning = false;
         this.aiModePaused = true;
         this.isRunning = false;
+        this.aiModeElapsed = this.aiScenarioElapsed();
+        this.aiModeResumedAt = null;
 
         this.voiceInteraction.stopScenarioPlayback();
         if (this.waveformAnimation) {
@@ -2607,6 +2661,8 @@ class SmartControlApp {
         this.aiModeRunning = false;
         this.aiModePaused = false;
         this.isRunning = false;
+        this.aiModeElapsed = 0;
+        this.aiModeResumedAt = null;
         this.voiceInteraction.stopScenarioPlayback();
         
         // 停止语音识别
@@ -2631,6 +2687,14 @@ class SmartControlApp {
         this.showToast('AI模式已停止', 'info');
     }
 
+    // AI模式场景已运行的毫秒数（不含暂停时间）
+    aiScenarioElapsed() {
+        if (this.aiModeResumedAt === null) {
+            return this.aiModeElapsed;
+        }
+        return this.aiModeElapsed + (Date.now() - this.aiModeResumedAt);
+    }
+
     updateAIControls() {
         const playPauseBtn = document.getElementById('aiPlayPauseBtn');
         const playPauseIcon = document.getElementById('aiPlayPauseIcon');
@@ -2798,8 +2862,19 @@ class SmartControlApp {
         this.waveformLastUpdate = now;
         
         // 模拟生成速度数据（0-100之间，带有平滑变化和随机性）
-        // 使用简单的正弦波 + 随机波动模拟节奏变化
-        const baseSpeed = 50 + 30 * Math.sin(now / 3000); // 基础波形，周期约3秒
+        // AI模式按模式库中当前场景的强度曲线，否则使用正弦波；再加上随机波动
+        const library = typeof PatternLibrary !== 'undefined' ? PatternLibrary.current : null;
+        const sceneLevel = library && this.aiModeState === 'running' && this.currentScenario
+            ? library.scene(this.currentScenario.id, this.aiScenarioElapsed() / 1000)
+            : null;
+        let baseSpeed;
+        if (sceneLevel !== null) {
+            baseSpeed = 100 * sceneLevel;
+        } else {
+            // 基础波形，周期约19秒；模式库中没有正弦表时实时计算
+            const sine = library ? library.shape('sine', now / 3000) : null;
+            baseSpeed = 50 + 30 * (sine !== null ? sine : Math.sin(now / 3000));
+        }
         const randomVariation = (Math.random() - 0.5) * 15; // 随机波动 ±7.5
         const targetSpeed = Math.max(0, Math.min(100, baseSpeed + randomVariation));
         
@@ -0,0 +1,87 @@
+// Control Curve Module
+// 控制曲线模块：播放视频时按预先编译的曲线（curve_compiler.py 生成）发送速度/强度
+
+const CURVE_MAGIC = 'SCCV';
+const CURVE_VERSION = 1;
+const CURVE_HEADER_SIZE = 32;
+
+class ControlCurve {
+    constructor(rate, channels, samples, values) {
+        this.rate = rate;           // 每秒采样数
+        this.channels = channels;   // 通道数：0=速度, 1=强度
+        this.samples = samples;
+        this.values = values;       // Uint8Array，按采样交错存放各通道的值（0-100）
+    }
+
+    // 加载视频旁边的曲线文件（video.mp4 -> video.mp4.curve），没有曲线时返回 null
+    static async load(videoPath) {
+        try {
+            // /resource/ 下的文件会被浏览器缓存，曲线重新编译后需要用 ETag 确认是否更新
+            const response = await fetch(`${videoPath}.curve`, { cache: 'no-cache' });
+            if (!response.ok) {
+                return null;
+            }
+            return ControlCurve.parse(await response.arrayBuffer());
+        } catch (error) {
+            console.warn('[ControlCurve] 加载曲线失败:', error);
+            return null;
+        }
+    }
+
+    // 解析曲线文件（格式见 curve_compiler.py）
+    static parse(buffer) {
+        if (buffer.byteLength < CURVE_HEADER_SIZE) {
+            throw new Error('曲线文件不完整');
+        }
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+        const version = view.getUint16(4, true);
+        if (magic !== CURVE_MAGIC || version !== CURVE_VERSION) {
+            throw new Error('不是曲线文件或版本不支持');
+        }
+        const channels = view.getUint16(6, true);
+        const rate = view.getFloat32(8, true);
+        const samples = view.getUint32(12, true);
+        if (buffer.byteLength < CURVE_HEADER_SIZE + samples * channels) {
+            throw new Error('曲线文件不完整');
+        }
+        const values = new Uint8Array(buffer, CURVE_HEADER_SIZE, samples * channels);
+        return new ControlCurve(rate, channels, samples, values);
+    }
+
+    // 播放时间（秒）对应的各通道值，超出曲线范围时取两端的值
+    valueAt(seconds) {
+        const index = Math.max(0, Math.min(this.samples - 1, Math.floor(seconds * this.rate)));
+        const offset = index * this.channels;
+        return {
+            speed: this.values[offset],
+            intensity: this.channels > 1 ? this.values[offset + 1] : this.values[offset]
+        };
+    }
+
+    // 视频播放期间按曲线采样率查表，值变化时调用 onChange({speed, intensity})
+    // 返回停止跟随的函数
+    attach(video, onChange) {
+        let last = null;
+        const tick = () => {
+            if (video.paused || video.ended) {
+                return;
+            }
+            const value = this.valueAt(video.currentTime);
+            if (!last || last.speed !== value.speed || last.intensity !== value.intensity) {
+                last = value;
+                onChange(value);
+            }
+        };
+        const timer = setInterval(tick, 1000 / this.rate);
+        // 拖动进度条后立即同步
+        video.addEventListener('seeked', tick);
+        return () => {
+            clearInterval(timer);
+            video.removeEventListener('seeked', tick);
+        };
+    }
+}
+
+// 导出控制曲线模块
+window.ControlCurve = ControlCurve;
@@ -18,10 +18,16 @@ class MQTTClient {
         };
     }
 
-    // Initialize MQTT connection
+    // Broker built into server.py (python3 server.py start --mqtt)
+    static localBrokerUrl() {
+        const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        return `${scheme}://${window.location.host}/mqtt`;
+    }
+
+    // Initialize MQTT connection (defaults to the local broker)
     async connect(brokerUrl, deviceId, options = {}) {
         try {
-            this.brokerUrl = brokerUrl;
+            this.brokerUrl = brokerUrl || MQTTClient.localBrokerUrl();
             this.deviceId = deviceId;
             
             // Use MQTT.js for browser
@@ -35,7 +41,7 @@ class MQTTClient {
                 ...options
             };
 
-            this.client = mqtt.connect(brokerUrl, connectOptions);
+            this.client = mqtt.connect(this.brokerUrl, connectOptions);
 
             // Connection event handlers
             this.client.on('connect', () => {
@@ -189,8 +195,11 @@ class DeviceCommands {
         return this.createCommand('intensity', { value: Math.max(0, Math.min(100, intensity)) });
     }
 
-    static setPattern(pattern) {
-        return this.createCommand('pattern', { type: pattern });
+    // library: 模式库版本（patterns.lut 的内容哈希），设备据此确认与页面使用同一份查找表
+    static setPattern(pattern, library = null) {
+        const parameters = { type: pattern };
+        if (library) parameters.library = library;
+        return this.createCommand('pattern', parameters);
     }
 
     // Preset mode commands
@@ -234,11 +243,13 @@ class DeviceCommands {
     }
 
     // AI Mode Commands
-    static startAIMode(characterId, scenarioId) {
-        return this.createCommand('ai_mode_start', {
+    static startAIMode(characterId, scenarioId, library = null) {
+        const parameters = {
             character: characterId,
             scenario: scenarioId
-        });
+        };
+        if (library) parameters.library = library;
+        return this.createCommand('ai_mode_start', parameters);
     }
 
     static stopAIMode() {
@@ -0,0 +1,108 @@
+// Pattern Library Module
+// 波形模式库：加载 pattern_compiler.py 生成的 patterns.lut，按相位/时间查表
+// 浏览器和设备使用同一份定点数查找表，播放的曲线完全一致
+
+const PATTERN_LIBRARY_URL = 'patterns.lut';
+const PATTERN_LIBRARY_MAGIC = 'SCPL';
+const PATTERN_LIBRARY_VERSION = 1;
+const PATTERN_HEADER_SIZE = 32;
+const PATTERN_ENTRY_SIZE = 40;
+const PATTERN_Q15 = 32767;
+const PATTERN_TWO_PI = Math.PI * 2;
+// 预设模式 -> [载波, 调制波]（与 pattern_compiler.py 的 PATTERNS 相同）
+const PATTERN_SHAPES = {
+    wave: ['sine', null],
+    pulse: ['sine', 'sine'],
+    random: ['sine', 'swell']
+};
+
+class PatternLibrary {
+    constructor(version, tables) {
+        this.version = version;     // 内容哈希（16位十六进制），随命令发给设备以确认版本一致
+        this.tables = tables;       // 名称 -> {kind, cycles, rate, values: Int16Array}
+    }
+
+    // 加载模式库，成功后设为 PatternLibrary.current；没有模式库时返回 null（使用实时计算）
+    static async load(url = PATTERN_LIBRARY_URL) {
+        try {
+            const response = await fetch(url);
+            if (!response.ok) {
+                return null;
+            }
+            PatternLibrary.current = PatternLibrary.parse(await response.arrayBuffer());
+            console.log(`[PatternLibrary] 已加载模式库 ${PatternLibrary.current.version}`);
+            return PatternLibrary.current;
+        } catch (error) {
+            console.warn('[PatternLibrary] 加载模式库失败:', error);
+            return null;
+        }
+    }
+
+    // 解析模式库文件（格式见 pattern_compiler.py），各表直接引用同一个 ArrayBuffer
+    static parse(buffer) {
+        const view = new DataView(buffer);
+        const bytes = new Uint8Array(buffer);
+        const magic = String.fromCharCode(...bytes.subarray(0, 4));
+        if (magic !== PATTERN_LIBRARY_MAGIC || view.getUint16(4, true) !== PATTERN_LIBRARY_VERSION) {
+            throw new Error('不是模式库文件或版本不支持');
+        }
+        const count = view.getUint16(6, true);
+        const version = Array.from(bytes.subarray(8, 16), b => b.toString(16).padStart(2, '0')).join('');
+        if (buffer.byteLength < view.getUint32(20, true)) {
+            throw new Error('模式库文件不完整');
+        }
+        const decoder = new TextDecoder();
+        const tables = {};
+        for (let i = 0; i < count; i++) {
+            const entry = PATTERN_HEADER_SIZE + i * PATTERN_ENTRY_SIZE;
+            const nameBytes = bytes.subarray(entry, entry + 24);
+            const end = nameBytes.indexOf(0);
+            const name = decoder.decode(end >= 0 ? nameBytes.subarray(0, end) : nameBytes);
+            tables[name] = {
+                kind: bytes[entry + 24] === 0 ? 'shape' : 'scene',
+                cycles: view.getUint16(entry + 26, true),
+                rate: view.getFloat32(entry + 28, true),
+                values: new Int16Array(buffer, view.getUint32(entry + 32, true), view.getUint32(entry + 36, true))
+            };
+        }
+        return new PatternLibrary(version, tables);
+    }
+
+    has(name) {
+        return name in this.tables;
+    }
+
+    // 基本波形在相位 theta（弧度）处的值，没有该波形时返回 null
+    shape(name, theta) {
+        const table = this.tables[`shape/${name}`];
+        if (!table) return null;
+        const length = table.values.length;
+        let index = Math.floor(theta / PATTERN_TWO_PI * table.rate) % length;
+        if (index < 0) index += length;
+        return table.values[index] / PATTERN_Q15;
+    }
+
+    // 预设模式的值（-1..1）：载波相位 carrier 与调制波相位 modulator 分别查表后相乘，
+    // 没有该模式或缺少所需的表时返回 null
+    pattern(pattern, carrier, modulator) {
+        const shapes = PATTERN_SHAPES[pattern];
+        if (!shapes) return null;
+        const value = this.shape(shapes[0], carrier);
+        if (value === null || shapes[1] === null) return value;
+        const envelope = this.shape(shapes[1], modulator);
+        return envelope === null ? null : value * envelope;
+    }
+
+    // 场景在开始后第 seconds 秒的强度（0..1），没有该场景时返回 null
+    scene(scenarioId, seconds) {
+        const table = this.tables[`scene/${scenarioId}`];
+        if (!table) return null;
+        const index = Math.max(0, Math.min(table.values.length - 1, Math.floor(seconds * table.rate)));
+        return table.values[index] / PATTERN_Q15;
+    }
+}
+
+PatternLibrary.current = null;
+
+// 导出波形模式库模块
+window.PatternLibrary = PatternLibrary;
@@ -1,6 +1,12 @@
 // Waveform Animation Module
 // 波形动画模块
 
+// pulse/random 模式调制波的频率（每像素弧度），三条波共用
+const WAVEFORM_MODULATION = {
+    pulse: 0.01,
+    random: 0.005
+};
+
 class WaveformAnimation {
     constructor() {
         this.isRunning = false;
@@ -166,20 +172,28 @@ class WaveformAnimation {
         const centerY = this.canvas.height / 2;
         let y = centerY;
 
+        // 优先使用预编译的模式库（与设备播放的曲线一致），没有时实时计算
+        const carrier = x * wave.frequency + wave.phase;
+        const modulator = x * (WAVEFORM_MODULATION[this.pattern] || 0) + wave.phase;
+        const library = typeof PatternLibrary !== 'undefined' ? PatternLibrary.current : null;
+        const value = library ? library.pattern(this.pattern, carrier, modulator) : null;
+        if (value !== null) {
+            return centerY + wave.amplitude * value;
+        }
+
         switch (this.pattern) {
             case 'wave':
-                y = centerY + wave.amplitude * Math.sin(x * wave.frequency + wave.phase);
+                y = centerY + wave.amplitude * Math.sin(carrier);
                 break;
             case 'pulse':
-                y = centerY + wave.amplitude * Math.sin(x * wave.frequency + wave.phase) * 
-                    Math.sin(x * 0.01 + wave.phase);
+                y = centerY + wave.amplitude * Math.sin(carrier) * Math.sin(modulator);
                 break;
             case 'random':
-                y = centerY + wave.amplitude * Math.sin(x * wave.frequency + wave.phase) * 
-                    (0.5 + 0.5 * Math.sin(x * 0.005 + wave.phase));
+                y = centerY + wave.amplitude * Math.sin(carrier) * 
+                    (0.5 + 0.5 * Math.sin(modulator));
                 break;
             default:
-                y = centerY + wave.amplitude * Math.sin(x * wave.frequency + wave.phase);
+                y = centerY + wave.amplitude * Math.sin(carrier);
         }
 
         return y;